@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+from hayabusa.compactor import Compactor
+
+if __name__ == '__main__':
+    compactor = Compactor()
+    compactor.exec()
@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+from hayabusa.benchmark import IngestBenchmark
+
+if __name__ == '__main__':
+    benchmark = IngestBenchmark()
+    benchmark.exec()
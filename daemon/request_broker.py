@@ -7,5 +7,6 @@ broker.start_threads()
 
 api = falcon.API()
 api.add_route('/v1/request', broker)
+api.add_route('/v1/request/{request_id}', broker, suffix='request')
 api.add_route('/v1/status/{request_id}', broker)
 api.add_route('/v1/health_check', broker)
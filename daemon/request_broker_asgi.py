@@ -0,0 +1,12 @@
+import falcon.asgi
+
+from hayabusa.async_broker import AsyncRequestBroker
+
+broker = AsyncRequestBroker()
+
+# the broker starts its background tasks on the ASGI startup event
+api = falcon.asgi.App(middleware=[broker])
+api.add_route('/v1/request', broker)
+api.add_route('/v1/request/{request_id}', broker, suffix='request')
+api.add_route('/v1/status/{request_id}', broker)
+api.add_route('/v1/health_check', broker)
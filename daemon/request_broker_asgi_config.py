@@ -0,0 +1,17 @@
+from hayabusa import HayabusaBase
+
+
+# gunicorn --config request_broker_asgi_config.py request_broker_asgi:api
+hayabusa = HayabusaBase()
+syslog = True
+syslog_addr = 'unix:///dev/log#dgram'
+syslog_prefix = 'request_broker'
+syslog_facility = 'local0'
+proc_name = 'request_broker'
+bind = '0.0.0.0:%s' % hayabusa.config['request-broker']['port']
+# Requests are served by coroutines on the event loop of the worker.
+# [request-broker] processes: 2 or more workers share the request state
+# in [request-broker] state-file.
+worker_class = 'uvicorn.workers.UvicornWorker'
+workers = int(hayabusa.config['request-broker'].get('processes', '1'))
+loglevel = 'info'
@@ -8,8 +8,8 @@ syslog_prefix = 'request_broker'
 syslog_facility = 'local0'
 proc_name = 'request_broker'
 bind = '0.0.0.0:%s' % hayabusa.config['request-broker']['port']
-# Note: request_broker does not work with multiple workers.
-# workers must be 1.
-workers = 1
+# [request-broker] processes: 2 or more workers share the request state
+# in [request-broker] state-file.
+workers = int(hayabusa.config['request-broker'].get('processes', '1'))
 threads = 10
 loglevel = 'info'
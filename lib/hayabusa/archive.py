@@ -0,0 +1,269 @@
+import json
+import lzma
+import os
+import sqlite3
+import struct
+import tempfile
+import unittest
+import zlib
+from datetime import datetime, timedelta
+
+from hayabusa.bloom import BloomFilter, partition_terms, \
+    read_partition_bloom
+from hayabusa.errors import StorageError
+from hayabusa.storage import TIME_FORMAT, STRUCTURED, minute_str
+
+
+# A cold-tier archive (YYYY/MM/DD.archive) keeps the rows of a day as
+# hourly partitions, each compressed on its own, so that searches only
+# decompress the hours they need:
+#   [member 00][bloom 00][member 01][bloom 01]...[index][length][magic]
+# The index is a JSON object:
+#   {"codec": "xz", "version": 4,
+#    "members": {"03": {"start": "2018-08-01 03:00", "end": ...,
+#                       "offset": ..., "length": ..., "size": ...,
+#                       "rows": ..., "bloom_offset": ...,
+#                       "bloom_length": ...}, ...},
+#    "source": [name, size, modification time of the daily partition]}
+# Hourly members are searched as 'YYYY/MM/DD.archive#HH'.
+ARCHIVE_MAGIC = b'HBARCH01'
+TRAILER = struct.Struct('<Q8s')
+MEMBER_SEPARATOR = '#'
+
+CODECS = {
+    'xz': (lambda data: lzma.compress(data, preset=6), lzma.decompress),
+    'zlib': (lambda data: zlib.compress(data, 9), zlib.decompress),
+}
+
+
+def is_archive_member(path):
+    return MEMBER_SEPARATOR in os.path.basename(path)
+
+
+# Returns (archive path, 'HH').
+def split_member_path(path):
+    archive, hour = path.rsplit(MEMBER_SEPARATOR, 1)
+    return (archive, hour)
+
+
+# Copies the rows of an hour of a structured partition into a new
+# structured partition at 'path' (or an extracted member of the hour).
+# Returns the number of the copied rows and the bloom filter of all the
+# rows (or None if no rows are copied).
+def build_hour(src_path, hour, storage_format, path, bloom_bits=0):
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('PRAGMA SYNCHRONOUS = OFF')
+        conn.execute('PRAGMA JOURNAL_MODE = MEMORY')
+        storage_format.create_schema(conn)
+        conn.execute('ATTACH DATABASE ? AS SRC', (src_path,))
+        columns = 'MINUTE, TS, HOST, PROGRAM, SEVERITY, LOGS'
+        cur = conn.execute('INSERT INTO LOG(%s) SELECT %s FROM SRC.LOG '
+                           'WHERE MINUTE BETWEEN ? AND ?' %
+                           (columns, columns),
+                           (minute_str(hour),
+                            minute_str(hour + timedelta(minutes=59))))
+        rows = cur.rowcount
+        conn.commit()
+        conn.execute('DETACH DATABASE SRC')
+        if not rows:
+            return (0, None)
+        conn.execute("INSERT INTO SYSLOG(SYSLOG) VALUES('optimize')")
+        conn.commit()
+        bloom = None
+        if bloom_bits:
+            bloom = BloomFilter.build(partition_terms(conn),
+                                      storage_format.tokenizer, bloom_bits)
+        return (rows, bloom)
+    finally:
+        conn.close()
+
+
+class ArchiveWriter:
+    def __init__(self, path, codec='xz', source=None):
+        if codec not in CODECS:
+            raise StorageError('Unknown Archive Codec: %s' % codec)
+        self.path = path
+        self.codec = codec
+        self.source = source
+        self.members = {}
+        self.f = open(path, 'wb')
+
+    def add(self, hour, db_path, rows, bloom=None):
+        compress, _ = CODECS[self.codec]
+        with open(db_path, 'rb') as f:
+            data = f.read()
+        compressed = compress(data)
+        member = {'start': minute_str(hour),
+                  'end': minute_str(hour + timedelta(minutes=59)),
+                  'offset': self.f.tell(), 'length': len(compressed),
+                  'size': len(data), 'rows': rows}
+        self.f.write(compressed)
+        if bloom:
+            bloom_bytes = bloom.to_bytes()
+            member['bloom_offset'] = self.f.tell()
+            member['bloom_length'] = len(bloom_bytes)
+            self.f.write(bloom_bytes)
+        self.members['%02d' % hour.hour] = member
+        return member
+
+    def close(self):
+        index = {'codec': self.codec, 'version': STRUCTURED,
+                 'members': self.members}
+        if self.source:
+            index['source'] = list(self.source)
+        index = json.dumps(index).encode('utf-8')
+        self.f.write(index)
+        self.f.write(TRAILER.pack(len(index), ARCHIVE_MAGIC))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+
+
+class ArchiveReader:
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'rb') as f:
+                f.seek(-TRAILER.size, os.SEEK_END)
+                length, magic = TRAILER.unpack(f.read(TRAILER.size))
+                if magic != ARCHIVE_MAGIC:
+                    raise StorageError('Invalid Archive: %s' % path)
+                f.seek(-TRAILER.size - length, os.SEEK_END)
+                index = json.loads(f.read(length).decode('utf-8'))
+        except (OSError, ValueError, struct.error) as e:
+            raise StorageError('Invalid Archive: %s, %s' % (path, e))
+        self.codec = index['codec']
+        self.version = index['version']
+        self.members = index['members']
+        source = index.get('source')
+        self.source = tuple(source) if source else None
+
+    def read(self, offset, length):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    # Returns [(member path, start, end, rows, size), ...].
+    def member_list(self):
+        return [(self.path + MEMBER_SEPARATOR + hour,
+                 datetime.strptime(member['start'], TIME_FORMAT),
+                 datetime.strptime(member['end'], TIME_FORMAT),
+                 member['rows'], member['length'])
+                for hour, member in sorted(self.members.items())]
+
+    def bloom(self, hour):
+        member = self.members.get(hour)
+        if not member or 'bloom_offset' not in member:
+            return None
+        return BloomFilter.from_bytes(self.read(member['bloom_offset'],
+                                                member['bloom_length']))
+
+    # Decompresses an hourly member into 'path'.
+    # Returns False if the archive does not have the hour (no rows).
+    def extract(self, hour, path):
+        member = self.members.get(hour)
+        if not member:
+            return False
+        _, decompress = CODECS[self.codec]
+        data = decompress(self.read(member['offset'], member['length']))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+        return True
+
+
+# Makes the members of archives searchable by workers: the hours of
+# a command are decompressed into local files, removed by 'cleanup'.
+class ArchiveExtractor:
+    def __init__(self, tmp_dir):
+        self.tmp_dir = tmp_dir
+        self.readers = {}
+        self.files = []
+
+    def reader(self, path):
+        if path not in self.readers:
+            self.readers[path] = ArchiveReader(path)
+        return self.readers[path]
+
+    # For PartitionPruner: archive members have their bloom filters
+    # in the archive.
+    def load_bloom(self, path):
+        if not is_archive_member(path):
+            return read_partition_bloom(path)
+        archive, hour = split_member_path(path)
+        try:
+            return self.reader(archive).bloom(hour)
+        except StorageError:
+            # reported when the member is extracted
+            return None
+
+    # Returns the local path to search instead of 'path',
+    # or None if the archive has no rows in the hour.
+    def local_path(self, path):
+        if not is_archive_member(path):
+            return path
+        archive, hour = split_member_path(path)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        fd, local = tempfile.mkstemp(dir=self.tmp_dir, suffix='.db')
+        os.close(fd)
+        self.files.append(local)
+        if not self.reader(archive).extract(hour, local):
+            return None
+        return local
+
+    def cleanup(self):
+        for path in self.files:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.files = []
+
+
+class TestArchive(unittest.TestCase):
+
+    def test_archive(self):
+        from hayabusa.storage import StorageFormat
+        storage_format = StorageFormat(STRUCTURED)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            day_path = os.path.join(tmp_dir, 'day.db')
+            conn = sqlite3.connect(day_path)
+            storage_format.create_schema(conn)
+            storage_format.insert(conn, [
+                ('Aug  1 03:05:01 host1 sshd[1]: noc\n', '2018-08-01 03:05'),
+                ('Aug  1 05:00:01 host1 cron[1]: run\n', '2018-08-01 05:00')])
+            conn.commit()
+            conn.close()
+
+            path = os.path.join(tmp_dir, '01.archive')
+            writer = ArchiveWriter(path, 'zlib', ('01.db', 1024, 1))
+            for h in (3, 4, 5):
+                hour = datetime(2018, 8, 1, h)
+                hour_path = os.path.join(tmp_dir, '%02d.db' % h)
+                rows, bloom = build_hour(day_path, hour, storage_format,
+                                         hour_path, bloom_bits=10)
+                if rows:
+                    writer.add(hour, hour_path, rows, bloom)
+            writer.close()
+
+            self.assertEqual(('01.db', 1024, 1), ArchiveReader(path).source)
+            extractor = ArchiveExtractor(os.path.join(tmp_dir, 'x'))
+            self.assertEqual(['03', '05'],
+                             [p[-2:] for p, _, _, _, _ in
+                              extractor.reader(path).member_list()])
+            self.assertIn('noc', extractor.load_bloom(path + '#03'))
+            self.assertIsNone(extractor.local_path(path + '#04'))
+            local = extractor.local_path(path + '#03')
+            conn = sqlite3.connect(local)
+            self.assertEqual([('2018-08-01 03:05', 'host1')],
+                             conn.execute('SELECT MINUTE, HOST FROM LOG')
+                             .fetchall())
+            conn.close()
+            extractor.cleanup()
+            self.assertEqual([], os.listdir(os.path.join(tmp_dir, 'x')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+import asyncio
+import functools
+import json
+import uuid
+
+import falcon
+import zmq
+import zmq.asyncio
+
+from hayabusa.constants import Status
+from hayabusa.errors import HayabusaError, unexpected_error
+from hayabusa.registry import SharedRequestRegistry, BufferedRequestRegistry
+from hayabusa.request_broker import RequestBroker
+
+
+# The request broker on an asyncio event loop (ASGI):
+# the ZeroMQ sockets, the result collector, the command dispatcher, the
+# request monitor and the REST routes share the loop, so requests in
+# flight cost coroutines instead of threads.
+# bcrypt, the partition planning (file I/O) and the reads of the
+# shared request state (state-file) run in the default executor, so
+# they do not block the loop. The requests of this process are written
+# to the shared request state by a thread (BufferedRequestRegistry).
+# The instance is also the falcon middleware that starts and stops the
+# background tasks with the ASGI lifespan events.
+class AsyncRequestBroker(RequestBroker):
+    ZMQ_CONTEXT = zmq.asyncio.Context
+
+    def __init__(self):
+        super().__init__()
+        if isinstance(self.requests, SharedRequestRegistry):
+            self.requests = BufferedRequestRegistry(self.requests,
+                                                    self.logger)
+        self.loop = None
+        self.result_context = zmq.asyncio.Context()
+        self.tasks = set()
+        # {request ID: tasks sending the chunks of the request}
+        self.stream_sends = {}
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        # the loop only keeps weak references to the tasks
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def run_blocking(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None,
+                                          functools.partial(func, *args))
+
+    async def process_startup(self, scope, event):
+        self.loop = asyncio.get_running_loop()
+        self.logger.info('Starting Result Collector Task')
+        self.spawn(self.result_collector())
+        self.spawn(self.request_monitor())
+        self.spawn(self.command_dispatcher())
+
+    async def process_shutdown(self, scope, event):
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def result_collector(self):
+        self.logger.info('-------------'
+                         ' Starting ResultCollector '
+                         '-------------')
+        while True:
+            try:
+                message = await self.receiver.recv_json()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                unexpected_error(self.logger, 'ResultCollector', e)
+                continue
+            self.collect_result(message)
+
+    async def request_monitor(self):
+        self.logger.info('-------------'
+                         ' Starting RequestMonitor '
+                         '-------------')
+        try:
+            while True:
+                await asyncio.sleep(self.request_monitor_check_interval)
+                await self.run_blocking(self.check_requests)
+                await self.run_blocking(self.prune_counts)
+                disconnected = await self.run_blocking(
+                    self.disconnected_requests)
+                for request_id, record in disconnected:
+                    self.cancel_request(request_id, record,
+                                        'Client Disconnected')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            unexpected_error(self.logger, 'RequestMonitor', e)
+            raise
+
+    async def command_dispatcher(self):
+        self.logger.info('-------------'
+                         ' Starting CommandDispatcher '
+                         '-------------')
+        while True:
+            try:
+                identity, data = await self.sender.recv_multipart()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                unexpected_error(self.logger, 'CommandDispatcher', e)
+                continue
+            self.worker_message(identity, data)
+            self.dispatch()
+
+    # The dispatcher runs on the same loop, so new commands are
+    # dispatched directly.
+    def wake_dispatcher(self):
+        self.dispatch()
+
+    def send_to_worker(self, identity, worker, message):
+        future = self.sender.send_multipart([identity,
+                                             json.dumps(message).encode()])
+        if future.done() and future.exception():
+            self.logger.error('Cannot Send Command: %s, %s', worker,
+                              future.exception())
+            return False
+        return True
+
+    # The result collector runs on the same loop,
+    # so the messages are collected directly (or on the loop, from the
+    # executor).
+    def loopback(self, message):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.loop.call_soon_threadsafe(self.collect_result, message)
+            return
+        self.collect_result(message)
+
+    # The chunks are sent on the loop.
+    def chunk_sender(self, socket):
+        return socket
+
+    def forward_chunk(self, request_id, chunk):
+        sender = self.stream_socket(request_id)
+        if sender is None:
+            return
+        task = self.spawn(self.send_chunk(request_id, sender, chunk))
+        sends = self.stream_sends.setdefault(request_id, set())
+        sends.add(task)
+        task.add_done_callback(sends.discard)
+
+    async def send_chunk(self, request_id, sender, chunk):
+        try:
+            await asyncio.wait_for(sender.send_json(chunk),
+                                   self.stream_timeout)
+        except (zmq.Again, asyncio.TimeoutError):
+            if self.streams.get(request_id) is sender:
+                self.stream_stalled(request_id)
+
+    # The chunks being sent are sent before the socket is closed.
+    def close_stream(self, request_id):
+        sender = self.streams.pop(request_id, None)
+        sends = self.stream_sends.pop(request_id, set())
+        if sender is not None:
+            self.spawn(self.close_stream_base(sender, list(sends)))
+
+    async def close_stream_base(self, sender, sends):
+        await asyncio.gather(*sends, return_exceptions=True)
+        sender.close()
+
+    def send_result(self, request_id, message, update_status):
+        host, port = self.get_host_port(request_id)
+        self.spawn(self.send_result_base(request_id, host, port, message,
+                                         update_status))
+
+    async def port_check(self, host, port):
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), 1.0)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.logger.error('Cannot Connect %s, %s, %s' % (host, port, e))
+            return False
+        writer.close()
+        return True
+
+    async def send_result_base(self, request_id, host, port, message,
+                               update_status):
+        log_message = self.log_filter(message)
+        address = 'tcp://%s:%s' % (host, port)
+        self.logger.debug('%s - connecting %s' % (request_id, address))
+
+        if not await self.port_check(host, port):
+            self.logger.error('Cannot Connect %s, %s' % (address, log_message))
+            return
+        sender = self.result_context.socket(zmq.PUSH)
+        try:
+            sender.connect(address)
+            await sender.send_json(message)
+        finally:
+            # the message is still delivered (the default linger)
+            sender.close()
+        if update_status:
+            try:
+                self.update_status(request_id, Status.RC_SentResult,
+                                   log_message)
+            except HayabusaError as e:
+                # removed by the request monitor
+                self.logger.error(str(e))
+
+    async def send_command(self, data):
+        request_id = data['id']
+        sum, priority, messages = await self.run_blocking(
+            self.command_messages, data)
+        if not messages:
+            self.no_partitions(request_id, sum)
+            return
+        if self.coalesce(data):
+            return
+        messages = [message for message in messages
+                    if not self.cached_result(message)]
+        self.scheduler.add(data['user'], request_id, priority, messages)
+        self.wake_dispatcher()
+        log_message = self.log_filter(data)
+        self.notify_status(request_id, Status.RW_SentAllCommands, log_message)
+
+    async def on_get(self, req, resp, request_id=None):
+        log_message = ''
+        try:
+            if req.path.find('/v1/health_check') == 0:
+                self.logger.debug('path: %s', req.path)
+                resp.media = self.health_status()
+            elif req.path.find('/v1/status/') == 0:
+                body = await req.stream.read()
+                data = self.load_post_data(body)
+                log_message = {'data': self.log_filter(data)}
+                self.logger.debug('path: %s, body: %s', req.path, log_message)
+                auth_user = await self.run_blocking(self.authenticate, data)
+                resp.media = await self.run_blocking(self.request_status,
+                                                     request_id, auth_user)
+            else:
+                resp.status = falcon.HTTP_404
+        except HayabusaError as e:
+            self.hayabusa_error(resp, e, log_message)
+        except Exception as e:
+            self.internal_server_error(resp, e, log_message)
+
+    async def on_delete_request(self, req, resp, request_id):
+        log_message = ''
+        try:
+            body = await req.stream.read()
+            data = self.load_post_data(body)
+            log_message = {'data': self.log_filter(data)}
+            self.logger.debug('path: %s, body: %s', req.path, log_message)
+            auth_user = await self.run_blocking(self.authenticate, data)
+            resp.media = await self.run_blocking(self.cancel, request_id,
+                                                 auth_user)
+        except HayabusaError as e:
+            self.hayabusa_error(resp, e, log_message)
+        except Exception as e:
+            self.internal_server_error(resp, e, log_message)
+
+    async def on_post(self, req, resp):
+        log_message = ''
+        request_id = str(uuid.uuid1())
+        try:
+            body = await req.stream.read()
+            log_message = {'id': request_id, 'data': body.decode()}
+            data = self.load_post_data(body)
+            data['id'] = request_id
+            log_message = self.log_filter(data)
+            self.logger.debug('request path: %s, body: %s',
+                              req.path, log_message)
+            if req.path == '/v1/request':
+                user = await self.run_blocking(self.authenticate, data)
+                host, port = self.get_host_port_from_post(data)
+                self.create_request(user, request_id,
+                                    Status.CR_ReceivedRequest,
+                                    host, port, log_message)
+                await self.send_command(data)
+                resp.media = {'id': request_id}
+            else:
+                resp.status = falcon.HTTP_404
+        except HayabusaError as e:
+            self.hayabusa_error(resp, e, log_message, request_id=request_id)
+        except Exception as e:
+            self.internal_server_error(resp, e, log_message)
@@ -0,0 +1,95 @@
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import unittest
+from collections import OrderedDict
+
+
+# Credentials verified with bcrypt, so that repeated requests of a user
+# (eg: the status polling of the WebUI, the search query poller) do not
+# hash the password again.
+# The keys are HMACs of the user, the password and the password hash
+# with a random key of the process, so neither the passwords nor
+# anything to check them with offline are kept, and a new password hash
+# does not match the old entries.
+# Entries expire after 'ttl' seconds, and the least recently used are
+# evicted beyond 'max_size'.
+class CredentialCache:
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.secret = os.urandom(32)
+        self.hits = 0
+        self.misses = 0
+        # {key: expiration time}
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, user, password, password_hash):
+        data = json.dumps([user, password, password_hash])
+        return hmac.new(self.secret, data.encode('utf-8'),
+                        hashlib.sha256).digest()
+
+    def verified(self, user, password, password_hash):
+        key = self.key(user, password, password_hash)
+        with self.lock:
+            expiration = self.entries.get(key)
+            if expiration is None or expiration < self.clock():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return False
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return True
+
+    def add(self, user, password, password_hash):
+        key = self.key(user, password, password_hash)
+        with self.lock:
+            self.entries[key] = self.clock() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TestCredentialCache(unittest.TestCase):
+
+    def test_credential_cache(self):
+        now = [0.0]
+        cache = CredentialCache(2, 60, clock=lambda: now[0])
+        self.assertFalse(cache.verified('a', 'pass', 'hash-a'))
+        cache.add('a', 'pass', 'hash-a')
+        self.assertTrue(cache.verified('a', 'pass', 'hash-a'))
+        self.assertFalse(cache.verified('a', 'wrong', 'hash-a'))
+        # a new password hash
+        self.assertFalse(cache.verified('a', 'pass', 'hash-a2'))
+        # no plaintext
+        self.assertNotIn(b'pass', b''.join(cache.entries))
+        now[0] = 61.0
+        self.assertFalse(cache.verified('a', 'pass', 'hash-a'))
+        self.assertEqual(0, len(cache))
+
+    def test_eviction(self):
+        cache = CredentialCache(2, 60)
+        cache.add('a', 'pass', 'hash-a')
+        cache.add('b', 'pass', 'hash-b')
+        self.assertTrue(cache.verified('a', 'pass', 'hash-a'))
+        cache.add('c', 'pass', 'hash-c')
+        self.assertFalse(cache.verified('b', 'pass', 'hash-b'))
+        self.assertTrue(cache.verified('a', 'pass', 'hash-a'))
+        cache.clear()
+        self.assertFalse(cache.verified('a', 'pass', 'hash-a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,324 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from hayabusa import HayabusaBase
+from hayabusa.bloom import bloom_path
+from hayabusa.db_file_path import partition_path
+from hayabusa.errors import HayabusaError, unexpected_error
+from hayabusa.log_parser import parse_line
+from hayabusa.storage import StorageFormat, FORMAT_NAMES, TOKENIZERS
+from hayabusa.store_engine import PartitionWriter, load_store_config
+
+
+PROGRAMS = ['sshd', 'CRON', 'kernel', 'systemd', 'sudo', 'postfix/smtpd',
+            'nginx', 'dhclient', 'rsyslogd', 'ntpd']
+USERS = ['root', 'admin', 'noc', 'ubuntu', 'deploy', 'backup']
+TEMPLATES = [
+    'Accepted password for {user} from {ip} port {port} ssh2',
+    'Failed password for invalid user {user} from {ip} port {port} ssh2',
+    'pam_unix(sshd:session): session opened for user {user} by (uid=0)',
+    '({user}) CMD ({word} {word} {word})',
+    'connection from {ip} {word} {word} status={num}',
+    '{word} {word} {word} {word} {num} {word}',
+]
+
+
+def human_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024.0:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f TB' % size
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+# Generates syslog lines (RFC 3164 with priorities) from a fixed seed.
+# The words of the messages follow a Zipf-like distribution,
+# as the terms of real logs do.
+class SyslogGenerator:
+    def __init__(self, hosts=50, programs=10, words=5000, seed=1):
+        self.random = random.Random(seed)
+        self.hosts = ['host%03d' % i for i in range(hosts)]
+        self.programs = (PROGRAMS + ['app%02d' % i for i in
+                                     range(max(0, programs -
+                                               len(PROGRAMS)))])[:programs]
+        self.words = ['w%05d' % i for i in range(words)]
+        self.weights = [1.0 / (i + 1) for i in range(words)]
+
+    def word(self):
+        return self.random.choices(self.words, self.weights)[0]
+
+    def message(self):
+        r = self.random
+        template = r.choice(TEMPLATES)
+        while '{word}' in template:
+            template = template.replace('{word}', self.word(), 1)
+        return template.format(
+            user=r.choice(USERS),
+            ip='10.%d.%d.%d' % (r.randrange(256), r.randrange(256),
+                                r.randrange(1, 255)),
+            port=r.randrange(1024, 65536), num=r.randrange(1000))
+
+    def line(self, time):
+        r = self.random
+        priority = r.randrange(8) + 8 * r.choice([1, 3, 4, 10, 16])
+        return '<%d>%s %2d %s %s %s[%d]: %s\n' % (
+            priority, time.strftime('%b'), time.day,
+            time.strftime('%H:%M:%S'), r.choice(self.hosts),
+            r.choice(self.programs), r.randrange(1, 32768), self.message())
+
+    # Lines spread over the minute.
+    def lines(self, count, minute):
+        return [self.line(minute + timedelta(seconds=60 * i // count))
+                for i in range(count)]
+
+    # Writes lines with the current time at 'rate' lines per second
+    # (0: as fast as possible), eg: into 'store_engine.py --follow'.
+    def stream(self, out, rate, count=0):
+        written = 0
+        start = time.time()
+        while not count or written < count:
+            out.write(self.line(datetime.now()))
+            written += 1
+            if rate:
+                wait = start + written / rate - time.time()
+                if wait > 0:
+                    out.flush()
+                    time.sleep(wait)
+        out.flush()
+
+
+class IngestBenchmark(HayabusaBase):
+    def __init__(self):
+        self.args = self.parse_args()
+        super().__init__('ingest-benchmark', stderr_logging=self.args.v)
+
+        store_config = load_store_config()
+        storage = store_config['storage']
+        self.storage_format = StorageFormat.from_config({
+            'format': self.args.format or storage.get('format', 'fts3'),
+            'tokenizer': self.args.tokenizer or
+            storage.get('tokenizer', 'unicode61'),
+            'prefix': self.args.prefix if self.args.prefix is not None
+            else storage.get('prefix', '')})
+        if self.args.bloom_bits is not None:
+            self.bloom_bits = self.args.bloom_bits
+        else:
+            self.bloom_bits = float(storage.get('bloom-bits-per-term', '0'))
+        self.batch_lines = self.args.batch_lines or \
+            int(store_config['ingest']['batch-lines'])
+        self.generator = SyslogGenerator(self.args.hosts, self.args.programs,
+                                         self.args.words, self.args.seed)
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser(
+            description='measure the ingest path of the store engine '
+                        'with synthetic syslog')
+        parser.add_argument('--lines', type=int, default=10000,
+                            help='lines per partition (default: 10000)')
+        parser.add_argument('--partitions', type=int, default=5,
+                            help='minute partitions to build (default: 5)')
+        parser.add_argument('--hosts', type=int, default=50,
+                            help='distinct hosts (default: 50)')
+        parser.add_argument('--programs', type=int, default=10,
+                            help='distinct programs (default: 10)')
+        parser.add_argument('--words', type=int, default=5000,
+                            help='vocabulary of the messages '
+                                 '(default: 5000)')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--format', choices=sorted(FORMAT_NAMES),
+                            help='storage format (default: store_config)')
+        parser.add_argument('--tokenizer', choices=TOKENIZERS)
+        parser.add_argument('--prefix', help="prefix indexes, eg: '2 3'")
+        parser.add_argument('--bloom-bits', type=float,
+                            help='bloom filter bits per term, 0 to disable')
+        parser.add_argument('--batch-lines', type=int,
+                            help='lines per insert (default: store_config)')
+        parser.add_argument('--query',
+                            help='match to time on each partition '
+                                 '(default: a frequent word)')
+        parser.add_argument('--store-dir',
+                            help='local store directory to build into '
+                                 '(default: a temporary directory, '
+                                 'removed afterwards)')
+        parser.add_argument('--generate', action='store_true',
+                            help='only write synthetic syslog to stdout')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='with --generate, lines per second '
+                                 '(default: 0, unlimited)')
+        parser.add_argument('--count', type=int, default=0,
+                            help='with --generate, lines to write '
+                                 '(default: 0, endless)')
+        parser.add_argument('--json', action='store_true',
+                            help='print the results in JSON')
+        parser.add_argument('-v', help='verbose', action='store_true')
+        return parser.parse_args()
+
+    # Builds the partitions as the store engine does (staged and
+    # published), and returns the build latencies and the raw bytes.
+    def build(self, store_dir, staging_dir, minutes):
+        latencies = []
+        raw_bytes = 0
+        for minute in minutes:
+            lines = self.generator.lines(self.args.lines, minute)
+            raw_bytes += sum(len(line.encode('utf-8')) for line in lines)
+            path = partition_path(store_dir, minute)
+            start = time.time()
+            writer = PartitionWriter(path, minute, self.logger,
+                                     self.storage_format, overwrite=True,
+                                     bloom_bits=self.bloom_bits,
+                                     staging_dir=staging_dir)
+            for i in range(0, len(lines), self.batch_lines):
+                writer.write(lines[i:i + self.batch_lines])
+            writer.close()
+            latencies.append(time.time() - start)
+        return latencies, raw_bytes
+
+    def query(self, paths, match):
+        expression = self.storage_format.match_expression(match, False)
+        latencies = []
+        rows = 0
+        for path in paths:
+            conn = sqlite3.connect('file:%s?immutable=1' % path, uri=True)
+            try:
+                start = time.time()
+                rows += conn.execute('SELECT count(*) FROM SYSLOG '
+                                     'WHERE SYSLOG MATCH ?',
+                                     (expression,)).fetchone()[0]
+                latencies.append(time.time() - start)
+            finally:
+                conn.close()
+        return latencies, rows
+
+    def run(self, store_dir):
+        staging_dir = os.path.join(store_dir, 'staging')
+        base_dir = os.path.join(store_dir, 'store')
+        first = datetime.now().replace(second=0, microsecond=0) - \
+            timedelta(minutes=self.args.partitions)
+        minutes = [first + timedelta(minutes=i)
+                   for i in range(self.args.partitions)]
+
+        build_latencies, raw_bytes = self.build(base_dir, staging_dir,
+                                                minutes)
+        paths = [partition_path(base_dir, minute) for minute in minutes]
+        db_bytes = sum(os.path.getsize(path) for path in paths)
+        bloom_bytes = sum(os.path.getsize(bloom_path(path))
+                          for path in paths
+                          if os.path.exists(bloom_path(path)))
+        match = self.args.query or self.generator.words[0]
+        query_latencies, rows = self.query(paths, match)
+
+        lines = self.args.lines * self.args.partitions
+        ingest_time = sum(build_latencies)
+        return {
+            'format': self.storage_format.to_dict(),
+            'bloom_bits_per_term': self.bloom_bits,
+            'lines': lines,
+            'partitions': self.args.partitions,
+            'raw_bytes': raw_bytes,
+            'ingest_seconds': ingest_time,
+            'lines_per_second': lines / ingest_time,
+            'db_bytes': db_bytes,
+            'bloom_bytes': bloom_bytes,
+            'index_overhead': (db_bytes + bloom_bytes - raw_bytes) /
+            raw_bytes,
+            'build_seconds': {
+                'min': min(build_latencies),
+                'avg': ingest_time / len(build_latencies),
+                'p95': percentile(build_latencies, 0.95),
+                'max': max(build_latencies)},
+            'query': match,
+            'query_rows': rows,
+            'query_seconds': {
+                'avg': sum(query_latencies) / len(query_latencies),
+                'max': max(query_latencies)},
+        }
+
+    def print_results(self, results):
+        if self.args.json:
+            sys.stdout.write(json.dumps(results, indent=2) + '\n')
+            return
+        build = results['build_seconds']
+        query = results['query_seconds']
+        sys.stdout.write(
+            'format: %s, bloom: %s bits/term\n'
+            'lines: %d (%d partitions), raw: %s\n'
+            'ingest: %.2fs, %.0f lines/s\n'
+            'disk: %s (db %s, bloom %s), index overhead: %.1f%%\n'
+            'build latency: min %.3fs, avg %.3fs, p95 %.3fs, max %.3fs\n'
+            "query '%s': %d rows, avg %.2fms, max %.2fms per partition\n" %
+            (results['format'], results['bloom_bits_per_term'],
+             results['lines'], results['partitions'],
+             human_bytes(results['raw_bytes']),
+             results['ingest_seconds'], results['lines_per_second'],
+             human_bytes(results['db_bytes'] + results['bloom_bytes']),
+             human_bytes(results['db_bytes']),
+             human_bytes(results['bloom_bytes']),
+             results['index_overhead'] * 100,
+             build['min'], build['avg'], build['p95'], build['max'],
+             results['query'], results['query_rows'],
+             query['avg'] * 1000, query['max'] * 1000))
+
+    def main(self):
+        if self.args.generate:
+            self.generator.stream(sys.stdout, self.args.rate,
+                                  self.args.count)
+            return
+        if self.args.lines <= 0 or self.args.partitions <= 0:
+            raise HayabusaError('--lines and --partitions must be positive')
+        if self.args.store_dir:
+            self.print_results(self.run(self.args.store_dir))
+            return
+        store_dir = tempfile.mkdtemp(prefix='hayabusa-benchmark-')
+        try:
+            self.print_results(self.run(store_dir))
+        finally:
+            shutil.rmtree(store_dir)
+
+    def exec(self):
+        try:
+            self.main()
+        except (KeyboardInterrupt, BrokenPipeError):
+            sys.stderr.write('Interrupted\n')
+            exit(1)
+        except HayabusaError as e:
+            self.logger.error('%s: %s', e.__class__.__name__, e)
+            sys.stderr.write('%s: %s\n' % (e.__class__.__name__, e))
+            exit(1)
+        except Exception as e:
+            unexpected_error(self.logger, 'IngestBenchmark', e)
+            raise
+
+
+class TestSyslogGenerator(unittest.TestCase):
+
+    def test_lines(self):
+        minute = datetime(2018, 8, 1, 3, 5)
+        lines = SyslogGenerator(hosts=3, programs=2, seed=1).lines(10,
+                                                                   minute)
+        self.assertEqual(lines,
+                         SyslogGenerator(hosts=3, programs=2,
+                                         seed=1).lines(10, minute))
+        for line in lines:
+            ts, host, program, severity = parse_line(line, 2018, 8)
+            self.assertTrue(ts.startswith('2018-08-01 03:05:'))
+            self.assertIn(host, ['host000', 'host001', 'host002'])
+            self.assertIn(program, ['sshd', 'CRON'])
+            self.assertIsNotNone(severity)
+
+
+if __name__ == '__main__':
+    unittest.main()
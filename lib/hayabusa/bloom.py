@@ -0,0 +1,204 @@
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import unittest
+
+from hayabusa.storage import FTS5_OPERATORS, FTS5_TOKEN_RE
+
+
+BLOOM_SUFFIX = '.bloom'
+DEFAULT_HASHES = 7
+
+
+def bloom_path(path):
+    return path + BLOOM_SUFFIX
+
+
+class BloomFilter:
+    def __init__(self, num_bits, num_hashes=DEFAULT_HASHES, tokenizer=None,
+                 bits=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.tokenizer = tokenizer
+        if bits is None:
+            bits = bytearray((num_bits + 7) // 8)
+        self.bits = bits
+
+    @classmethod
+    def build(cls, terms, tokenizer, bits_per_term):
+        terms = list(terms)
+        num_bits = max(64, int(math.ceil(len(terms) * bits_per_term)))
+        bloom = cls(num_bits, tokenizer=tokenizer)
+        for term in terms:
+            bloom.add(term)
+        return bloom
+
+    def indexes(self, term):
+        digest = hashlib.blake2b(term.encode('utf-8'), digest_size=16)
+        value = digest.digest()
+        h1 = int.from_bytes(value[:8], 'little')
+        h2 = int.from_bytes(value[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, term):
+        for index in self.indexes(term):
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, term):
+        return all(self.bits[index >> 3] & (1 << (index & 7))
+                   for index in self.indexes(term))
+
+    def contains_all(self, terms):
+        return all(term in self for term in terms)
+
+    def to_bytes(self):
+        header = {'tokenizer': self.tokenizer, 'bits': self.num_bits,
+                  'hashes': self.num_hashes}
+        return json.dumps(header).encode('utf-8') + b'\n' + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        header, bits = data.split(b'\n', 1)
+        header = json.loads(header.decode('utf-8'))
+        return cls(header['bits'], header['hashes'], header['tokenizer'],
+                   bytearray(bits))
+
+    def write(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.to_bytes())
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+# The distinct terms of an FTS5 partition, as tokenized by its tokenizer.
+def partition_terms(conn):
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.SYSLOG_VOCAB "
+                 "USING fts5vocab(main, 'SYSLOG', 'row')")
+    try:
+        for row in conn.execute('SELECT TERM FROM temp.SYSLOG_VOCAB'):
+            yield row[0]
+    finally:
+        conn.execute('DROP TABLE temp.SYSLOG_VOCAB')
+
+
+def write_partition_bloom(conn, path, tokenizer, bits_per_term):
+    bloom = BloomFilter.build(partition_terms(conn), tokenizer,
+                              bits_per_term)
+    bloom.write(bloom_path(path))
+    return bloom
+
+
+def read_partition_bloom(path):
+    return BloomFilter.read(bloom_path(path))
+
+
+# Tokenizes phrases with the same FTS5 tokenizer as the partitions,
+# so that the terms are the same as the terms in their bloom filters.
+def query_terms(phrases, tokenizer):
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute("CREATE VIRTUAL TABLE Q USING fts5(T, tokenize='%s')" %
+                     tokenizer)
+        conn.executemany('INSERT INTO Q VALUES (?)', [(p,) for p in phrases])
+        conn.execute('CREATE VIRTUAL TABLE temp.V '
+                     "USING fts5vocab(main, 'Q', 'row')")
+        return [row[0] for row in conn.execute('SELECT TERM FROM temp.V')]
+    finally:
+        conn.close()
+
+
+# The phrases all of which a matching line must contain.
+# Queries with OR, NOT or parentheses, and prefix terms are not used,
+# so they never skip partitions.
+def required_phrases(match, exact):
+    if not match:
+        return []
+    if exact:
+        return [match]
+    phrases = []
+    position = 0
+    match = match.strip()
+    while position < len(match):
+        m = FTS5_TOKEN_RE.match(match, position)
+        if not m:
+            return []
+        position = m.end()
+        phrase, paren, word = m.groups()
+        if paren or word in FTS5_OPERATORS:
+            if word == 'AND':
+                continue
+            return []
+        term = phrase or word
+        if term.endswith('*'):
+            continue
+        if phrase:
+            term = term[1:-1].replace('""', '"')
+        phrases.append(term)
+    return phrases
+
+
+# 'load_bloom' returns the bloom filter of a partition path.
+class PartitionPruner:
+    def __init__(self, phrases, load_bloom=read_partition_bloom):
+        self.phrases = phrases
+        self.load_bloom = load_bloom
+        self.terms = {}
+
+    def tokenized(self, tokenizer):
+        if tokenizer not in self.terms:
+            self.terms[tokenizer] = query_terms(self.phrases, tokenizer)
+        return self.terms[tokenizer]
+
+    # False only if the bloom filter says the partition cannot match.
+    # Partitions without a bloom filter (being written, or legacy)
+    # are always searched.
+    def may_match(self, path):
+        if not self.phrases:
+            return True
+        try:
+            bloom = self.load_bloom(path)
+        except (OSError, ValueError, KeyError):
+            return True
+        if bloom is None:
+            return True
+        return bloom.contains_all(self.tokenized(bloom.tokenizer))
+
+
+class TestBloom(unittest.TestCase):
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter.build(['noc', 'login', '192'], 'unicode61', 10)
+        self.assertTrue(bloom.contains_all(['noc', '192']))
+        self.assertFalse('absent' in bloom and 'missing' in bloom)
+
+    def test_required_phrases(self):
+        self.assertEqual(['noc', '192.168.0.1'],
+                         required_phrases('noc 192.168.0.1', False))
+        self.assertEqual(['login failed', 'noc'],
+                         required_phrases('"login failed" AND noc acc*',
+                                          False))
+        self.assertEqual([], required_phrases('noc OR root', False))
+        self.assertEqual(['noc OR root'],
+                         required_phrases('noc OR root', True))
+
+    def test_partition_terms(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE VIRTUAL TABLE SYSLOG USING FTS5(LOGS)')
+        conn.execute("INSERT INTO SYSLOG VALUES ('Accepted for Noc')")
+        self.assertEqual(['accepted', 'for', 'noc'],
+                         sorted(partition_terms(conn)))
+        self.assertEqual(['168', '192', 'noc'],
+                         sorted(query_terms(['NOC', '192.168'],
+                                            'unicode61')))
+
+
+if __name__ == '__main__':
+    unittest.main()
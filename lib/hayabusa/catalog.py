@@ -0,0 +1,232 @@
+import glob
+import os
+import sqlite3
+import unittest
+from datetime import datetime, timedelta
+
+from hayabusa.archive import ArchiveReader
+from hayabusa.db_file_path import PartitionGroup, covered_range
+from hayabusa.errors import StorageError
+from hayabusa.storage import TIME_FORMAT, minute_str, partition_rows, \
+    partition_version
+
+
+CATALOG_FILE = 'catalog.db'
+
+# Partition files of a store, and the time format of their paths
+PARTITION_PATTERNS = [
+    (os.path.join('[0-9]' * 4, '[0-9][0-9]', '[0-9][0-9]',
+                  '[0-2][0-9]', '[0-5][0-9].db'), '%Y/%m/%d/%H/%M.db',
+     timedelta(0)),
+    (os.path.join('[0-9]' * 4, '[0-9][0-9]', '[0-9][0-9]',
+                  '[0-2][0-9].db'), '%Y/%m/%d/%H.db',
+     timedelta(minutes=59)),
+    (os.path.join('[0-9]' * 4, '[0-9][0-9]', '[0-9][0-9].db'),
+     '%Y/%m/%d.db', timedelta(days=1) - timedelta(minutes=1)),
+]
+ARCHIVE_PATTERN = os.path.join('[0-9]' * 4, '[0-9][0-9]',
+                               '[0-9][0-9].archive')
+
+
+def catalog_path(store_dir):
+    return os.path.join(store_dir, CATALOG_FILE)
+
+
+def catalog_exists(store_dir):
+    return os.path.exists(catalog_path(store_dir))
+
+
+# The catalog lists the partitions of a store: the path (relative to
+# the store), the first and the last minutes ('YYYY-MM-DD hh:mm'),
+# the storage format version, the number of rows and the file size.
+# The store engine and the compactor keep it up to date, so that the
+# request broker can plan searches without globbing the NFS directories.
+class PartitionCatalog:
+    def __init__(self, store_dir, readonly=False, timeout=30.0):
+        self.store_dir = store_dir
+        path = catalog_path(store_dir)
+        try:
+            if readonly:
+                self.conn = sqlite3.connect('file:%s?mode=ro' % path,
+                                            uri=True, timeout=timeout)
+                return
+            new = not os.path.exists(path)
+            os.makedirs(store_dir, exist_ok=True)
+            self.conn = sqlite3.connect(path, timeout=timeout)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS PARTITIONS('
+                              'PATH TEXT PRIMARY KEY, START TEXT, END TEXT, '
+                              'VERSION INTEGER, ROWS INTEGER, '
+                              'BYTES INTEGER)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS PARTITIONS_END '
+                              'ON PARTITIONS(END)')
+            self.conn.commit()
+        except sqlite3.Error as e:
+            raise StorageError('Catalog Error: %s, %s' % (path, e))
+        if new:
+            # partitions written before the catalog was created
+            self.rebuild()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.store_dir)
+
+    # The size of archive members is given, as they are not files.
+    def entry(self, path, start, end, version, rows, size=None):
+        if size is None:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+        return (self.relpath(path), minute_str(start), minute_str(end),
+                version, rows, size)
+
+    def register(self, path, start, end, version, rows):
+        self.replace([(path, start, end, version, rows)], [])
+
+    # Adds (or updates) partitions and removes others in a transaction,
+    # eg: an hourly partition and its minute partitions.
+    # added: (path, start, end, version, rows[, size])
+    def replace(self, added, removed):
+        entries = [self.entry(*partition) for partition in added]
+        try:
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO PARTITIONS '
+                                      'VALUES (?, ?, ?, ?, ?, ?)', entries)
+                self.conn.executemany('DELETE FROM PARTITIONS '
+                                      'WHERE PATH = ?',
+                                      [(self.relpath(path),)
+                                       for path in removed])
+        except sqlite3.Error as e:
+            raise StorageError('Catalog Error: %s, %s' %
+                               (catalog_path(self.store_dir), e))
+
+    def scan(self):
+        for pattern, path_format, length in PARTITION_PATTERNS:
+            for path in glob.glob(os.path.join(self.store_dir, pattern)):
+                try:
+                    start = datetime.strptime(self.relpath(path),
+                                              path_format)
+                except ValueError:
+                    continue
+                conn = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+                try:
+                    version = partition_version(conn)
+                    rows = partition_rows(conn)
+                except sqlite3.Error:
+                    # an empty or broken file
+                    continue
+                finally:
+                    conn.close()
+                yield (path, start, start + length, version, rows)
+        for path in glob.glob(os.path.join(self.store_dir,
+                                           ARCHIVE_PATTERN)):
+            try:
+                archive = ArchiveReader(path)
+            except StorageError:
+                continue
+            for member, start, end, rows, size in archive.member_list():
+                yield (member, start, end, archive.version, rows, size)
+
+    def rebuild(self):
+        partitions = list(self.scan())
+        try:
+            with self.conn:
+                self.conn.execute('DELETE FROM PARTITIONS')
+        except sqlite3.Error as e:
+            raise StorageError('Catalog Error: %s, %s' %
+                               (catalog_path(self.store_dir), e))
+        self.replace(partitions, [])
+        return len(partitions)
+
+    # Returns (path, start, end, version, (rows, bytes)) of the partitions
+    # which have rows in [start_time, end_time], ordered by time.
+    def partitions(self, start_time, end_time):
+        try:
+            rows = self.conn.execute('SELECT PATH, START, END, VERSION, '
+                                     'ROWS, BYTES FROM PARTITIONS '
+                                     'WHERE END >= ? AND START <= ? '
+                                     'ORDER BY START, END',
+                                     (minute_str(start_time),
+                                      minute_str(end_time))).fetchall()
+        except sqlite3.Error as e:
+            raise StorageError('Catalog Error: %s, %s' %
+                               (catalog_path(self.store_dir), e))
+        return [(os.path.join(self.store_dir, path),
+                 datetime.strptime(start, TIME_FORMAT),
+                 datetime.strptime(end, TIME_FORMAT), version,
+                 (rows, size))
+                for path, start, end, version, rows, size in rows]
+
+    def plan(self, start_time, end_time):
+        return catalog_plan(self.partitions(start_time, end_time),
+                            start_time, end_time)
+
+
+# Groups the partitions of the catalog like 'partition_plan' does:
+# a list of PartitionGroup lists, one list per day.
+# Partitions in the same format which are fully inside the period
+# share a group.
+def catalog_plan(partitions, start_time, end_time):
+    plan = []
+    day = None
+    for path, start, end, version, identity in partitions:
+        if start.date() != day:
+            day = start.date()
+            plan.append([])
+        groups = plan[-1]
+        compacted = start != end
+        time_range = covered_range(start, end, start_time, end_time)
+        if groups and time_range is None and \
+           groups[-1].time_range is None and groups[-1].version == version:
+            groups[-1] = groups[-1]._replace(
+                paths=groups[-1].paths + ' ' + path,
+                compacted=groups[-1].compacted or compacted,
+                identity=groups[-1].identity + (identity,))
+        else:
+            groups.append(PartitionGroup(path, compacted, time_range,
+                                         version, (identity,)))
+    return plan
+
+
+class TestCatalog(unittest.TestCase):
+
+    def test_catalog_plan(self):
+        def minute(time_str):
+            return datetime.strptime(time_str, TIME_FORMAT)
+        partitions = [
+            ('/s/2018/07/31.db', minute('2018-07-31 00:00'),
+             minute('2018-07-31 23:59'), 4, (90, 900)),
+            ('/s/2018/08/01/00.db', minute('2018-08-01 00:00'),
+             minute('2018-08-01 00:59'), 4, (60, 600)),
+            ('/s/2018/08/01/01/00.db', minute('2018-08-01 01:00'),
+             minute('2018-08-01 01:00'), 4, (1, 10)),
+            ('/s/2018/08/01/01/01.db', minute('2018-08-01 01:01'),
+             minute('2018-08-01 01:01'), 2, (2, 20)),
+            ('/s/2018/08/01/02.db', minute('2018-08-01 02:00'),
+             minute('2018-08-01 02:59'), 4, (30, 300))]
+        start = minute('2018-07-31 11:04')
+        end = minute('2018-08-01 02:44')
+        self.assertEqual([
+            [PartitionGroup('/s/2018/07/31.db', True,
+                            (start, minute('2018-07-31 23:59')), 4,
+                            ((90, 900),))],
+            [PartitionGroup('/s/2018/08/01/00.db /s/2018/08/01/01/00.db',
+                            True, None, 4, ((60, 600), (1, 10))),
+             PartitionGroup('/s/2018/08/01/01/01.db', False, None, 2,
+                            ((2, 20),)),
+             PartitionGroup('/s/2018/08/01/02.db', True,
+                            (minute('2018-08-01 02:00'), end), 4,
+                            ((30, 300),))]],
+            catalog_plan(partitions, start, end))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,15 @@ from hayabusa.errors import HayabusaError, CLIClientError
 from hayabusa.rest_client import RESTClient
 
 
+# Writes the rows of a result as they are received (without empty
+# lines, the chunks end with whole rows).
+class RowWriter:
+    def write(self, text):
+        for line in text.splitlines(keepends=True):
+            if line != '\n':
+                sys.stdout.write(line)
+
+
 class CLIClient(HayabusaBase):
     def __init__(self):
         self.args = self.parse_args()
@@ -18,13 +27,19 @@ class CLIClient(HayabusaBase):
     def parse_args(self):
         parser = argparse.ArgumentParser()
         parser.add_argument('--start-time',
-                            help='start time. eg: 2018-08-10 01:03',
+                            help='start time. eg: 2018-08-10 01:03 '
+                                 'or 2018-08-10 01:03:30',
                             required=True)
         parser.add_argument('--end-time',
                             help='end time. eg: 2018-08-10 23:59',
                             required=True)
         parser.add_argument('--match',
                             help="matching keyword. eg: noc or 'noc Login'")
+        parser.add_argument('--host', help='host name in syslog headers')
+        parser.add_argument('--program', help='program in syslog headers')
+        parser.add_argument('--severity',
+                            help='max severity (of the lines stored with '
+                                 'the syslog priority). eg: err or 3')
         parser.add_argument('--user', help='user', required=True)
         parser.add_argument('--password', help='password', required=True)
         parser.add_argument('-e', help='exact match', action='store_true')
@@ -65,6 +80,9 @@ class CLIClient(HayabusaBase):
         count = args.c
         sum = args.s
         verbose = args.v
+        filters = {k: v for k, v in [('host', args.host),
+                                     ('program', args.program),
+                                     ('severity', args.severity)] if v}
 
         stdout = ''
         stderr = ''
@@ -72,9 +90,13 @@ class CLIClient(HayabusaBase):
         data = None
         try:
             client = RESTClient(self.config, self.logger)
+            # the counts are not streamed
+            output = None if count else RowWriter()
             self.request_id, data = client.search(user, password, match,
                                                   start_time, end_time,
-                                                  count, sum, exact)
+                                                  count, sum, exact,
+                                                  filters=filters,
+                                                  output=output)
             try:
                 stdout = data['stdout']
                 stderr = data['stderr']
@@ -0,0 +1,439 @@
+import argparse
+import fcntl
+import glob
+import os
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+from hayabusa import HayabusaBase
+from hayabusa.archive import ArchiveReader, ArchiveWriter, build_hour
+from hayabusa.bloom import bloom_path, write_partition_bloom
+from hayabusa.catalog import PartitionCatalog
+from hayabusa.db_file_path import hour_partition_path, day_partition_path, \
+    archive_path
+from hayabusa.errors import HayabusaError, unexpected_error
+from hayabusa.storage import StorageFormat, COMPACTED, STRUCTURED, \
+    minute_str, partition_version
+from hayabusa.store_engine import load_store_config, load_sources, \
+    staging_path, publish_partition
+
+
+# (name, size, modification time) of a source partition
+def source_identity(path):
+    stat = os.stat(path)
+    return (os.path.basename(path), stat.st_size, stat.st_mtime_ns)
+
+
+# The sources merged into a partition (see PartitionMerger).
+def merged_sources(path):
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute('SELECT NAME, SIZE, MTIME FROM MERGED')
+        return set(rows.fetchall())
+    except sqlite3.OperationalError:
+        # made by older versions
+        return set()
+    finally:
+        conn.close()
+
+
+# A partition records the sources merged into it, so that the sources
+# left by a crash after it was published (before they were removed) are
+# not merged again.
+class PartitionMerger:
+    FETCH_ROWS = 10000
+
+    def __init__(self, path, storage_format, logger, bloom_bits=0,
+                 staging_dir=None):
+        self.path = path
+        # built on the local disk, or next to the partition
+        self.staged = bool(staging_dir)
+        if self.staged:
+            self.tmp_path = staging_path(staging_dir, path)
+        else:
+            self.tmp_path = path + '.tmp'
+        self.logger = logger
+        self.bloom_bits = bloom_bits
+        self.rows = 0
+
+        os.makedirs(os.path.dirname(self.tmp_path), exist_ok=True)
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self.conn = sqlite3.connect(self.tmp_path)
+        self.conn.execute('PRAGMA SYNCHRONOUS = OFF')
+        self.conn.execute('PRAGMA JOURNAL_MODE = MEMORY')
+        self.storage_format = storage_format.create_schema(self.conn)
+        self.conn.execute('CREATE TABLE MERGED '
+                          '(NAME TEXT, SIZE INTEGER, MTIME INTEGER)')
+
+    # Returns a query of (LOGS, MINUTE) rows and its parameters.
+    def source_query(self, version, minute):
+        if version == STRUCTURED:
+            return ('SELECT LOGS, MINUTE FROM SRC.LOG', ())
+        if version == COMPACTED:
+            return ('SELECT LOGS, MINUTE FROM SRC.SYSLOG', ())
+        return ('SELECT LOGS, ? FROM SRC.SYSLOG', (minute_str(minute),))
+
+    # 'minute' is the time of a minute partition.
+    # Compacted and structured partitions already have the MINUTE column.
+    def merge(self, src_path, minute=None):
+        identity = source_identity(src_path)
+        self.conn.execute('ATTACH DATABASE ? AS SRC', (src_path,))
+        try:
+            if src_path == self.path:
+                # the sources of the partition being rewritten
+                for row in merged_sources(src_path):
+                    self.conn.execute('INSERT INTO MERGED VALUES (?, ?, ?)',
+                                      row)
+            else:
+                self.conn.execute('INSERT INTO MERGED VALUES (?, ?, ?)',
+                                  identity)
+            version = \
+                self.conn.execute('PRAGMA SRC.USER_VERSION').fetchone()[0]
+            query, params = self.source_query(version, minute)
+            if version == STRUCTURED:
+                columns = 'MINUTE, TS, HOST, PROGRAM, SEVERITY, LOGS'
+                cur = self.conn.execute('INSERT INTO LOG(%s) '
+                                        'SELECT %s FROM SRC.LOG' %
+                                        (columns, columns))
+                self.rows += cur.rowcount
+            else:
+                # the syslog headers are parsed while copying
+                cur = self.conn.cursor()
+                cur.execute(query, params)
+                rows = cur.fetchmany(PartitionMerger.FETCH_ROWS)
+                while rows:
+                    self.rows += self.storage_format.insert(self.conn, rows)
+                    rows = cur.fetchmany(PartitionMerger.FETCH_ROWS)
+            self.conn.commit()
+        finally:
+            self.conn.execute('DETACH DATABASE SRC')
+
+    def publish(self):
+        # merge all FTS index segments into one
+        self.conn.execute("INSERT INTO SYSLOG(SYSLOG) VALUES('optimize')")
+        self.conn.commit()
+        # the new bloom filter has all the terms of the old partition,
+        # so it is published first
+        if self.bloom_bits:
+            write_partition_bloom(self.conn, self.path,
+                                  self.storage_format.tokenizer,
+                                  self.bloom_bits)
+        self.conn.close()
+        if self.staged:
+            publish_partition(self.tmp_path, self.path)
+        else:
+            os.rename(self.tmp_path, self.path)
+        self.logger.info('published %s (%s rows)', self.path, self.rows)
+
+
+class Compactor(HayabusaBase):
+    LOCK_FILE = '.compactor.lock'
+
+    def __init__(self):
+        self.args = self.parse_args()
+        super().__init__('compactor', stderr_logging=self.args.v)
+
+        store_config = load_store_config()
+        self.store_dirs = self.load_store_dirs(store_config)
+        # the store being compacted
+        self.base_dir = None
+        self.staging_dir = store_config['path'].get('staging-dir')
+        self.storage_format = \
+            StorageFormat.from_config(store_config['storage']).compacted()
+        self.bloom_bits = \
+            float(store_config['storage'].get('bloom-bits-per-term', '0'))
+        compaction = store_config['compaction']
+        self.hourly_delay = \
+            timedelta(minutes=float(compaction['hourly-delay']))
+        self.daily_delay = timedelta(hours=float(compaction['daily-delay']))
+        archive = store_config['archive'] \
+            if store_config.has_section('archive') else {}
+        self.archive_age = timedelta(days=float(archive.get('age', '0')))
+        self.archive_codec = archive.get('codec', 'xz')
+        self.retention = timedelta(days=float(archive.get('retention', '0')))
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--upgrade', action='store_true',
+                            help='rewrite hourly and daily partitions '
+                                 'made by older versions')
+        parser.add_argument('--rebuild-catalog', action='store_true',
+                            help='rebuild the partition catalog '
+                                 'from the partition files')
+        parser.add_argument('--store',
+                            help='store directory to compact '
+                                 '(default: base-dir and the stores of '
+                                 'the tenants of the sources)')
+        parser.add_argument('-v', help='verbose', action='store_true')
+        return parser.parse_args()
+
+    # base-dir, and the stores of the tenants ingested by
+    # 'store_engine.py --sources' ('store-dir/TENANT') which exist
+    def load_store_dirs(self, store_config):
+        if self.args.store:
+            return [self.args.store]
+        store_dirs = [store_config['path']['base-dir']]
+        store_dir = store_config['path'].get('store-dir')
+        if store_dir:
+            tenants = sorted(set(source.tenant for source in
+                                 load_sources(store_config)))
+            store_dirs += [os.path.join(store_dir, tenant)
+                           for tenant in tenants
+                           if os.path.isdir(os.path.join(store_dir, tenant))]
+        return store_dirs
+
+    def remove_sources(self, sources, src_dir):
+        for src in sources:
+            os.remove(src)
+            if os.path.exists(bloom_path(src)):
+                os.remove(bloom_path(src))
+        try:
+            os.rmdir(src_dir)
+        except OSError:
+            # not empty
+            pass
+
+    # start, end: the first and the last minutes of the partition
+    def merge(self, path, sources, start, end):
+        merger = PartitionMerger(path, self.storage_format, self.logger,
+                                 self.bloom_bits, self.staging_dir)
+        merged = set()
+        # partitions written after the last compaction
+        if os.path.exists(path):
+            merged = merged_sources(path)
+            merger.merge(path)
+        for src, minute in sources:
+            if source_identity(src) in merged:
+                self.logger.info('already merged into %s: %s', path, src)
+                continue
+            merger.merge(src, minute)
+        merger.publish()
+        # the sources leave the catalog before they are removed
+        self.catalog.replace([(path, start, end,
+                               merger.storage_format.version, merger.rows)],
+                             [src for src, _ in sources])
+
+    def compact_hour(self, hour, hour_dir):
+        files = sorted(glob.glob(os.path.join(hour_dir, '[0-5][0-9].db')))
+        if files:
+            sources = [(f, hour.replace(minute=int(os.path.basename(f)[:2])))
+                       for f in files]
+            self.logger.debug('compacting %s (%s partitions)',
+                              hour_dir, len(files))
+            self.merge(hour_partition_path(self.base_dir, hour), sources,
+                       hour, hour + timedelta(minutes=59))
+        self.remove_sources(files, hour_dir)
+
+    def compact_day(self, day, day_dir):
+        files = sorted(glob.glob(os.path.join(day_dir, '[0-2][0-9].db')))
+        if files:
+            self.logger.debug('compacting %s (%s partitions)',
+                              day_dir, len(files))
+            self.merge(day_partition_path(self.base_dir, day),
+                       [(f, None) for f in files], day,
+                       day + timedelta(days=1) - timedelta(minutes=1))
+        self.remove_sources(files, day_dir)
+
+    def day_dirs(self):
+        pattern = os.path.join(self.base_dir, '[0-9]' * 4,
+                               '[0-9][0-9]', '[0-9][0-9]')
+        for day_dir in sorted(glob.glob(pattern)):
+            if not os.path.isdir(day_dir):
+                continue
+            relpath = os.path.relpath(day_dir, self.base_dir)
+            yield datetime.strptime(relpath, '%Y/%m/%d'), day_dir
+
+    def hour_dirs(self, day, day_dir):
+        pattern = os.path.join(day_dir, '[0-2][0-9]')
+        for hour_dir in sorted(glob.glob(pattern)):
+            if not os.path.isdir(hour_dir):
+                continue
+            hour = day.replace(hour=int(os.path.basename(hour_dir)))
+            yield hour, hour_dir
+
+    def compact(self):
+        now = datetime.now()
+        for day, day_dir in self.day_dirs():
+            for hour, hour_dir in self.hour_dirs(day, day_dir):
+                if hour + timedelta(hours=1) + self.hourly_delay <= now:
+                    self.compact_hour(hour, hour_dir)
+            if day + timedelta(days=1) + self.daily_delay <= now:
+                if any(self.hour_dirs(day, day_dir)):
+                    continue
+                self.compact_day(day, day_dir)
+
+    # Packs a daily partition into a compressed archive of hourly
+    # members (see archive.py), then removes the partition.
+    # A day already archived has the rows of the partition if the
+    # archive was made from it (the compactor stopped before removing
+    # it), or else the partition has rows which arrived after the day
+    # was archived, and they are added to the archive.
+    def archive_day(self, day, path):
+        conn = sqlite3.connect(path)
+        try:
+            version = partition_version(conn)
+        finally:
+            conn.close()
+        if version != STRUCTURED:
+            self.logger.info('not archived (run --upgrade first): %s', path)
+            return
+        archive = archive_path(self.base_dir, day)
+        source = source_identity(path)
+        old = ArchiveReader(archive) if os.path.exists(archive) else None
+        if old and old.source == source:
+            self.logger.info('already archived: %s', path)
+            self.remove_archived(path, archive)
+            return
+        if self.staging_dir:
+            tmp_path = staging_path(self.staging_dir, archive)
+        else:
+            tmp_path = archive + '.tmp'
+        os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+        with tempfile.TemporaryDirectory(
+                dir=os.path.dirname(tmp_path)) as tmp_dir:
+            writer = ArchiveWriter(tmp_path, self.archive_codec, source)
+            for h in range(24):
+                hour = day.replace(hour=h)
+                hour_path = os.path.join(tmp_dir, '%02d.db' % h)
+                # the rows archived before are copied with the new rows
+                old_rows = 0
+                if old and old.extract('%02d' % h, hour_path):
+                    old_rows = old.members['%02d' % h]['rows']
+                rows, bloom = build_hour(path, hour, self.storage_format,
+                                         hour_path, self.bloom_bits)
+                if rows:
+                    writer.add(hour, hour_path, old_rows + rows, bloom)
+                elif old_rows:
+                    writer.add(hour, hour_path, old_rows,
+                               old.bloom('%02d' % h))
+                os.remove(hour_path)
+            writer.close()
+        if self.staging_dir:
+            publish_partition(tmp_path, archive)
+        else:
+            os.rename(tmp_path, archive)
+        self.remove_archived(path, archive)
+
+    # Replaces the daily partition with the members of its archive.
+    def remove_archived(self, path, archive):
+        members = ArchiveReader(archive).member_list()
+        self.catalog.replace([(member, start, end, STRUCTURED, rows, size)
+                              for member, start, end, rows, size in members],
+                             [path])
+        self.remove_sources([path], os.path.dirname(path))
+        self.logger.info('archived %s into %s (%s hours, %s bytes)',
+                         path, archive, len(members),
+                         os.path.getsize(archive))
+
+    def archive_days(self):
+        pattern = os.path.join(self.base_dir, '[0-9]' * 4, '[0-9][0-9]',
+                               '[0-9][0-9].db')
+        now = datetime.now()
+        for path in sorted(glob.glob(pattern)):
+            relpath = os.path.relpath(path, self.base_dir)
+            day = datetime.strptime(relpath, '%Y/%m/%d.db')
+            if day + timedelta(days=1) + self.archive_age > now:
+                continue
+            self.archive_day(day, path)
+
+    # Removes the daily partitions and the archives of the days
+    # older than the retention period.
+    def expire(self):
+        now = datetime.now()
+        pattern = os.path.join(self.base_dir, '[0-9]' * 4, '[0-9][0-9]',
+                               '[0-9][0-9].*')
+        for path in sorted(glob.glob(pattern)):
+            relpath = os.path.relpath(path, self.base_dir)
+            name, ext = os.path.splitext(relpath)
+            if ext not in ('.db', '.archive'):
+                continue
+            day = datetime.strptime(name, '%Y/%m/%d')
+            if day + timedelta(days=1) + self.retention > now:
+                continue
+            if ext == '.archive':
+                removed = [member for member, _, _, _, _ in
+                           ArchiveReader(path).member_list()]
+            else:
+                removed = [path]
+            self.catalog.replace([], removed)
+            self.remove_sources([path], os.path.dirname(path))
+            self.logger.info('expired %s', path)
+
+    def upgrade(self):
+        day_pattern = os.path.join(self.base_dir, '[0-9]' * 4,
+                                   '[0-9][0-9]', '[0-9][0-9].db')
+        hour_pattern = os.path.join(self.base_dir, '[0-9]' * 4,
+                                    '[0-9][0-9]', '[0-9][0-9]',
+                                    '[0-2][0-9].db')
+        for path in sorted(glob.glob(day_pattern) + glob.glob(hour_pattern)):
+            conn = sqlite3.connect(path)
+            try:
+                version = partition_version(conn)
+            finally:
+                conn.close()
+            if version == COMPACTED:
+                self.logger.info('upgrading %s', path)
+                relpath = os.path.relpath(path, self.base_dir)
+                if relpath.count('/') == 3:
+                    start = datetime.strptime(relpath, '%Y/%m/%d/%H.db')
+                    end = start + timedelta(minutes=59)
+                else:
+                    start = datetime.strptime(relpath, '%Y/%m/%d.db')
+                    end = start + timedelta(days=1) - timedelta(minutes=1)
+                self.merge(path, [], start, end)
+
+    # The other stores are compacted after an error in a store.
+    def main(self):
+        errors = []
+        for store_dir in self.store_dirs:
+            self.base_dir = store_dir
+            try:
+                self.compact_store()
+            except HayabusaError as e:
+                self.logger.error('%s: %s: %s', store_dir,
+                                  e.__class__.__name__, e)
+                errors.append(store_dir)
+        if errors:
+            raise HayabusaError('Compaction Error: %s' % ', '.join(errors))
+
+    def compact_store(self):
+        lock_path = os.path.join(self.base_dir, Compactor.LOCK_FILE)
+        with open(lock_path, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.logger.info('another compactor is running: %s',
+                                 self.base_dir)
+                return
+            self.catalog = PartitionCatalog(self.base_dir)
+            try:
+                if self.args.rebuild_catalog:
+                    partitions = self.catalog.rebuild()
+                    self.logger.info('rebuilt the partition catalog: '
+                                     '%s partitions', partitions)
+                if self.args.upgrade:
+                    self.upgrade()
+                self.compact()
+                if self.archive_age:
+                    self.archive_days()
+                if self.retention:
+                    self.expire()
+            finally:
+                self.catalog.close()
+
+    def exec(self):
+        try:
+            self.main()
+        except KeyboardInterrupt:
+            sys.stderr.write('Interrupted\n')
+            exit(1)
+        except HayabusaError as e:
+            self.logger.error('%s: %s', e.__class__.__name__, e)
+            sys.stderr.write('%s: %s\n' % (e.__class__.__name__, e))
+            exit(1)
+        except Exception as e:
+            unexpected_error(self.logger, 'Compactor', e)
+            raise
@@ -1,6 +1,12 @@
 from enum import Enum, auto
 
 
+# The ports of the request broker process N are
+# 'command + N * BROKER_PORT_STRIDE', 'result + N * BROKER_PORT_STRIDE'
+# and 'cancel + N * BROKER_PORT_STRIDE'.
+BROKER_PORT_STRIDE = 10
+
+
 class Status(Enum):
     # Prefix
     # C: Client, R: RequestBroker, W: Worker
@@ -32,6 +38,7 @@ class Status(Enum):
     # RequestBroker -> Client
     RC_RequestError = auto()
     RC_TimeoutError = auto()
+    RC_CancelledRequest = auto()
 
     def __str__(self):
         return self.name
@@ -39,4 +46,5 @@ class Status(Enum):
 
 CompletedStatus = [Status.RC_SentResult,
                    Status.RC_TimeoutError,
-                   Status.RC_RequestError]
+                   Status.RC_RequestError,
+                   Status.RC_CancelledRequest]
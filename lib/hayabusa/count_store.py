@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from hayabusa.errors import HayabusaError
+
+
+# The key of the count of a partition: the number of lines matching
+# the same search in the same partition (path and identity from the
+# partition catalog) never changes.
+# Matches are normalized, so that 'noc  root' and ' noc root' share counts.
+def count_key(user, match, exact, filters, version, path, identity):
+    match = ' '.join(match.split()) if match else ''
+    filters = sorted((key, str(value))
+                     for key, value in (filters or {}).items())
+    data = json.dumps([user, match, bool(exact), filters, version, path,
+                       identity])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+# Counts of partitions, persistent across restarts of the request broker,
+# so that counts over long time periods only search the partitions
+# which have not been counted yet.
+# The counts of replaced and removed partitions are never used again:
+# the counts which were not used for a while are pruned.
+class CountStore:
+    # SQLite variables in a statement
+    BATCH = 500
+    # second, the last use of a count is updated at most at the interval
+    USE_INTERVAL = 24 * 60 * 60
+
+    def __init__(self, path, timeout=30.0, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.conn = sqlite3.connect(path, timeout=timeout,
+                                        check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode = WAL')
+            self.conn.execute('PRAGMA synchronous = NORMAL')
+            with self.conn:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS COUNTS('
+                                  'KEY TEXT PRIMARY KEY, COUNT INTEGER, '
+                                  'USED INTEGER)')
+                columns = [row[1] for row in
+                           self.conn.execute('PRAGMA TABLE_INFO(COUNTS)')]
+                if 'USED' not in columns:
+                    # made by older versions (pruned first)
+                    self.conn.execute('ALTER TABLE COUNTS '
+                                      'ADD COLUMN USED INTEGER DEFAULT 0')
+                self.conn.execute('CREATE INDEX IF NOT EXISTS COUNTS_USED '
+                                  'ON COUNTS(USED)')
+        except (OSError, sqlite3.Error) as e:
+            raise HayabusaError('Count Store Error: %s, %s' % (path, e))
+
+    def close(self):
+        self.conn.close()
+
+    # Returns {key: count} of the keys in the store.
+    def get_many(self, keys):
+        counts = {}
+        keys = list(keys)
+        now = int(self.clock())
+        try:
+            with self.lock, self.conn:
+                for i in range(0, len(keys), CountStore.BATCH):
+                    batch = keys[i:i + CountStore.BATCH]
+                    variables = ', '.join('?' * len(batch))
+                    counts.update(self.conn.execute(
+                        'SELECT KEY, COUNT FROM COUNTS '
+                        'WHERE KEY IN (%s)' % variables, batch))
+                    self.conn.execute('UPDATE COUNTS SET USED = ? '
+                                      'WHERE USED < ? AND KEY IN (%s)' %
+                                      variables,
+                                      [now, now - CountStore.USE_INTERVAL] +
+                                      batch)
+        except sqlite3.Error as e:
+            raise HayabusaError('Count Store Error: %s, %s' % (self.path, e))
+        return counts
+
+    # items: (key, count) pairs
+    def put_many(self, items):
+        now = int(self.clock())
+        try:
+            with self.lock, self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO COUNTS '
+                                      'VALUES (?, ?, ?)',
+                                      [(key, count, now)
+                                       for key, count in items])
+        except sqlite3.Error as e:
+            raise HayabusaError('Count Store Error: %s, %s' % (self.path, e))
+
+    # Removes the counts which were not used in 'lifetime' seconds.
+    # Returns the number of the removed counts.
+    def prune(self, lifetime):
+        try:
+            with self.lock, self.conn:
+                cur = self.conn.execute('DELETE FROM COUNTS WHERE USED < ?',
+                                        (int(self.clock() - lifetime),))
+        except sqlite3.Error as e:
+            raise HayabusaError('Count Store Error: %s, %s' % (self.path, e))
+        return cur.rowcount
+
+
+class TestCountStore(unittest.TestCase):
+
+    def test_count_key(self):
+        key = count_key('user', ' noc  root', False, {}, 4,
+                        '/s/2018/08/01/00/00.db', [1, 10])
+        self.assertEqual(key, count_key('user', 'noc root', False, None, 4,
+                                        '/s/2018/08/01/00/00.db', [1, 10]))
+        self.assertNotEqual(key, count_key('user', 'noc root', True, {}, 4,
+                                           '/s/2018/08/01/00/00.db',
+                                           [1, 10]))
+        self.assertNotEqual(key, count_key('user', 'noc root', False,
+                                           {'host': 'host1'}, 4,
+                                           '/s/2018/08/01/00/00.db',
+                                           [1, 10]))
+
+    def test_count_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = CountStore(os.path.join(tmp_dir, 'counts.db'))
+            store.put_many([('a', 1), ('b', 0)])
+            self.assertEqual({'a': 1, 'b': 0},
+                             store.get_many(['a', 'b', 'c']))
+            store.close()
+
+    def test_prune(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'counts.db')
+            # a count store made by older versions
+            conn = sqlite3.connect(path)
+            with conn:
+                conn.execute('CREATE TABLE COUNTS('
+                             'KEY TEXT PRIMARY KEY, COUNT INTEGER)')
+                conn.execute("INSERT INTO COUNTS VALUES ('old', 1)")
+            conn.close()
+            now = [10 * 24 * 60 * 60]
+            store = CountStore(path, clock=lambda: now[0])
+            store.put_many([('a', 1), ('b', 2)])
+            now[0] += 3 * 24 * 60 * 60
+            # used counts are kept
+            self.assertEqual({'a': 1}, store.get_many(['a']))
+            now[0] += 24 * 60 * 60
+            self.assertEqual(2, store.prune(2 * 24 * 60 * 60))
+            self.assertEqual({'a': 1}, store.get_many(['a', 'b', 'old']))
+            store.close()
+
+    def test_error(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'file')
+            with open(path, 'w'):
+                pass
+            with self.assertRaises(HayabusaError):
+                CountStore(os.path.join(path, 'counts.db'))
+
+
+if __name__ == '__main__':
+    unittest.main()
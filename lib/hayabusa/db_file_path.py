@@ -1,5 +1,8 @@
+import glob
 import os
+import re
 import unittest
+from collections import namedtuple
 from datetime import datetime, timedelta
 
 from hayabusa.errors import HayabusaError
@@ -47,10 +50,30 @@ def generate_path(hour, minute):
     return os.path.join(hour_path, minute_path)
 
 
-def db_file_path(store_dir, start_time, end_time):
-    start_date = datetime(start_time.year, start_time.month, start_time.day)
-    end_date = datetime(end_time.year, end_time.month, end_time.day)
+def partition_path(store_dir, time):
+    dir_path = time.strftime('%Y/%m/%d/%H')
+    db_file = '%02d.db' % time.minute
+    return os.path.join(store_dir, dir_path, db_file)
+
+
+def hour_partition_path(store_dir, time):
+    return os.path.join(store_dir, time.strftime('%Y/%m/%d/%H') + '.db')
+
+
+def day_partition_path(store_dir, time):
+    return os.path.join(store_dir, time.strftime('%Y/%m/%d') + '.db')
 
+
+# A cold-tier archive of a day (see archive.py) and its hourly members
+def archive_path(store_dir, time):
+    return os.path.join(store_dir, time.strftime('%Y/%m/%d') + '.archive')
+
+
+def archive_member_path(path, time):
+    return '%s#%02d' % (path, time.hour)
+
+
+def check_time_period(start_time, end_time):
     errors = []
     now = datetime.now()
     if start_time > now:
@@ -63,6 +86,13 @@ def db_file_path(store_dir, start_time, end_time):
     if errors:
         raise HayabusaError(', '.join(errors))
 
+
+def db_file_path(store_dir, start_time, end_time):
+    start_date = datetime(start_time.year, start_time.month, start_time.day)
+    end_date = datetime(end_time.year, end_time.month, end_time.day)
+
+    check_time_period(start_time, end_time)
+
     start_time_dir = os.path.join(store_dir, start_time.strftime('%Y/%m/%d'))
 
     # the exact same time (one minute)
@@ -175,6 +205,255 @@ def db_file_path(store_dir, start_time, end_time):
     return res_paths
 
 
+# A group of partitions queried by one command.
+# paths: space separated paths (and globs) of the partitions
+# compacted: True for hourly/daily partitions (with the MINUTE column)
+# time_range: (start, end) minutes to filter rows by,
+#             or None to read whole partitions
+# version: the storage format version of the partitions if known
+#          (from the partition catalog)
+# identity: (rows, bytes) of each partition if known (from the partition
+#           catalog), which change when a partition is rewritten
+PartitionGroup = namedtuple('PartitionGroup',
+                            ['paths', 'compacted', 'time_range', 'version',
+                             'identity'],
+                            defaults=[None, None])
+
+
+def covered_range(start, end, range_start, range_end):
+    if range_start <= start and end <= range_end:
+        return None
+    return (max(start, range_start), min(end, range_end))
+
+
+def partition_groups(items):
+    groups = []
+    for compacted, path, time_range in items:
+        if groups and time_range is None and \
+           groups[-1].time_range is None and \
+           groups[-1].compacted == compacted:
+            paths = groups[-1].paths + ' ' + path
+            groups[-1] = PartitionGroup(paths, compacted, None)
+        else:
+            groups.append(PartitionGroup(path, compacted, time_range))
+    return groups
+
+
+# Splits the weights (in order) into 'pieces' consecutive slices
+# ((start, end) indexes) of about the same total weight.
+def balanced_slices(weights, pieces):
+    pieces = max(1, min(pieces, len(weights)))
+    slices = []
+    start = 0
+    remaining = sum(weights)
+    for piece in range(pieces, 1, -1):
+        target = remaining / piece
+        end = start + 1
+        weight = weights[start]
+        # each of the next pieces needs a weight
+        while end < len(weights) - (piece - 1) and \
+                weight + weights[end] / 2 <= target:
+            weight += weights[end]
+            end += 1
+        slices.append((start, end))
+        remaining -= weight
+        start = end
+    slices.append((start, len(weights)))
+    return slices
+
+
+# The partitions of a PartitionGroup and their weights: the bytes of the
+# partitions in the partition catalog, or 1 for each path of the group
+# (the brace expansions and globs of stores without the catalog are
+# expanded by the workers, not on NFS by the request broker).
+def group_partitions(group):
+    paths = group.paths.split()
+    if group.identity is not None:
+        return paths, [max(1, identity[1]) for identity in group.identity]
+    return paths, [1] * len(paths)
+
+
+# eg: YYYY/MM/DD.db, YYYY/MM/DD/HH.db, YYYY/MM/DD/HH/MM.db
+PERIOD_RE = re.compile(r'(\d{4})/(\d{2})/(\d{2})(?:/(\d{2}))?(?:/(\d{2}))?'
+                       r'\.db$')
+
+
+# The first and the last minutes of a partition file, or None (globs and
+# archive members).
+def partition_period(path):
+    m = PERIOD_RE.search(path)
+    if not m:
+        return None
+    fields = [int(field) for field in m.groups() if field is not None]
+    start = datetime(*fields)
+    if len(fields) == 3:
+        return (start, start + timedelta(days=1) - timedelta(minutes=1))
+    if len(fields) == 4:
+        return (start, start + timedelta(minutes=59))
+    return (start, start)
+
+
+# Splits the period (first and last minutes) into at most 'pieces'
+# consecutive periods of about the same number of minutes.
+def split_period(period, pieces):
+    start, end = period
+    minutes = int((end - start).total_seconds() // 60) + 1
+    pieces = max(1, min(pieces, minutes))
+    return [(start + timedelta(minutes=minutes * i // pieces),
+             start + timedelta(minutes=minutes * (i + 1) // pieces - 1))
+            for i in range(pieces)]
+
+
+# Splits the groups into about 'shards' groups of about the same weight
+# (bytes or number of partitions), so that the commands keep all the
+# workers busy.
+# Each group gets shards in proportion to its weight, and is split into
+# consecutive partitions, so the shards keep the order of the groups.
+# A group with fewer partitions than its shards (eg: a daily partition)
+# is split into the MINUTE periods of its compacted partitions.
+# Returns a list of (group, (start, end)) pairs for each group: the
+# slices of the partitions of the group, or None if it was not split.
+def shard_groups(groups, shards):
+    partitions = [group_partitions(group) for group in groups]
+    total = sum(sum(weights) for _, weights in partitions)
+    res = []
+    for group, (paths, weights) in zip(groups, partitions):
+        pieces = round(shards * sum(weights) / total) if total else 1
+        if pieces <= 1:
+            res.append([(group, None)])
+            continue
+        if len(paths) < pieces:
+            group_shards = period_shards(group, paths, weights, pieces)
+        else:
+            group_shards = []
+            for start, end in balanced_slices(weights, pieces):
+                identity = group.identity
+                if identity is not None:
+                    identity = tuple(identity[start:end])
+                group_shards.append((group._replace(
+                    paths=' '.join(paths[start:end]), identity=identity),
+                    (start, end)))
+        if len(group_shards) <= 1:
+            group_shards = [(group, None)]
+        res.append(group_shards)
+    return res
+
+
+# Shards of a group for each partition, and the partitions with the
+# MINUTE column split into periods (time_range) by their weights.
+def period_shards(group, paths, weights, pieces):
+    group_shards = []
+    for i, (path, weight) in enumerate(zip(paths, weights)):
+        identity = group.identity
+        if identity is not None:
+            identity = (identity[i],)
+        shard = group._replace(paths=path, identity=identity)
+        period = group.time_range or partition_period(path)
+        path_pieces = round(pieces * weight / sum(weights))
+        if period is None or period[0] == period[1] or path_pieces <= 1:
+            group_shards.append((shard, (i, i + 1)))
+            continue
+        for time_range in split_period(period, path_pieces):
+            group_shards.append((shard._replace(compacted=True,
+                                                time_range=time_range),
+                                 (i, i + 1)))
+    return group_shards
+
+
+# Picks the coarsest partitions covering the time period:
+# the hourly members of an archive (YYYY/MM/DD.archive#HH) if the day
+# was archived, a daily partition (YYYY/MM/DD.db) if it was compacted,
+# hourly partitions (YYYY/MM/DD/HH.db) if the hour was compacted,
+# and minute partitions (YYYY/MM/DD/HH/MM.db) otherwise.
+# Compacted partitions only partly inside the period get a time_range.
+# Returns a list of PartitionGroup lists, one list per day.
+def partition_plan(store_dir, start_time, end_time, exists=os.path.exists):
+    check_time_period(start_time, end_time)
+
+    one_hour = timedelta(hours=1)
+    last_minute = timedelta(minutes=59)
+    last_day_minute = timedelta(days=1) - timedelta(minutes=1)
+    day = datetime(start_time.year, start_time.month, start_time.day)
+    plan = []
+    while day <= end_time:
+        day_start = max(start_time, day)
+        day_end = min(end_time, day + last_day_minute)
+        items = []
+        day_path = day_partition_path(store_dir, day)
+        day_archive_path = archive_path(store_dir, day)
+        if exists(day_path):
+            time_range = covered_range(day, day + last_day_minute,
+                                       day_start, day_end)
+            items.append((True, day_path, time_range))
+        elif exists(day_archive_path):
+            # the hourly members of an archived day
+            hour = day_start.replace(minute=0)
+            while hour <= day_end:
+                time_range = covered_range(hour, hour + last_minute,
+                                           max(day_start, hour),
+                                           min(day_end, hour + last_minute))
+                items.append((True, archive_member_path(day_archive_path,
+                                                        hour), time_range))
+                hour += one_hour
+        else:
+            minutes = None
+            hour = day_start.replace(minute=0)
+            while hour <= day_end:
+                hour_start = max(day_start, hour)
+                hour_end = min(day_end, hour + last_minute)
+                hour_path = hour_partition_path(store_dir, hour)
+                if exists(hour_path):
+                    if minutes:
+                        path = db_file_path(store_dir, *minutes)[0]
+                        items.append((False, path, None))
+                        minutes = None
+                    time_range = covered_range(hour, hour + last_minute,
+                                               hour_start, hour_end)
+                    items.append((True, hour_path, time_range))
+                elif minutes:
+                    minutes = (minutes[0], hour_end)
+                else:
+                    minutes = (hour_start, hour_end)
+                hour += one_hour
+            if minutes:
+                path = db_file_path(store_dir, *minutes)[0]
+                items.append((False, path, None))
+        plan.append(partition_groups(items))
+        day += timedelta(days=1)
+    return plan
+
+
+BRACE_RE = re.compile(r'\{(\d+)\.\.(\d+)\}')
+GLOB_RE = re.compile(r'[*?\[]')
+
+
+def expand_braces(pattern):
+    m = BRACE_RE.search(pattern)
+    if not m:
+        return [pattern]
+    first, last = m.groups()
+    patterns = []
+    for i in range(int(first), int(last) + 1):
+        expanded = pattern[:m.start()] + '%0*d' % (len(first), i) + \
+            pattern[m.end():]
+        patterns += expand_braces(expanded)
+    return patterns
+
+
+# Expands the paths of a PartitionGroup (brace expansions and globs,
+# as bash does) into the partition files which exist.
+# Plain paths (eg: from the partition catalog) are not checked.
+def expand_paths(paths):
+    files = []
+    for path in paths.split():
+        if not BRACE_RE.search(path) and not GLOB_RE.search(path):
+            files.append(path)
+            continue
+        for pattern in expand_braces(path):
+            files += sorted(glob.glob(pattern))
+    return files
+
+
 def parse_time(time_str, end=False):
     try:
         date = datetime.strptime(time_str, '%Y-%m-%d')
@@ -183,10 +462,17 @@ def parse_time(time_str, end=False):
         else:
             time = datetime(date.year, date.month, date.day, 0, 0)
     except ValueError:
-        time = datetime.strptime(time_str, '%Y-%m-%d %H:%M')
+        try:
+            time = datetime.strptime(time_str, '%Y-%m-%d %H:%M')
+        except ValueError:
+            time = datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S')
     return time
 
 
+def has_seconds(time_str):
+    return time_str.count(':') == 2
+
+
 def parse_start_time(time_str):
     return parse_time(time_str, end=False)
 
@@ -200,6 +486,10 @@ class TestDBPath(unittest.TestCase):
     def setUp(self):
         self.dir = '/efs/store/auth'
 
+    def test_partition_path(self):
+        res = partition_path(self.dir, datetime(2018, 8, 1, 3, 5, 42))
+        self.assertEqual('/efs/store/auth/2018/08/01/03/05.db', res)
+
     def test_db_file_path_the_same_time(self):
         res = db_file_path(self.dir, parse_start_time('2018-08-01 3:05'),
                            parse_end_time('2018-08-01 3:05'))
@@ -384,6 +674,108 @@ class TestDBPath(unittest.TestCase):
                           '/efs/store/auth/2018/08/01/*/*.db',
                           '/efs/store/auth/2018/08/02/*/*.db'], res)
 
+    def test_partition_plan_without_compacted_partitions(self):
+        start = parse_start_time('2018-07-31 11:04')
+        end = parse_end_time('2018-08-01 05:44')
+        res = partition_plan(self.dir, start, end, exists=lambda p: False)
+        paths = [[group.paths for group in groups] for groups in res]
+        self.assertEqual([[p] for p in db_file_path(self.dir, start, end)],
+                         paths)
+
+    def test_partition_plan_compacted_partitions(self):
+        compacted = {'/efs/store/auth/2018/07/31.db',
+                     '/efs/store/auth/2018/08/01/00.db',
+                     '/efs/store/auth/2018/08/01/01.db',
+                     '/efs/store/auth/2018/08/01/04.db'}
+        res = partition_plan(self.dir, parse_start_time('2018-07-31 11:04'),
+                             parse_end_time('2018-08-01 04:44'),
+                             exists=lambda p: p in compacted)
+        self.assertEqual([
+            [PartitionGroup('/efs/store/auth/2018/07/31.db', True,
+                            (datetime(2018, 7, 31, 11, 4),
+                             datetime(2018, 7, 31, 23, 59)))],
+            [PartitionGroup('/efs/store/auth/2018/08/01/00.db '
+                            '/efs/store/auth/2018/08/01/01.db', True, None),
+             PartitionGroup('/efs/store/auth/2018/08/01/{02..03}/*.db',
+                            False, None),
+             PartitionGroup('/efs/store/auth/2018/08/01/04.db', True,
+                            (datetime(2018, 8, 1, 4, 0),
+                             datetime(2018, 8, 1, 4, 44)))]], res)
+
+    def test_balanced_slices(self):
+        self.assertEqual([(0, 2), (2, 4)], balanced_slices([1] * 4, 2))
+        self.assertEqual([(0, 1), (1, 4)], balanced_slices([9, 1, 1, 1], 2))
+        self.assertEqual([(0, 1), (1, 2), (2, 3)],
+                         balanced_slices([1, 1, 1], 5))
+        self.assertEqual([(0, 2)], balanced_slices([1, 1], 1))
+
+    def test_shard_groups(self):
+        day = PartitionGroup('/s/2018/08/01.db', True, None, 4, ((10, 600),))
+        hours = PartitionGroup('/s/2018/08/02/00.db /s/2018/08/02/01.db '
+                               '/s/2018/08/02/02.db /s/2018/08/02/03.db',
+                               True, None, 4,
+                               ((1, 100), (1, 100), (1, 300), (1, 100)))
+        res = shard_groups([day, hours], 4)
+        self.assertEqual([
+            [(day._replace(time_range=(datetime(2018, 8, 1, 0, 0),
+                                       datetime(2018, 8, 1, 11, 59))),
+              (0, 1)),
+             (day._replace(time_range=(datetime(2018, 8, 1, 12, 0),
+                                       datetime(2018, 8, 1, 23, 59))),
+              (0, 1))],
+            [(PartitionGroup('/s/2018/08/02/00.db /s/2018/08/02/01.db',
+                             True, None, 4, ((1, 100), (1, 100))), (0, 2)),
+             (PartitionGroup('/s/2018/08/02/02.db /s/2018/08/02/03.db',
+                             True, None, 4, ((1, 300), (1, 100))), (2, 4))]],
+            res)
+        # a daily partition split into periods
+        res = shard_groups([day], 3)
+        self.assertEqual([[
+            (day._replace(time_range=(datetime(2018, 8, 1, 0, 0),
+                                      datetime(2018, 8, 1, 7, 59))),
+             (0, 1)),
+            (day._replace(time_range=(datetime(2018, 8, 1, 8, 0),
+                                      datetime(2018, 8, 1, 15, 59))),
+             (0, 1)),
+            (day._replace(time_range=(datetime(2018, 8, 1, 16, 0),
+                                      datetime(2018, 8, 1, 23, 59))),
+             (0, 1))]], res)
+        # a part of an hourly partition, and minute partitions
+        hour = PartitionGroup('/s/2018/08/02/00.db', True,
+                              (datetime(2018, 8, 2, 0, 30),
+                               datetime(2018, 8, 2, 0, 59)), 4, ((1, 100),))
+        self.assertEqual([(datetime(2018, 8, 2, 0, 30),
+                           datetime(2018, 8, 2, 0, 44)),
+                          (datetime(2018, 8, 2, 0, 45),
+                           datetime(2018, 8, 2, 0, 59))],
+                         [group.time_range for group, _ in
+                          shard_groups([hour], 2)[0]])
+        minute = PartitionGroup('/s/2018/08/02/01/00.db', False, None, 4,
+                                ((1, 100),))
+        self.assertEqual([[(minute, None)]], shard_groups([minute], 4))
+        # globs of stores without the catalog are not expanded
+        minutes = PartitionGroup('/s/2018/08/02/{00..01}/*.db', False, None)
+        self.assertEqual([[(minutes, None)]], shard_groups([minutes], 4))
+
+    def test_partition_period(self):
+        self.assertEqual((datetime(2018, 8, 1, 0, 0),
+                          datetime(2018, 8, 1, 23, 59)),
+                         partition_period('/s/2018/08/01.db'))
+        self.assertEqual((datetime(2018, 8, 1, 3, 0),
+                          datetime(2018, 8, 1, 3, 59)),
+                         partition_period('/s/2018/08/01/03.db'))
+        self.assertEqual((datetime(2018, 8, 1, 3, 5),
+                          datetime(2018, 8, 1, 3, 5)),
+                         partition_period('/s/2018/08/01/03/05.db'))
+        self.assertIsNone(partition_period('/s/2018/08/01.archive#03'))
+        self.assertIsNone(partition_period('/s/2018/08/01/*/*.db'))
+
+    def test_expand_braces(self):
+        self.assertEqual(['/s/01/05.db'], expand_braces('/s/01/05.db'))
+        self.assertEqual(['/s/01/08.db', '/s/01/09.db',
+                          '/s/02/08.db', '/s/02/09.db'],
+                         expand_braces('/s/{01..02}/{08..09}.db'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -36,6 +36,14 @@ class MonitorError(HayabusaError):
     pass
 
 
+class StoreEngineError(HayabusaError):
+    pass
+
+
+class StorageError(HayabusaError):
+    pass
+
+
 def unexpected_error(logger, label, e, log_message=None):
     e_type, e_value, e_traceback = sys.exc_info()
     lines = ['\n']
@@ -0,0 +1,76 @@
+import bisect
+import hashlib
+import unittest
+from collections import Counter
+
+
+# Consistent hashing of partition paths to worker hosts, so that the
+# commands on a partition go to the same host (warm page cache and NFS
+# fscache), and only the partitions of a host move when it is added or
+# removed. Each host has 'points' points on the ring to even out the
+# partitions.
+class HashRing:
+    def __init__(self, hosts, points=100):
+        ring = sorted((self.hash('%s#%d' % (host, i)), host)
+                      for host in hosts for i in range(points))
+        self.keys = [key for key, _ in ring]
+        self.hosts = [host for _, host in ring]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def host(self, path):
+        if not self.keys:
+            return None
+        i = bisect.bisect(self.keys, self.hash(path)) % len(self.keys)
+        return self.hosts[i]
+
+    # The host of most of the paths (ties: the host of the first path).
+    def preferred_host(self, paths):
+        if not self.keys or not paths:
+            return None
+        return Counter(self.host(path) for path in paths).most_common(1)[0][0]
+
+    # The preferred host of a command message to the workers (its paths
+    # are separated by spaces).
+    def command_host(self, command):
+        return self.preferred_host(command['paths'].split())
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_hash_ring(self):
+        paths = ['/s/2018/08/01/%02d/%02d.db' % (h, m)
+                 for h in range(24) for m in range(60)]
+        self.assertIsNone(HashRing([]).host(paths[0]))
+        ring = HashRing(['host1', 'host2', 'host3'])
+        hosts = dict((path, ring.host(path)) for path in paths)
+        counts = Counter(hosts.values())
+        self.assertEqual(3, len(counts))
+        self.assertTrue(min(counts.values()) > len(paths) / 3 * 0.7)
+        # only the paths of the new host move
+        ring4 = HashRing(['host1', 'host2', 'host3', 'host4'])
+        for path in paths:
+            new_host = ring4.host(path)
+            self.assertIn(new_host, (hosts[path], 'host4'))
+        self.assertEqual(hosts[paths[0]], ring.preferred_host(paths[:1]))
+        self.assertEqual('host1', HashRing(['host1']).preferred_host(paths))
+
+    def test_command_host(self):
+        ring = HashRing(['host1', 'host2', 'host3'])
+        commands = [{'id': 'request', 'index': h, 'commands': 24,
+                     'paths': ' '.join('/s/2018/08/01/%02d/%02d.db' % (h, m)
+                                       for m in range(60)),
+                     'sql': 'select count(*) from logs;', 'count': True,
+                     'sum': True, 'phrases': [], 'immutable': True}
+                    for h in range(24)]
+        hosts = [ring.command_host(command) for command in commands]
+        # the hours are spread over the hosts
+        self.assertEqual(3, len(set(hosts)))
+        paths = commands[0]['paths'].split()
+        self.assertEqual(ring.preferred_host(paths), hosts[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import re
+import unittest
+from datetime import datetime
+
+
+SEVERITIES = ['emerg', 'alert', 'crit', 'err',
+              'warning', 'notice', 'info', 'debug']
+
+TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+MONTHS = {name: i + 1 for i, name in
+          enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])}
+
+# eg: <34>Aug  1 03:05:01 host1 sshd[123]: message (RFC 3164)
+BSD_RE = re.compile(r'^(?:<(\d{1,3})>)?'
+                    r'([A-Z][a-z]{2}) {1,2}(\d{1,2}) '
+                    r'(\d{2}:\d{2}:\d{2}) '
+                    r'(\S+) ([^\s\[:]+)')
+
+# eg: <34>1 2018-08-01T03:05:01.003+09:00 host1 sshd 123 - - message
+#     (RFC 5424 or rsyslog high precision timestamps)
+ISO_RE = re.compile(r'^(?:<(\d{1,3})>)?(?:1 )?'
+                    r'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.\d+)?'
+                    r'(Z|[+-]\d{2}:?\d{2})? '
+                    r'(\S+) ([^\s\[:]+)')
+
+
+def parse_severity(value):
+    if type(value) == int or (type(value) == str and value.isdigit()):
+        severity = int(value)
+        if 0 <= severity < len(SEVERITIES):
+            return severity
+    elif type(value) == str and value.lower() in SEVERITIES:
+        return SEVERITIES.index(value.lower())
+    raise ValueError('Invalid Severity: %s (%s or 0-7)' %
+                     (value, ', '.join(SEVERITIES)))
+
+
+def severity_from_priority(priority):
+    if priority is None:
+        return None
+    return int(priority) % 8
+
+
+# Parses the syslog header of a line.
+# 'year' and 'month' are the time the line was received,
+# because RFC 3164 timestamps do not have the year.
+# Returns (timestamp, host, program, severity),
+# the items not found in the line are None.
+def parse_line(line, year, month):
+    m = BSD_RE.match(line)
+    if m:
+        priority, month_name, day, time, host, program = m.groups()
+        line_month = MONTHS.get(month_name)
+        if line_month is None:
+            return (None, None, None, None)
+        # a line of December received in January
+        line_year = year - 1 if line_month > month else year
+        ts = '%04d-%02d-%02d %s' % (line_year, line_month, int(day), time)
+        return (ts, host, program, severity_from_priority(priority))
+
+    m = ISO_RE.match(line)
+    if m:
+        priority, time, zone, host, program = m.groups()
+        try:
+            if zone:
+                if zone == 'Z':
+                    zone = '+00:00'
+                elif ':' not in zone:
+                    zone = zone[:3] + ':' + zone[3:]
+                local_time = datetime.fromisoformat(time + zone)
+                # store the local time as the search time periods
+                local_time = local_time.astimezone().replace(tzinfo=None)
+            else:
+                local_time = datetime.fromisoformat(time)
+        except ValueError:
+            return (None, None, None, None)
+        return (local_time.strftime(TS_FORMAT), host, program,
+                severity_from_priority(priority))
+
+    return (None, None, None, None)
+
+
+class TestLogParser(unittest.TestCase):
+
+    def test_parse_line_bsd(self):
+        line = 'Aug  1 03:05:01 host1 sshd[123]: Accepted password\n'
+        self.assertEqual(('2018-08-01 03:05:01', 'host1', 'sshd', None),
+                         parse_line(line, 2018, 8))
+
+    def test_parse_line_bsd_with_priority(self):
+        line = '<34>Oct 11 22:14:15 mymachine su: failed for lonvick'
+        self.assertEqual(('2018-10-11 22:14:15', 'mymachine', 'su', 2),
+                         parse_line(line, 2018, 10))
+
+    def test_parse_line_bsd_previous_year(self):
+        line = 'Dec 31 23:59:59 host1 CRON[9]: (root) CMD'
+        self.assertEqual(('2018-12-31 23:59:59', 'host1', 'CRON', None),
+                         parse_line(line, 2019, 1))
+
+    def test_parse_line_iso(self):
+        line = '2018-08-01T03:05:01.123456 host1 kernel: eth0 up'
+        self.assertEqual(('2018-08-01 03:05:01', 'host1', 'kernel', None),
+                         parse_line(line, 2018, 8))
+
+    def test_parse_line_unknown(self):
+        self.assertEqual((None, None, None, None),
+                         parse_line('no header', 2018, 8))
+
+    def test_parse_severity(self):
+        self.assertEqual(3, parse_severity('err'))
+        self.assertEqual(3, parse_severity('3'))
+        self.assertEqual(7, parse_severity(7))
+        self.assertRaises(ValueError, parse_severity, 'fatal')
+        self.assertRaises(ValueError, parse_severity, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
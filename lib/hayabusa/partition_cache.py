@@ -0,0 +1,176 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+
+# Local copies (on the local disk of the worker host) of the partitions
+# in the partition catalog, so that repeated searches do not read them
+# over NFS again.
+# Partitions are copied on their first search, and the least recently
+# searched copies (the modification times) are removed beyond
+# 'max_bytes'. The worker processes of a host share the directory.
+# A copy is named after the path and the file status of the partition,
+# so a replaced partition (renamed over the old one) is copied again.
+class PartitionCache:
+    # the copies in progress of processes which died
+    STALE_TMP_SECONDS = 3600
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bytes of the copies (of all the processes, as of the last scan)
+        self.size = sum(size for _, size, _ in self.entries())
+
+    def cache_path(self, path, stat):
+        key = '%s\0%d\0%d\0%d' % (os.path.abspath(path), stat.st_ino,
+                                  stat.st_size, stat.st_mtime_ns)
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, name + '.db')
+
+    # Returns the path of the local copy of the partition, or the path
+    # itself if it cannot be copied.
+    def local_path(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return path
+        if stat.st_size > self.max_bytes:
+            return path
+        cached = self.cache_path(path, stat)
+        try:
+            # the least recently searched copies are removed first
+            os.utime(cached)
+            with self.lock:
+                self.hits += 1
+            return cached
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.misses += 1
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        os.close(fd)
+        try:
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, cached)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return path
+        # the other processes add their copies too, so the directory is
+        # scanned for its size
+        self.evict(cached)
+        return cached
+
+    # (modification time, size, path) of the copies
+    def entries(self):
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith('.db'):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            elif entry.name.endswith('.tmp') and \
+                    now - stat.st_mtime > self.STALE_TMP_SECONDS:
+                self.remove(entry.path)
+        return entries
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            # removed by another process
+            return False
+
+    # Removes the least recently searched copies but 'keep'.
+    def evict(self, keep):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        evictions = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            if self.remove(path):
+                evictions += 1
+            total -= size
+        with self.lock:
+            self.size = total
+            self.evictions += evictions
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'bytes': self.size}
+
+
+class TestPartitionCache(unittest.TestCase):
+
+    def create_partition(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def test_partition_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, '%02d.db' % i) for i in range(3)]
+            for path in paths:
+                self.create_partition(path, b'x' * 100)
+            cache = PartitionCache(os.path.join(tmp_dir, 'cache'), 250)
+            copies = [cache.local_path(path) for path in paths[:2]]
+            for path, copy in zip(paths, copies):
+                self.assertNotEqual(path, copy)
+                with open(copy, 'rb') as f:
+                    self.assertEqual(b'x' * 100, f.read())
+            self.assertEqual(copies[0], cache.local_path(paths[0]))
+            os.utime(copies[1], (0, 0))
+            # evicts the least recently searched copy
+            cache.local_path(paths[2])
+            self.assertTrue(os.path.exists(copies[0]))
+            self.assertFalse(os.path.exists(copies[1]))
+            self.assertEqual({'hits': 1, 'misses': 3, 'evictions': 1,
+                              'bytes': 200}, cache.stats())
+            # a replaced partition is copied again
+            os.remove(paths[0])
+            self.create_partition(paths[0], b'y' * 120)
+            copy = cache.local_path(paths[0])
+            self.assertNotEqual(copies[0], copy)
+            with open(copy, 'rb') as f:
+                self.assertEqual(b'y' * 120, f.read())
+            # missing and too large partitions are not copied
+            missing = os.path.join(tmp_dir, 'missing.db')
+            self.assertEqual(missing, cache.local_path(missing))
+            self.create_partition(paths[1], b'x' * 300)
+            self.assertEqual(paths[1], cache.local_path(paths[1]))
+
+    def test_shared_directory(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, '%02d.db' % i) for i in range(4)]
+            for path in paths:
+                self.create_partition(path, b'x' * 100)
+            cache_dir = os.path.join(tmp_dir, 'cache')
+            # the caches of two processes
+            caches = [PartitionCache(cache_dir, 250) for _ in range(2)]
+            for i, path in enumerate(paths):
+                cache = caches[i % 2]
+                os.utime(cache.local_path(path), (i, i))
+            copies = [name for name in os.listdir(cache_dir)
+                      if name.endswith('.db')]
+            self.assertEqual(2, len(copies))
+            self.assertEqual(200, caches[1].stats()['bytes'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Partitions are only read. SQLite reads immutable partitions (published
+# partitions never change, they are only replaced by renaming) without
+# locking and change detection.
+def partition_uri(path, immutable=False):
+    uri = 'file:%s?mode=ro' % urllib.parse.quote(path)
+    if immutable:
+        uri += '&immutable=1'
+    return uri
+
+
+# The rows as the sqlite3 command line shell prints them (list mode).
+def format_rows(rows):
+    return ''.join('|'.join('' if value is None else str(value)
+                            for value in row) + '\n'
+                   for row in rows)
+
+
+# Runs the SQL of a command on partitions in the worker process:
+# the partitions are searched on a thread pool (SQLite releases the GIL),
+# and the connections to immutable partitions are kept for the next
+# commands (LRU, reopened if the file was replaced).
+# A worker process runs a command at a time: 'interrupt' stops it, and
+# 'reset' makes the engine run the next one.
+class QueryEngine:
+    def __init__(self, threads=4, max_connections=256):
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(threads)
+        self.max_connections = max_connections
+        # {path: (file signature, connection)} of idle connections
+        self.connections = OrderedDict()
+        # connections running queries
+        self.active = set()
+        self.lock = threading.Lock()
+        self.interrupted = threading.Event()
+
+    def close(self):
+        self.executor.shutdown()
+        with self.lock:
+            for _, conn in self.connections.values():
+                conn.close()
+            self.connections.clear()
+
+    def signature(self, path):
+        stat = os.stat(path)
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def connect(self, path, immutable, reuse):
+        if reuse:
+            signature = self.signature(path)
+            with self.lock:
+                cached = self.connections.pop(path, None)
+            if cached:
+                if cached[0] == signature:
+                    return (signature, cached[1])
+                cached[1].close()
+        else:
+            signature = None
+        conn = sqlite3.connect(partition_uri(path, immutable), uri=True,
+                               check_same_thread=False)
+        return (signature, conn)
+
+    def release(self, path, signature, conn):
+        if signature is None:
+            conn.close()
+            return
+        evicted = []
+        with self.lock:
+            self.connections[path] = (signature, conn)
+            while len(self.connections) > self.max_connections:
+                evicted.append(self.connections.popitem(last=False)[1][1])
+        for old in evicted:
+            old.close()
+
+    # Returns (rows, None) or (None, error message).
+    def search(self, sql, path, immutable, reuse):
+        if self.interrupted.is_set():
+            return (None, 'interrupted')
+        try:
+            signature, conn = self.connect(path, immutable, reuse)
+        except (OSError, sqlite3.Error) as e:
+            return (None, str(e))
+        with self.lock:
+            self.active.add(conn)
+        try:
+            rows = conn.execute(sql).fetchall()
+        except sqlite3.Error as e:
+            # not reused after errors
+            signature = None
+            return (None, str(e))
+        finally:
+            with self.lock:
+                self.active.discard(conn)
+            self.release(path, signature, conn)
+        return (rows, None)
+
+    # partitions: (path, immutable, reuse) of each partition,
+    # 'reuse': the connection is kept for the next commands.
+    # Returns (rows, error message) of each partition, in order.
+    def run(self, sql, partitions):
+        futures = [self.executor.submit(self.search, sql, *partition)
+                   for partition in partitions]
+        return [future.result() for future in futures]
+
+    # Yields (rows, error message) of each partition, in order, searching
+    # at most a partition per thread ahead, so that only their rows are
+    # kept at a time.
+    def iterate(self, sql, partitions):
+        futures = deque()
+        for partition in partitions:
+            if len(futures) == self.threads:
+                yield futures.popleft().result()
+            futures.append(self.executor.submit(self.search, sql,
+                                                *partition))
+        while futures:
+            yield futures.popleft().result()
+
+    # Stops the running command: the running queries fail, and the other
+    # partitions are not searched.
+    def interrupt(self):
+        self.interrupted.set()
+        with self.lock:
+            for conn in self.active:
+                conn.interrupt()
+
+    def reset(self):
+        self.interrupted.clear()
+
+
+class TestQueryEngine(unittest.TestCase):
+
+    def create_partition(self, path, lines):
+        conn = sqlite3.connect(path)
+        with conn:
+            conn.execute('CREATE TABLE syslog (logs TEXT)')
+            conn.executemany('INSERT INTO syslog VALUES (?)',
+                             [(line,) for line in lines])
+        conn.close()
+
+    def test_partition_uri(self):
+        self.assertEqual('file:/s/2018/08/01/00.db?mode=ro',
+                         partition_uri('/s/2018/08/01/00.db'))
+        self.assertEqual('file:/s/a%20b.db?mode=ro&immutable=1',
+                         partition_uri('/s/a b.db', immutable=True))
+
+    def test_format_rows(self):
+        self.assertEqual('a|1\n|2\n', format_rows([('a', 1), (None, 2)]))
+
+    def test_query_engine(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, '%02d.db' % i) for i in range(3)]
+            for i, path in enumerate(paths):
+                self.create_partition(path, ['line %d' % j
+                                             for j in range(i + 1)])
+            missing = os.path.join(tmp_dir, 'missing.db')
+            engine = QueryEngine(threads=2, max_connections=2)
+            sql = 'select count(*) from syslog;'
+            partitions = [(path, True, True) for path in paths]
+            res = engine.run(sql, partitions + [(missing, False, False)])
+            self.assertEqual([([(1,)], None), ([(2,)], None),
+                              ([(3,)], None)], res[:3])
+            # the request broker reports missing partitions by the error
+            self.assertEqual((None, 'unable to open database file'), res[3])
+            self.assertEqual(2, len(engine.connections))
+            # a replaced partition is reopened
+            os.remove(paths[2])
+            self.create_partition(paths[2], ['line'])
+            self.assertEqual([([(1,)], None)],
+                             engine.run(sql, [(paths[2], True, True)]))
+            self.assertEqual(['no such table: log'],
+                             [error for _, error in
+                              engine.run('select logs from log;',
+                                         partitions[:1])])
+            self.assertEqual([([(1,)], None), ([(2,)], None),
+                              ([(1,)], None)],
+                             list(engine.iterate(sql, partitions)))
+            engine.interrupt()
+            self.assertEqual([(None, 'interrupted')],
+                             engine.run(sql, partitions[:1]))
+            engine.reset()
+            self.assertEqual([([(1,)], None)],
+                             engine.run(sql, partitions[:1]))
+            engine.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,350 @@
+import copy
+import json
+import logging
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+
+from hayabusa.constants import Status
+from hayabusa.errors import HayabusaError
+
+
+# microseconds, as requests are created and updated many times a second
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+class RequestRecord:
+    __slots__ = ('user', 'status', 'data', 'host', 'port',
+                 'created', 'updated', 'owner')
+
+    def __init__(self, user, status, host, port, created):
+        self.user = user
+        self.status = status
+        self.data = None
+        self.host = host
+        self.port = port
+        self.created = created
+        self.updated = created
+        # the result address of the broker process which owns the
+        # request (SharedRequestRegistry), None: this process
+        self.owner = None
+
+    def copy(self):
+        return copy.copy(self)
+
+
+# The state of the requests of the request broker.
+# The request broker runs in a single process (gunicorn with threads),
+# so the records are in its memory. The requests are split into
+# stripes by their IDs, and each stripe has its own lock, so that the
+# result collector and the REST handlers rarely wait for each other.
+# Readers get copies of the records.
+class RequestRegistry:
+    def __init__(self, stripes=16):
+        self.stripes = [(threading.Lock(), {}) for _ in range(stripes)]
+
+    def close(self):
+        pass
+
+    def stripe(self, request_id):
+        return self.stripes[hash(request_id) % len(self.stripes)]
+
+    def create(self, request_id, user, status, host, port):
+        lock, records = self.stripe(request_id)
+        record = RequestRecord(user, status, host, port, datetime.now())
+        with lock:
+            records[request_id] = record
+
+    # Returns the time the request was created.
+    def update(self, request_id, status, data=None):
+        lock, records = self.stripe(request_id)
+        with lock:
+            record = records.get(request_id)
+            if record is None:
+                raise HayabusaError('Unknown Request ID: %s' % request_id)
+            record.status = status
+            record.data = data
+            record.updated = datetime.now()
+            return record.created
+
+    # Returns a copy of the record, or None.
+    def get(self, request_id):
+        lock, records = self.stripe(request_id)
+        with lock:
+            record = records.get(request_id)
+            return record.copy() if record else None
+
+    def remove(self, request_id):
+        lock, records = self.stripe(request_id)
+        with lock:
+            records.pop(request_id, None)
+
+    # Returns (request_id, copy of the record) pairs.
+    # All the requests are owned by this process.
+    def items(self, owned=False):
+        items = []
+        for lock, records in self.stripes:
+            with lock:
+                items.extend((request_id, record.copy())
+                             for request_id, record in records.items())
+        return items
+
+    def __len__(self):
+        return sum(len(records) for _, records in self.stripes)
+
+
+# The state of the requests shared by the request broker processes
+# on a host, in a SQLite database in WAL mode (readers do not block the
+# writer). Each request is owned by the process which received it:
+# the workers send the results to the owner, which collects them and
+# times the request out, while any process answers status requests.
+class SharedRequestRegistry:
+    def __init__(self, path, owner, timeout=30.0):
+        self.path = path
+        self.owner = owner
+        self.timeout = timeout
+        # a connection for each thread
+        self.local = threading.local()
+        conn = self.connection()
+        try:
+            conn.execute('PRAGMA journal_mode = WAL')
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS REQUESTS('
+                             'ID TEXT PRIMARY KEY, OWNER TEXT, USER TEXT, '
+                             'STATUS TEXT, DATA TEXT, HOST TEXT, '
+                             'PORT INTEGER, CREATED TEXT, UPDATED TEXT)')
+        except sqlite3.Error as e:
+            raise HayabusaError('Request State Error: %s, %s' % (path, e))
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def execute(self, sql, params=()):
+        conn = self.connection()
+        try:
+            with conn:
+                return conn.execute(sql, params)
+        except sqlite3.Error as e:
+            raise HayabusaError('Request State Error: %s, %s' %
+                                (self.path, e))
+
+    def record(self, row):
+        user, status, data, host, port, created, updated, owner = row
+        record = RequestRecord(user, Status[status], host, port,
+                               datetime.strptime(created, TIME_FORMAT))
+        record.data = json.loads(data) if data else None
+        record.updated = datetime.strptime(updated, TIME_FORMAT)
+        record.owner = owner
+        return record
+
+    def create(self, request_id, user, status, host, port):
+        now = datetime.now().strftime(TIME_FORMAT)
+        self.execute('INSERT OR REPLACE INTO REQUESTS '
+                     'VALUES (?, ?, ?, ?, NULL, ?, ?, ?, ?)',
+                     (request_id, self.owner, user, status.name, host, port,
+                      now, now))
+
+    def update(self, request_id, status, data=None):
+        data = json.dumps(data) if data is not None else None
+        cur = self.execute('UPDATE REQUESTS SET STATUS = ?, DATA = ?, '
+                           'UPDATED = ? WHERE ID = ?',
+                           (status.name, data,
+                            datetime.now().strftime(TIME_FORMAT),
+                            request_id))
+        if not cur.rowcount:
+            raise HayabusaError('Unknown Request ID: %s' % request_id)
+        row = self.execute('SELECT CREATED FROM REQUESTS WHERE ID = ?',
+                           (request_id,)).fetchone()
+        return datetime.strptime(row[0], TIME_FORMAT)
+
+    def get(self, request_id):
+        row = self.execute('SELECT USER, STATUS, DATA, HOST, PORT, '
+                           'CREATED, UPDATED, OWNER FROM REQUESTS '
+                           'WHERE ID = ?',
+                           (request_id,)).fetchone()
+        return self.record(row) if row else None
+
+    def remove(self, request_id):
+        self.execute('DELETE FROM REQUESTS WHERE ID = ?', (request_id,))
+
+    def items(self, owned=False):
+        sql = 'SELECT ID, USER, STATUS, DATA, HOST, PORT, CREATED, ' \
+              'UPDATED, OWNER FROM REQUESTS'
+        params = ()
+        if owned:
+            sql += ' WHERE OWNER = ?'
+            params = (self.owner,)
+        return [(row[0], self.record(row[1:]))
+                for row in self.execute(sql, params).fetchall()]
+
+    def __len__(self):
+        return self.execute('SELECT count(*) FROM REQUESTS').fetchone()[0]
+
+
+# The requests of this process in memory, written to a
+# SharedRequestRegistry in the same order by a thread, so that the
+# asyncio request broker does not wait on its event loop while another
+# process holds the lock of the database.
+# The requests of the other processes are read from the database (the
+# request broker reads them in its executor).
+class BufferedRequestRegistry:
+    def __init__(self, shared, logger):
+        self.shared = shared
+        self.owner = shared.owner
+        self.logger = logger
+        self.records = RequestRegistry()
+        self.writes = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    # The writes queued so far are written first.
+    def close(self):
+        self.writes.put(None)
+        self.writer.join()
+
+    def write_loop(self):
+        try:
+            while True:
+                write = self.writes.get()
+                if write is None:
+                    return
+                func, args = write
+                try:
+                    func(*args)
+                except HayabusaError as e:
+                    # eg: removed by the request monitor of another
+                    # process
+                    self.logger.error(str(e))
+        finally:
+            self.shared.close()
+
+    def create(self, request_id, user, status, host, port):
+        self.records.create(request_id, user, status, host, port)
+        self.writes.put((self.shared.create,
+                         (request_id, user, status, host, port)))
+
+    # Requests created before this process started are only in the
+    # database.
+    def update(self, request_id, status, data=None):
+        try:
+            created = self.records.update(request_id, status, data)
+        except HayabusaError:
+            return self.shared.update(request_id, status, data)
+        self.writes.put((self.shared.update, (request_id, status, data)))
+        return created
+
+    def get(self, request_id):
+        record = self.records.get(request_id)
+        if record is not None:
+            return record
+        return self.shared.get(request_id)
+
+    def remove(self, request_id):
+        self.records.remove(request_id)
+        self.writes.put((self.shared.remove, (request_id,)))
+
+    # The records in memory are newer than the ones in the database
+    # (or not written yet).
+    def items(self, owned=False):
+        items = dict(self.shared.items(owned))
+        items.update(self.records.items())
+        return list(items.items())
+
+    def __len__(self):
+        return len(self.items())
+
+
+class TestRequestRegistry(unittest.TestCase):
+
+    def test_registry(self):
+        registry = RequestRegistry(stripes=4)
+        registry.create('a', 'user', Status.CR_ReceivedRequest,
+                        'localhost', 5000)
+        registry.create('b', 'user', Status.CR_ReceivedRequest,
+                        'localhost', 5001)
+        progress = ['worker-1', None]
+        registry.update('a', Status.WR_CollectingResults, progress)
+        record = registry.get('a')
+        self.assertEqual(Status.WR_CollectingResults, record.status)
+        self.assertEqual(progress, record.data)
+        # copies do not change the registry
+        record.status = Status.RC_SentResult
+        self.assertEqual(Status.WR_CollectingResults,
+                         registry.get('a').status)
+        self.assertEqual(['a', 'b'],
+                         sorted(request_id for request_id, _ in
+                                registry.items()))
+        registry.remove('a')
+        self.assertEqual(1, len(registry))
+        self.assertIsNone(registry.get('a'))
+        self.assertRaises(HayabusaError, registry.update, 'a',
+                          Status.RC_SentResult)
+
+    def test_shared_registry(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'requests.db')
+            registry1 = SharedRequestRegistry(path, 'tcp://localhost:10001')
+            registry2 = SharedRequestRegistry(path, 'tcp://localhost:10002')
+            registry1.create('a', 'user', Status.CR_ReceivedRequest,
+                             'localhost', 5000)
+            registry2.update('a', Status.WR_CollectingResults, ['w1', None])
+            record = registry1.get('a')
+            self.assertEqual(Status.WR_CollectingResults, record.status)
+            self.assertEqual(['w1', None], record.data)
+            self.assertEqual('tcp://localhost:10001', record.owner)
+            self.assertEqual(['a'], [request_id for request_id, _ in
+                                     registry1.items(owned=True)])
+            self.assertEqual([], registry2.items(owned=True))
+            registry2.remove('a')
+            self.assertEqual(0, len(registry1))
+            registry1.close()
+            registry2.close()
+
+    def test_buffered_registry(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'requests.db')
+            shared = SharedRequestRegistry(path, 'tcp://localhost:10001')
+            other = SharedRequestRegistry(path, 'tcp://localhost:10002')
+            other.create('b', 'user', Status.CR_ReceivedRequest,
+                         'localhost', 5001)
+            registry = BufferedRequestRegistry(
+                shared, logging.getLogger('test_buffered_registry'))
+            registry.create('a', 'user', Status.CR_ReceivedRequest,
+                            'localhost', 5000)
+            registry.update('a', Status.WR_CollectingResults, ['w1'])
+            self.assertEqual(Status.WR_CollectingResults,
+                             registry.get('a').status)
+            self.assertEqual('user', registry.get('b').user)
+            self.assertEqual(['a', 'b'], sorted(request_id for request_id, _
+                                                in registry.items()))
+            self.assertEqual(['a'], [request_id for request_id, _ in
+                                     registry.items(owned=True)])
+            registry.remove('b')
+            registry.close()
+            # written in order
+            record = other.get('a')
+            self.assertEqual(Status.WR_CollectingResults, record.status)
+            self.assertEqual(['w1'], record.data)
+            self.assertIsNone(other.get('b'))
+            other.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,17 @@
 import copy
 import json
+import logging
 import os
+import queue
 import re
-import shlex
 import socket
 import threading
 import time
+import unittest
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from multiprocessing import Lock, Manager
 
 import bcrypt
 import falcon
@@ -16,16 +19,76 @@ import yaml
 import zmq
 
 from hayabusa import HayabusaBase
-from hayabusa.constants import Status, CompletedStatus
-from hayabusa.db_file_path import db_file_path, \
-    parse_start_time, parse_end_time
+from hayabusa.auth_cache import CredentialCache
+from hayabusa.bloom import required_phrases
+from hayabusa.catalog import PartitionCatalog, catalog_exists
+from hayabusa.constants import Status, CompletedStatus, BROKER_PORT_STRIDE
+from hayabusa.count_store import CountStore, count_key
+from hayabusa.db_file_path import partition_plan, check_time_period, \
+    parse_start_time, parse_end_time, has_seconds, shard_groups
 from hayabusa.errors import HayabusaError, AuthenticationError, BadRequest, \
     unexpected_error
+from hayabusa.hash_ring import HashRing
+from hayabusa.log_parser import parse_severity, TS_FORMAT
+from hayabusa.registry import RequestRegistry, SharedRequestRegistry
+from hayabusa.result_cache import ResultCache, result_cache_key
+from hayabusa.scheduler import CommandScheduler, INTERACTIVE, BATCH
+from hayabusa.storage import StorageFormat, load_format_history, \
+    format_segments, minute_str, FTS3, STRUCTURED
 from hayabusa.utils import time_str
 
 
+# Sends the chunks of a streamed request to the client on a thread, so
+# that a stalled client does not stop the result collector.
+# The chunks after a send timed out are dropped ('stalled').
+class ChunkSender:
+    def __init__(self, socket):
+        self.socket = socket
+        self.stalled = False
+        self.chunks = queue.Queue()
+        th = threading.Thread(target=self.run)
+        th.daemon = True
+        th.start()
+
+    def send(self, chunk):
+        self.chunks.put(chunk)
+
+    # The queued chunks are sent before the socket is closed.
+    def close(self):
+        self.chunks.put(None)
+
+    def run(self):
+        chunk = self.chunks.get()
+        while chunk is not None:
+            if not self.stalled:
+                try:
+                    self.socket.send_json(chunk)
+                except zmq.Again:
+                    self.stalled = True
+            chunk = self.chunks.get()
+        self.socket.close()
+
+
 class RequestBroker(HayabusaBase):
     USER_LIST_FILE = 'users.yml'
+    # AsyncRequestBroker uses the sockets on its event loop
+    ZMQ_CONTEXT = zmq.Context
+    # the worker label of cached results
+    CACHE_WORKER = 'result-cache'
+    # requests with the same parameters are coalesced
+    COALESCE_FIELDS = ('user', 'start_time', 'end_time', 'match', 'count',
+                       'sum', 'exact', 'log_host', 'log_program',
+                       'log_severity')
+    # wakes up the command dispatcher for new commands
+    DISPATCHER_ADDRESS = 'inproc://hayabusa-dispatcher'
+    # chunks of a streamed request queued for the client
+    STREAM_HWM = 16
+    # second, the count store is pruned at most at the interval
+    COUNTS_PRUNE_INTERVAL = 60 * 60
+    # the clients of the running requests checked at once, and the
+    # timeout (second) of a check
+    PORT_CHECK_THREADS = 16
+    PORT_CHECK_TIMEOUT = 0.5
 
     def __init__(self):
         super().__init__('request-broker')
@@ -34,15 +97,48 @@ class RequestBroker(HayabusaBase):
                          '=========================')
         self.users = self.load_users()
 
-        manager = Manager()
-        self.requests = manager.dict()
-        self.requests_lock = Lock()
+        # only used by the result collector
+        self.results = {}
+        self.progress = {}
+        self.local = threading.local()
+        # coalesced requests:
+        # {parameters: leader ID}, {leader ID: parameters},
+        # {leader ID: [follower ID, ...]}
+        self.inflight = {}
+        self.leaders = {}
+        self.followers = {}
+        # only used by the result collector:
+        # {ID of the commands of a cancelled leader: promoted follower ID}
+        self.promoted = {}
+        self.coalesce_lock = threading.Lock()
+        # {worker label: the time of its last notice or result}
+        self.workers = {}
+        # {worker label: the counters of the partition cache of the worker
+        # process in its last result}
+        self.partition_cache_stats = {}
+        # only used by the command dispatcher:
+        # (socket identity, label, host) of the workers waiting for
+        # commands, and a command waiting for a worker
+        self.idle_workers = deque()
+        self.pending = None
+        # {worker host: the time of its last ready message},
+        # the hash ring of the hosts, and the commands sent to
+        # the preferred hosts or not
+        self.worker_hosts = {}
+        self.hash_ring = None
+        self.affinity_hits = 0
+        self.affinity_misses = 0
+        # {worker label: (user, priority, command)} of the commands sent
+        # to the worker processes, until they are ready again
+        self.outstanding = {}
+        self.outstanding_lock = threading.Lock()
 
         # -------- Config --------
         config = self.config
         self.store_dir = config['path']['base-dir']
         self.sender_port = config['port']['command']
         self.receiver_port = config['port']['result']
+        self.cancel_port = config['port'].get('cancel', '5559')
         self.max_search_days = int(config['limit']['max-search-days'])
         self.request_borker_host = config['request-broker']['host']
         self.request_timeout = \
@@ -53,21 +149,113 @@ class RequestBroker(HayabusaBase):
             float(config['request-broker']['request-data-lifetime'])
         self.max_stderr_length = \
             int(config['request-broker']['max-stderr-length'])
+        self.processes = \
+            int(config['request-broker'].get('processes', '1'))
+        state_file = config['request-broker'].get('state-file')
+        # MB
+        cache_size = \
+            float(config['request-broker'].get('result-cache-size', '0'))
+        self.result_cache = None
+        if cache_size:
+            self.result_cache = ResultCache(int(cache_size * 1024 * 1024))
+        self.shards = int(config['request-broker'].get('shards', '0'))
+        self.worker_lifetime = \
+            float(config['request-broker'].get('worker-lifetime', '600'))
+        self.worker_processes = int(config['worker']['process'])
+        count_store = config['request-broker'].get('count-store')
+        self.count_store = CountStore(count_store) if count_store else None
+        # days
+        self.count_store_lifetime = float(
+            config['request-broker'].get('count-store-lifetime', '30'))
+        self.counts_pruned = time.time()
+        # minutes
+        self.interactive_period = \
+            float(config['request-broker'].get('interactive-period', '60'))
+        self.scheduler = CommandScheduler(self.parse_user_weights(
+            config['request-broker'].get('user-weights', '')))
+        auth_cache_size = \
+            int(config['request-broker'].get('auth-cache-size', '0'))
+        self.auth_cache = None
+        if auth_cache_size:
+            # second
+            ttl = float(config['request-broker'].get('auth-cache-ttl',
+                                                     '300'))
+            self.auth_cache = CredentialCache(auth_cache_size, ttl)
+        self.affinity_points = \
+            int(config['request-broker'].get('affinity-points', '0'))
+        # second
+        self.stream_timeout = \
+            float(config['request-broker'].get('stream-timeout', '10'))
 
         # -------- ZeroMQ --------
         self.logger.info('Listening Ports')
-        sender_bind = 'tcp://*:%s' % self.sender_port
-        receiver_bind = 'tcp://*:%s' % self.receiver_port
-        self.logger.info('Command PUSH: %s', sender_bind)
-        self.logger.info('Result PULL: %s', receiver_bind)
+        # workers ask for commands when they are free
+        router_context = self.ZMQ_CONTEXT()
+        self.sender = router_context.socket(zmq.ROUTER)
+        # fails to send to workers which are gone
+        self.sender.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        pull_context = self.ZMQ_CONTEXT()
+        self.receiver = pull_context.socket(zmq.PULL)
+        # only used by the result collector
+        pub_context = self.ZMQ_CONTEXT()
+        self.canceller = pub_context.socket(zmq.PUB)
+        # {request ID: socket (None: stalled)} of the streamed results,
+        # only used by the result collector
+        self.stream_context = self.ZMQ_CONTEXT()
+        self.streams = {}
+        self.bind_ports()
+        # the workers send the results of the requests of this process
+        # to this address
+        self.reply_to = 'tcp://%s:%s' % (self.request_borker_host,
+                                         self.receiver_port)
 
-        push_context = zmq.Context()
-        self.sender = push_context.socket(zmq.PUSH)
-        self.sender.bind(sender_bind)
+        # -------- Request State --------
+        if state_file:
+            self.logger.info('Request State: %s', state_file)
+            self.requests = SharedRequestRegistry(state_file, self.reply_to)
+        elif self.processes > 1:
+            raise HayabusaError('state-file is required for %s processes' %
+                                self.processes)
+        else:
+            self.requests = RequestRegistry()
 
-        pull_context = zmq.Context()
-        self.receiver = pull_context.socket(zmq.PULL)
-        self.receiver.bind(receiver_bind)
+    # The broker processes (gunicorn workers) bind the first free set
+    # of ports: 'command + N * BROKER_PORT_STRIDE',
+    # 'result + N * BROKER_PORT_STRIDE' and
+    # 'cancel + N * BROKER_PORT_STRIDE' (N: 0 to processes - 1).
+    def bind_ports(self):
+        for n in range(self.processes):
+            offset = n * BROKER_PORT_STRIDE
+            sender_bind = 'tcp://*:%s' % (int(self.sender_port) + offset)
+            receiver_bind = 'tcp://*:%s' % (int(self.receiver_port) + offset)
+            canceller_bind = 'tcp://*:%s' % (int(self.cancel_port) + offset)
+            try:
+                self.sender.bind(sender_bind)
+            except zmq.ZMQError:
+                # used by another broker process
+                continue
+            try:
+                self.receiver.bind(receiver_bind)
+            except zmq.ZMQError:
+                self.sender.unbind(sender_bind)
+                continue
+            try:
+                self.canceller.bind(canceller_bind)
+            except zmq.ZMQError:
+                self.sender.unbind(sender_bind)
+                self.receiver.unbind(receiver_bind)
+                continue
+            self.logger.info('Command ROUTER: %s', sender_bind)
+            self.logger.info('Result PULL: %s', receiver_bind)
+            self.logger.info('Cancel PUB: %s', canceller_bind)
+            self.sender_port = int(self.sender_port) + offset
+            self.receiver_port = int(self.receiver_port) + offset
+            self.cancel_port = int(self.cancel_port) + offset
+            return
+        raise HayabusaError('No free ports: command %s, result %s, '
+                            'cancel %s (processes: %s)' %
+                            (self.sender_port, self.receiver_port,
+                             self.cancel_port, self.processes))
 
     def elapsed_time(self, start):
         delta = datetime.now() - start
@@ -75,98 +263,194 @@ class RequestBroker(HayabusaBase):
             delta.microseconds / 1000000.0
         return e_time
 
+    def users_file(self):
+        return os.path.join(HayabusaBase.etc_dir, self.USER_LIST_FILE)
+
+    # the user list file is replaced or rewritten if these change
+    def users_file_stat(self, file):
+        stat = os.stat(file)
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def read_users(self, file):
+        self.logger.debug('loading user list (YAML): %s', file)
+        with open(file, 'r') as f:
+            users = yaml.safe_load(f)
+        if type(users) != dict:
+            raise HayabusaError('Invalid user list format: %s' % file)
+        return users
+
     def load_users(self):
-        file = os.path.join(HayabusaBase.etc_dir, self.USER_LIST_FILE)
+        file = self.users_file()
         try:
-            self.logger.debug('loading user list (YAML): %s', file)
-            with open(file, 'r') as f:
-                users = yaml.load(f)
-            if type(users) != dict:
-                raise HayabusaError('Invalid user list format: %s' % file)
-
+            self.users_stat = self.users_file_stat(file)
+            users = self.read_users(file)
         except Exception as e:
             self.critical_exit(e, 'Load Error: user list file: %s' % file)
         return users
 
+    # Reloads the user list if the file changed, and forgets the
+    # verified credentials.
+    # The current user list is kept if the new one cannot be loaded.
+    def check_users(self):
+        file = self.users_file()
+        try:
+            users_stat = self.users_file_stat(file)
+            if users_stat == self.users_stat:
+                return
+            users = self.read_users(file)
+        except Exception as e:
+            self.logger.error('Load Error: user list file: %s, %s' %
+                              (file, e))
+            return
+        self.logger.info('reloaded user list: %s', file)
+        self.users = users
+        self.users_stat = users_stat
+        if self.auth_cache is not None:
+            self.auth_cache.clear()
+
     def notify_status(self, request_id, status, log_message):
         self.logger.debug('Status - %s - [%s] - %s',
                           request_id, status, log_message)
 
     def create_request(self, user, request_id, status, host, port,
                        log_message):
-        with self.requests_lock:
-            now = datetime.now()
-            self.requests[request_id] = \
-                {'user': user, 'status': status, 'data': None,
-                 'host': host, 'port': port,
-                 'updated': now, 'created': now}
+        self.requests.create(request_id, user, status, host, port)
         self.notify_status(request_id, status, log_message)
 
+    # 'data' (the progress) is copied, as the result collector keeps
+    # updating it.
     def update_status(self, request_id, status, log_message, data=None):
-        with self.requests_lock:
-            if self.requests.get(request_id):
-                tmp_data = copy.deepcopy(self.requests[request_id])
-                tmp_data['status'] = status
-                tmp_data['data'] = data
-                tmp_data['updated'] = datetime.now()
-                elapsed_time = self.elapsed_time(tmp_data['created'])
-                self.requests[request_id] = tmp_data
-                self.logger.debug('Update Status - %s - [%s] - [%s]',
-                                  request_id, status, time_str(elapsed_time))
-            else:
-                raise HayabusaError('Unknown Request ID: %s' % request_id)
+        created = self.requests.update(request_id, status, copy.copy(data))
+        self.logger.debug('Update Status - %s - [%s] - [%s]',
+                          request_id, status,
+                          time_str(self.elapsed_time(created)))
         self.notify_status(request_id, status, log_message)
 
+    # The result collector receives timeout errors as results.
     def timeout_error(self, request_id, host, port):
-        context = zmq.Context()
-        sender = context.socket(zmq.PUSH)
-        sender.connect('tcp://%s:%s' %
-                       (self.request_borker_host, self.receiver_port))
+        self.loopback(self.timeout_message(request_id, host, port))
+
+    # Sends a message to the result collector of this process.
+    def loopback(self, message):
+        self.push(self.reply_to, message)
+
+    # Sends a message to the result collector of a broker process,
+    # with a socket for each thread.
+    def push(self, address, message):
+        senders = getattr(self.local, 'senders', None)
+        if senders is None:
+            senders = self.local.senders = {}
+        sender = senders.get(address)
+        if sender is None:
+            sender = zmq.Context.instance().socket(zmq.PUSH)
+            sender.connect(address)
+            senders[address] = sender
+        sender.send_json(message)
+
+    def error_message(self, type, status, request_id, host, port, error):
         message = {}
-        message['type'] = 'timeout_error'
+        message['type'] = type
         message['id'] = request_id
-        message['message'] = Status.RC_TimeoutError.name
+        message['message'] = status.name
         message['host'] = host
         message['port'] = port
         message['exit_status'] = 1
         message['stdout'] = ''
-        message['stderr'] = 'Error: Request Timeout'
-        sender.send_json(message)
+        message['stderr'] = 'Error: %s' % error
+        return message
+
+    def timeout_message(self, request_id, host, port):
+        return self.error_message('timeout_error', Status.RC_TimeoutError,
+                                  request_id, host, port, 'Request Timeout')
+
+    def cancel_message(self, request_id, host, port, reason):
+        return self.error_message('cancel_error',
+                                  Status.RC_CancelledRequest, request_id,
+                                  host, port,
+                                  'Request Cancelled (%s)' % reason)
+
+    # The result collector of the process which owns the request
+    # cancels it.
+    def cancel_request(self, request_id, record, reason):
+        self.logger.info('%s - cancelling: %s', request_id, reason)
+        message = self.cancel_message(request_id, record.host, record.port,
+                                      reason)
+        if record.owner in (None, self.reply_to):
+            self.loopback(message)
+        else:
+            self.push(record.owner, message)
+
+    # Workers kill the running commands of the request, and drop the
+    # queued commands.
+    def cancel_commands(self, request_id):
+        self.canceller.send_string(request_id)
 
     def request_monitor(self):
         self.logger.info('-------------'
                          ' Starting RequestMonitor '
                          '-------------')
-        timeout = self.request_timeout
-        interval = self.request_monitor_check_interval
-        lifetime = self.request_data_lifetime * 60.0 * 60.0
-
         try:
             while True:
-                time.sleep(interval)
-                now = datetime.now()
-                self.logger.debug('RequestMonitor: stored requests: %s',
-                                  len(self.requests))
-                for request_id, d in self.requests.items():
-                    elapsed_time = self.elapsed_time(d['created'])
-                    if d['status'] in CompletedStatus:
-                        if elapsed_time > lifetime:
-                            self.logger.debug('removing expired request'
-                                              ' data: %s [%s]',
-                                              request_id,
-                                              time_str(elapsed_time))
-                            with self.requests_lock:
-                                if self.requests.get(request_id):
-                                    del self.requests[request_id]
-                    else:
-                        if elapsed_time > timeout:
-                            self.timeout_error(request_id,
-                                               d['host'], d['port'])
-
+                time.sleep(self.request_monitor_check_interval)
+                self.check_requests()
+                self.prune_counts()
+                for request_id, record in self.disconnected_requests():
+                    self.cancel_request(request_id, record,
+                                        'Client Disconnected')
         except Exception as e:
             unexpected_error(self.logger, 'RequestMonitor', e)
             raise
 
+    # Removes expired requests, and times out running requests.
+    def check_requests(self):
+        timeout = self.request_timeout
+        lifetime = self.request_data_lifetime * 60.0 * 60.0
+        self.logger.debug('RequestMonitor: stored requests: %s',
+                          len(self.requests))
+        for request_id, record in self.requests.items():
+            elapsed_time = self.elapsed_time(record.created)
+            if record.status in CompletedStatus and elapsed_time > lifetime:
+                self.logger.debug('removing expired request data: %s [%s]',
+                                  request_id, time_str(elapsed_time))
+                self.requests.remove(request_id)
+        # other processes time out their requests
+        for request_id, record in self.requests.items(owned=True):
+            elapsed_time = self.elapsed_time(record.created)
+            if record.status not in CompletedStatus and \
+               elapsed_time > timeout:
+                self.timeout_error(request_id, record.host, record.port)
+
+    # Removes the counts of the count store which were not used in
+    # 'count-store-lifetime' days (at most hourly).
+    def prune_counts(self):
+        if self.count_store is None or \
+           time.time() - self.counts_pruned < self.COUNTS_PRUNE_INTERVAL:
+            return
+        self.counts_pruned = time.time()
+        removed = self.count_store.prune(
+            self.count_store_lifetime * 24 * 60 * 60)
+        self.logger.debug('RequestMonitor: pruned counts: %d', removed)
+
+    # Returns the running requests of this process whose clients no
+    # longer listen for the results (eg: killed or timed out).
+    def disconnected_requests(self):
+        running = [(request_id, record) for request_id, record in
+                   self.requests.items(owned=True)
+                   if record.status not in CompletedStatus]
+        if not running:
+            return []
+
+        # 'port_check' of this class blocks
+        def connected(item):
+            _, record = item
+            return RequestBroker.port_check(self, record.host, record.port,
+                                            self.PORT_CHECK_TIMEOUT)
+
+        with ThreadPoolExecutor(min(len(running),
+                                    self.PORT_CHECK_THREADS)) as executor:
+            checks = list(executor.map(connected, running))
+        return [item for item, check in zip(running, checks) if not check]
+
     def start_threads(self):
         self.logger.info('Starting Result Collector Thread')
         collector = threading.Thread(target=self.result_collector)
@@ -177,6 +461,10 @@ class RequestBroker(HayabusaBase):
         tracker.setDaemon(True)
         tracker.start()
 
+        dispatcher = threading.Thread(target=self.command_dispatcher)
+        dispatcher.setDaemon(True)
+        dispatcher.start()
+
     def log_progress(self, progress):
         for request_id, data in progress.items():
             self.logger.debug('Progress - %s - %s', request_id, data)
@@ -186,11 +474,11 @@ class RequestBroker(HayabusaBase):
         self.logger.debug('Ignore Result: %s', log_message)
 
     def check_request_id(self, request_id):
-        if self.requests.get(request_id):
-            status = self.requests[request_id]['status']
-            if status in CompletedStatus:
+        record = self.requests.get(request_id)
+        if record:
+            if record.status in CompletedStatus:
                 raise HayabusaError('Completed Status: %s, %s' %
-                                    (request_id, status))
+                                    (request_id, record.status))
         else:
             raise HayabusaError('Unknown Request ID: %s' % request_id)
 
@@ -203,76 +491,264 @@ class RequestBroker(HayabusaBase):
         return (host, port)
 
     def get_host_port(self, request_id):
-        host = self.requests[request_id]['host']
-        port = self.requests[request_id]['port']
-        return (host, port)
+        record = self.requests.get(request_id)
+        if not record:
+            raise HayabusaError('Unknown Request ID: %s' % request_id)
+        return (record.host, record.port)
+
+    # 'user:weight, ...' (the other users: 1)
+    def parse_user_weights(self, value):
+        weights = {}
+        for item in value.split(','):
+            if not item.strip():
+                continue
+            try:
+                user, weight = item.split(':')
+                weights[user.strip()] = float(weight)
+            except ValueError:
+                raise HayabusaError('Invalid user-weights: %s' % value)
+        return weights
+
+    # Requests for short time periods are interactive.
+    def request_priority(self, start_time, end_time):
+        minutes = (end_time - start_time).total_seconds() / 60.0
+        if minutes <= self.interactive_period:
+            return INTERACTIVE
+        return BATCH
+
+    def wake_dispatcher(self):
+        self.push(self.DISPATCHER_ADDRESS, {})
+
+    # Workers send a 'ready' message when they are free, and the
+    # dispatcher sends them the next command of the scheduler.
+    def command_dispatcher(self):
+        self.logger.info('-------------'
+                         ' Starting CommandDispatcher '
+                         '-------------')
+        wake = zmq.Context.instance().socket(zmq.PULL)
+        wake.bind(self.DISPATCHER_ADDRESS)
+        poller = zmq.Poller()
+        poller.register(self.sender, zmq.POLLIN)
+        poller.register(wake, zmq.POLLIN)
+        while True:
+            try:
+                for ready, _ in poller.poll():
+                    if ready is wake:
+                        wake.recv()
+                    else:
+                        self.worker_message(*self.sender.recv_multipart())
+                self.dispatch()
+            except Exception as e:
+                unexpected_error(self.logger, 'CommandDispatcher', e)
+
+    # A worker process offers itself to all the request broker processes
+    # when it is free ('ready', a credit for a command), and withdraws
+    # the offers when it gets a command from one of them ('withdraw'),
+    # so commands do not wait in a busy process.
+    # A 'ready' means that the process finished the command sent to it,
+    # and the first 'ready' of a process ('start') that the command sent
+    # to the process before its restart was lost.
+    # Idle processes repeat their offers ('renew'), so that a restarted
+    # request broker process learns about them; repeated offers of an
+    # idle process are ignored.
+    def worker_message(self, identity, data):
+        try:
+            message = json.loads(data)
+            worker = message['worker']
+        except (ValueError, KeyError):
+            self.logger.error('Invalid Worker Message: %s', data)
+            return
+        if message.get('type') == 'withdraw':
+            self.idle_workers = deque(entry for entry in self.idle_workers
+                                      if entry[0] != identity)
+            return
+        host = message.get('host', worker)
+        self.worker_hosts[host] = time.time()
+        if message.get('start'):
+            self.requeue_outstanding(worker)
+        elif not message.get('renew'):
+            with self.outstanding_lock:
+                self.outstanding.pop(worker, None)
+        if any(entry[0] == identity for entry in self.idle_workers):
+            return
+        self.idle_workers.append((identity, worker, host))
+
+    def dispatch(self):
+        while self.idle_workers:
+            if self.pending is None:
+                self.pending = self.scheduler.next()
+                if self.pending is None:
+                    return
+            command = self.pending[2]
+            entry = self.idle_worker(command)
+            self.idle_workers.remove(entry)
+            identity, worker, _ = entry
+            if self.send_to_worker(identity, worker, command):
+                with self.outstanding_lock:
+                    self.outstanding[worker] = self.pending
+                self.notify_status(command['id'], Status.RW_SentCommand,
+                                   command)
+                self.pending = None
+
+    # The hash ring of the hosts which asked for commands in the last
+    # 'worker-lifetime' seconds (rebuilt when they change).
+    def worker_ring(self):
+        now = time.time()
+        hosts = frozenset(host for host, last in self.worker_hosts.items()
+                          if now - last < self.worker_lifetime)
+        if self.hash_ring is None or self.hash_ring[0] != hosts:
+            self.hash_ring = (hosts, HashRing(sorted(hosts),
+                                              self.affinity_points))
+        return self.hash_ring[1]
+
+    # An idle worker process of the preferred host of the partitions of
+    # the command, or any idle worker process if the processes of the
+    # host are all busy.
+    def idle_worker(self, command):
+        if not self.affinity_points:
+            return self.idle_workers[0]
+        host = self.worker_ring().command_host(command)
+        for entry in self.idle_workers:
+            if entry[2] == host:
+                self.affinity_hits += 1
+                return entry
+        self.affinity_misses += 1
+        return self.idle_workers[0]
+
+    def requeue_outstanding(self, worker):
+        with self.outstanding_lock:
+            entry = self.outstanding.pop(worker, None)
+        if entry is None:
+            return
+        user, priority, command = entry
+        record = self.requests.get(command['id'])
+        if not record or record.status in CompletedStatus:
+            return
+        self.logger.info('%s - requeued command #%s of %s', command['id'],
+                         command['index'], worker)
+        self.scheduler.requeue(user, command['id'], priority, command)
+
+    # Returns False if the worker is gone.
+    def send_to_worker(self, identity, worker, message):
+        try:
+            self.sender.send_multipart([identity,
+                                        json.dumps(message).encode()])
+        except zmq.ZMQError as e:
+            self.logger.error('Cannot Send Command: %s, %s', worker, e)
+            return False
+        return True
 
     def result_collector(self):
         self.logger.info('-------------'
                          ' Starting ResultCollector '
                          '-------------')
-        message = {}
-        results = {}
-        progress = {}
-
         while True:
             try:
                 message = self.receiver.recv_json()
-                request_id = message['id']
-                self.logger.debug('ResultCollector')
-                self.check_request_id(request_id)
-                if message['type'] == 'timeout_error':
-                    self.update_status(request_id, Status.RC_TimeoutError,
-                                       message)
-                    if results.get(request_id):
-                        del results[request_id]
-                    if progress.get(request_id):
-                        del progress[request_id]
-                    self.send_result(request_id, message, update_status=False)
-                    continue
-
-                num_commands = message['commands']
-                if not results.get(request_id):
-                    results[request_id] = []
-                    progress[request_id] = []
-                    for _ in range(num_commands):
-                        results[request_id].append(None)
-                        progress[request_id].append(None)
-                index = message['index']
-                if message['type'] == 'notice':
-                    self.notify_status(request_id, Status.RW_ReceivedCommand,
-                                       message)
-                    progress[request_id][index] = message['worker']
-                    self.update_status(request_id, Status.WR_CollectingResults,
-                                       message, data=progress[request_id])
-                    self.log_progress(progress)
-                    continue
-
-                results[request_id][index] = message
-                progress[request_id][index] = 'completed-' + message['worker']
-                log_message = self.log_filter(message)
-                self.notify_status(request_id, Status.WR_ReceivedResult,
-                                   log_message)
-                num_results = len([r for r in results[request_id] if r])
-                label = '[%d/%d] #%d' % (num_results, num_commands, index)
-                self.update_status(request_id, Status.WR_CollectingResults,
-                                   label, data=progress[request_id])
-                if num_results == num_commands:
-                    self.update_status(request_id,
-                                       Status.WR_ReceivedAllResults,
-                                       log_message)
-                    sum = message['sum']
-                    result = self.consolidate_result(request_id, sum,
-                                                     results[request_id])
+            except Exception as e:
+                unexpected_error(self.logger, 'ResultCollector', e)
+                continue
+            self.collect_result(message)
+
+    # Collects notices and results of the workers, and sends the result
+    # to the client when all the results of the request are received.
+    def collect_result(self, message):
+        results = self.results
+        progress = self.progress
+        try:
+            # the results of the commands of a cancelled leader go to
+            # the promoted follower
+            request_id = self.promoted.get(message['id'], message['id'])
+            self.logger.debug('ResultCollector')
+            self.check_request_id(request_id)
+            if message['type'] in ('timeout_error', 'cancel_error'):
+                status = Status[message['message']]
+                if message['type'] == 'cancel_error' and \
+                   self.promote(request_id):
+                    # the commands keep running for the followers
+                    self.update_status(request_id, status, message)
+                    self.close_stream(request_id)
+                    self.send_result(request_id, message,
+                                     update_status=False)
+                    return
+                self.update_status(request_id, status, message)
+                if results.get(request_id):
                     del results[request_id]
+                if progress.get(request_id):
                     del progress[request_id]
-                    self.send_result(request_id, result, update_status=True)
+                commands_id = self.release_commands(request_id)
+                dropped = self.scheduler.cancel(commands_id)
+                self.logger.debug('%s - dropped commands: %s', request_id,
+                                  dropped)
+                self.cancel_commands(commands_id)
+                self.close_stream(request_id)
+                self.send_result(request_id, message, update_status=False)
+                # the followers fail with a timed out leader (or a
+                # cancelled leader without followers still waiting)
+                self.fan_out(request_id, message, status,
+                             update_status=False)
+                return
+
+            if message['type'] == 'chunk':
+                self.forward_chunk(request_id, message)
+                return
+
+            num_commands = message['commands']
+            if not results.get(request_id):
+                results[request_id] = []
+                progress[request_id] = []
+                for _ in range(num_commands):
+                    results[request_id].append(None)
+                    progress[request_id].append(None)
+            index = message['index']
+            if message['worker'] != self.CACHE_WORKER:
+                self.workers[message['worker']] = time.time()
+            if 'partition_cache' in message:
+                self.partition_cache_stats[message['worker']] = \
+                    message.pop('partition_cache')
+            if message['type'] == 'notice':
+                self.notify_status(request_id, Status.RW_ReceivedCommand,
+                                   message)
+                progress[request_id][index] = message['worker']
+                self.update_status(request_id, Status.WR_CollectingResults,
+                                   message, data=progress[request_id])
                 self.log_progress(progress)
-            except HayabusaError as e:
-                self.logger.error(str(e))
-                self.ignore_result(message)
-            except Exception as e:
-                unexpected_error(self.logger, 'ResultCollector', e)
+                return
+
+            results[request_id][index] = message
+            self.cache_result(message)
+            self.memoize_counts(message)
+            if message.get('stream'):
+                self.stream_tail(request_id, message)
+            progress[request_id][index] = 'completed-' + message['worker']
+            log_message = self.log_filter(message)
+            self.notify_status(request_id, Status.WR_ReceivedResult,
+                               log_message)
+            num_results = len([r for r in results[request_id] if r])
+            label = '[%d/%d] #%d' % (num_results, num_commands, index)
+            self.update_status(request_id, Status.WR_CollectingResults,
+                               label, data=progress[request_id])
+            if num_results == num_commands:
+                self.update_status(request_id,
+                                   Status.WR_ReceivedAllResults,
+                                   log_message)
+                sum = message['sum']
+                result = self.consolidate_result(request_id, sum,
+                                                 results[request_id])
+                del results[request_id]
+                del progress[request_id]
+                self.release_commands(request_id)
+                self.close_stream(request_id)
+                self.send_result(request_id, result, update_status=True)
+                self.fan_out(request_id, result,
+                             Status.WR_ReceivedAllResults,
+                             update_status=True)
+            self.log_progress(progress)
+        except HayabusaError as e:
+            self.logger.error(str(e))
+            self.ignore_result(message)
+        except Exception as e:
+            unexpected_error(self.logger, 'ResultCollector', e)
 
     def consolidate_result(self, request_id, sum_option, data):
         result = {}
@@ -292,14 +768,18 @@ class RequestBroker(HayabusaBase):
                 result['stdout'] += r['stdout']
             result['stderr'] += r['stderr']
             result['exit_status'] += r['exit_status']
+        if data and data[0].get('stream'):
+            # the client received the rows in the chunks
+            result['chunks'] = [r.get('chunks', 0) for r in data]
         if sum_option:
             sum_value = sum(sum_values)
             self.logger.debug('%s - sum: %s, values: %s',
                               request_id, sum_value, sum_values)
             result['stdout'] = str(sum_value)
 
-        # '| awk \'{m+=$1} END{print m;}' does not return non zero exit status.
-        # But it returns standard errors.
+        # the partitions which cannot be opened (eg: removed by the
+        # compactor after the command was planned) fail with the error
+        # of sqlite3 (see QueryEngine.search)
         if 'unable to open database' in result['stderr']:
             result['stderr'] = 'Error: unable to open database file(s)'
         elif len(result['stderr']) > self.max_stderr_length:
@@ -307,6 +787,60 @@ class RequestBroker(HayabusaBase):
                                + '...'
         return result
 
+    # The chunks of the rows of streamed requests go to the client as
+    # they are received (the client puts them in order), with a socket
+    # for each request. If the client does not take them in
+    # 'stream-timeout' seconds, the request is cancelled.
+    # Returns the sender of the chunks of the request (None: stalled).
+    def stream_socket(self, request_id):
+        if request_id in self.streams:
+            return self.streams[request_id]
+        host, port = self.get_host_port(request_id)
+        timeout = int(self.stream_timeout * 1000)
+        sender = self.stream_context.socket(zmq.PUSH)
+        sender.setsockopt(zmq.SNDHWM, self.STREAM_HWM)
+        sender.setsockopt(zmq.SNDTIMEO, timeout)
+        sender.setsockopt(zmq.LINGER, timeout)
+        sender.connect('tcp://%s:%s' % (host, port))
+        self.streams[request_id] = self.chunk_sender(sender)
+        return self.streams[request_id]
+
+    def chunk_sender(self, socket):
+        return ChunkSender(socket)
+
+    def forward_chunk(self, request_id, chunk):
+        sender = self.stream_socket(request_id)
+        if sender is None:
+            return
+        if sender.stalled:
+            self.stream_stalled(request_id)
+            return
+        sender.send(chunk)
+
+    # The rest of the rows of a command is its last chunk, so that the
+    # result collector does not keep the rows of streamed requests.
+    def stream_tail(self, request_id, message):
+        seq = message.get('chunks', 0)
+        self.forward_chunk(request_id, {'id': request_id, 'type': 'chunk',
+                                        'index': message['index'],
+                                        'seq': seq, 'last': True,
+                                        'stdout': message['stdout']})
+        message['chunks'] = seq + 1
+        message['stdout'] = ''
+
+    def stream_stalled(self, request_id):
+        self.close_stream(request_id)
+        # the other chunks are dropped
+        self.streams[request_id] = None
+        record = self.requests.get(request_id)
+        if record and record.status not in CompletedStatus:
+            self.cancel_request(request_id, record, 'Result Stream Stalled')
+
+    def close_stream(self, request_id):
+        sender = self.streams.pop(request_id, None)
+        if sender is not None:
+            sender.close()
+
     def send_result(self, request_id, message, update_status):
         host, port = self.get_host_port(request_id)
         args = (request_id, host, port, message, update_status)
@@ -314,14 +848,15 @@ class RequestBroker(HayabusaBase):
         th.setDaemon(True)
         th.start()
 
-    def port_check(self, host, port):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(1.0)
-        try:
-            result = sock.connect_ex((host, port))
-        except socket.error as e:
-            self.logger.error('Cannot Connect %s, %s, %s' % (host, port, e))
-            return False
+    def port_check(self, host, port, timeout=1.0):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            try:
+                result = sock.connect_ex((host, port))
+            except socket.error as e:
+                self.logger.error('Cannot Connect %s, %s, %s' %
+                                  (host, port, e))
+                return False
         if result != 0:
             return False
         return True
@@ -369,33 +904,14 @@ class RequestBroker(HayabusaBase):
         try:
             if req.path.find('/v1/health_check') == 0:
                 self.logger.debug('path: %s', req.path)
-                resp.media = {'status': 'ok'}
+                resp.media = self.health_status()
             elif req.path.find('/v1/status/') == 0:
                 body = req.stream.read()
                 data = self.load_post_data(body)
                 log_message = {'data': self.log_filter(data)}
                 self.logger.debug('path: %s, body: %s', req.path, log_message)
                 auth_user = self.authenticate(data)
-                if request_id:
-                    if self.requests.get(request_id):
-                        user = self.requests[request_id]['user']
-                        if auth_user != user:
-                            raise BadRequest('Permission Denied: %s' %
-                                             auth_user)
-                        status = self.requests[request_id]['status']
-                        data = self.requests[request_id]['data']
-                        created = self.requests[request_id]['created']
-                        updated = self.requests[request_id]['updated']
-                        res = {'id': request_id, 'status': status.name,
-                               'data': data,
-                               'updated': updated.isoformat(),
-                               'created': created.isoformat()}
-                        self.logger.debug('status response: %s', res)
-                        resp.media = res
-                    else:
-                        raise BadRequest('Invalid Request ID: %s' % request_id)
-                else:
-                    raise BadRequest('Invalid Parameters')
+                resp.media = self.request_status(request_id, auth_user)
             else:
                 resp.status = falcon.HTTP_404
         except HayabusaError as e:
@@ -403,6 +919,63 @@ class RequestBroker(HayabusaBase):
         except Exception as e:
             self.internal_server_error(resp, e, log_message)
 
+    def on_delete_request(self, req, resp, request_id):
+        log_message = ''
+        try:
+            body = req.stream.read()
+            data = self.load_post_data(body)
+            log_message = {'data': self.log_filter(data)}
+            self.logger.debug('path: %s, body: %s', req.path, log_message)
+            auth_user = self.authenticate(data)
+            resp.media = self.cancel(request_id, auth_user)
+        except HayabusaError as e:
+            self.hayabusa_error(resp, e, log_message)
+        except Exception as e:
+            self.internal_server_error(resp, e, log_message)
+
+    # Returns the record of the request of the user.
+    def user_request(self, request_id, auth_user):
+        if not request_id:
+            raise BadRequest('Invalid Parameters')
+        record = self.requests.get(request_id)
+        if not record:
+            raise BadRequest('Invalid Request ID: %s' % request_id)
+        if auth_user != record.user:
+            raise BadRequest('Permission Denied: %s' % auth_user)
+        return record
+
+    def cancel(self, request_id, auth_user):
+        record = self.user_request(request_id, auth_user)
+        if record.status in CompletedStatus:
+            raise BadRequest('Completed Request: %s, %s' %
+                             (request_id, record.status))
+        self.cancel_request(request_id, record,
+                            'Cancelled by %s' % auth_user)
+        return {'id': request_id,
+                'status': Status.RC_CancelledRequest.name}
+
+    # the commands waiting for workers, and running on workers, and the
+    # counters of the partition caches of the workers
+    def health_status(self):
+        partition_cache = {'hits': 0, 'misses': 0, 'evictions': 0}
+        for stats in list(self.partition_cache_stats.values()):
+            for key in partition_cache:
+                partition_cache[key] += stats.get(key, 0)
+        return {'status': 'ok', 'queued_commands': len(self.scheduler),
+                'running_commands': len(self.outstanding),
+                'affinity_hits': self.affinity_hits,
+                'affinity_misses': self.affinity_misses,
+                'partition_cache': partition_cache}
+
+    def request_status(self, request_id, auth_user):
+        record = self.user_request(request_id, auth_user)
+        res = {'id': request_id, 'status': record.status.name,
+               'data': record.data,
+               'updated': record.updated.isoformat(),
+               'created': record.created.isoformat()}
+        self.logger.debug('status response: %s', res)
+        return res
+
     def on_post(self, req, resp):
         log_message = ''
         request_id = str(uuid.uuid1())
@@ -445,27 +1018,46 @@ class RequestBroker(HayabusaBase):
         except KeyError:
             error = 'Invalid Authentication Information'
             raise BadRequest(error)
+        self.check_users()
         try:
             password_hash = self.users[user]
         except KeyError:
             message = "Invalid User: '%s'" % user
             self.error_log(message, data)
             raise auth_error
+        # only successful verifications are cached,
+        # so wrong passwords are always hashed
+        if self.auth_cache is not None and \
+           self.auth_cache.verified(user, password, password_hash):
+            return user
         if not bcrypt.checkpw(password.encode(), password_hash.encode()):
             message = "Password Mismatch: '%s'" % user
             self.error_log(message, data)
             raise auth_error
+        if self.auth_cache is not None:
+            self.auth_cache.add(user, password, password_hash)
         return user
 
+    # Returns the first and the last minutes of the time period,
+    # and the exact time period if it is given with seconds.
     def parse_time_period(self, start_time_str, end_time_str):
         try:
             start_time = parse_start_time(start_time_str)
             end_time = parse_end_time(end_time_str)
         except ValueError:
             error = 'Invalid Time Period: %s - %s ' \
-                    '(format: YYYY-MM-DD [hh:mm] - YYYY-MM-DD [hh:mm])'
+                    '(format: YYYY-MM-DD [hh:mm[:ss]] - ' \
+                    'YYYY-MM-DD [hh:mm[:ss]])'
             raise BadRequest(error % (start_time_str, end_time_str))
 
+        ts_range = None
+        if has_seconds(start_time_str) or has_seconds(end_time_str):
+            if not has_seconds(end_time_str):
+                end_time = end_time.replace(second=59)
+            ts_range = (start_time, end_time)
+            start_time = start_time.replace(second=0)
+            end_time = end_time.replace(second=0)
+
         if start_time > end_time:
             message = 'Invalid Time Period: %s - %s' \
                       % (start_time, end_time)
@@ -476,9 +1068,196 @@ class RequestBroker(HayabusaBase):
             message = 'Too Long Time Period: %sdays ' \
                       '(Max: %sdays)' % (days, self.max_search_days)
             raise BadRequest(message)
-        return (start_time, end_time)
+        return (start_time, end_time, ts_range)
+
+    # 'host' and 'port' are the client's address,
+    # so the fields of the syslog headers have the prefix 'log_'.
+    def parse_filters(self, data):
+        filters = {}
+        for field in ('host', 'program'):
+            value = data.get('log_' + field)
+            if value:
+                filters[field] = value
+        severity = data.get('log_severity')
+        if severity not in (None, ''):
+            try:
+                filters['severity'] = parse_severity(severity)
+            except ValueError as e:
+                raise BadRequest(str(e))
+        return filters
 
     def send_command(self, data):
+        request_id = data['id']
+        sum, priority, messages = self.command_messages(data)
+        if not messages:
+            self.no_partitions(request_id, sum)
+            return
+        if self.coalesce(data):
+            return
+        messages = [message for message in messages
+                    if not self.cached_result(message)]
+        self.scheduler.add(data['user'], request_id, priority, messages)
+        self.wake_dispatcher()
+        log_message = self.log_filter(data)
+        self.notify_status(request_id, Status.RW_SentAllCommands, log_message)
+
+    # A request with the same parameters as a request in flight (the
+    # leader) waits for the result of the leader instead of sending
+    # the commands again.
+    # Returns True if the request follows a leader.
+    def coalesce(self, data):
+        request_id = data['id']
+        # the chunks of streamed requests are not sent to the followers
+        if self.streamed(data):
+            return False
+        key = json.dumps([data.get(field)
+                          for field in self.COALESCE_FIELDS])
+        with self.coalesce_lock:
+            leader = self.inflight.get(key)
+            if leader is None:
+                self.inflight[key] = request_id
+                self.leaders[request_id] = key
+                self.followers[request_id] = []
+                return False
+            self.followers[leader].append(request_id)
+        self.logger.debug('%s - coalesced with %s', request_id, leader)
+        self.update_status(request_id, Status.RW_SentAllCommands,
+                           'Coalesced: %s' % leader)
+        return True
+
+    # Returns the followers of a leader, which is no longer in flight.
+    def release(self, request_id):
+        with self.coalesce_lock:
+            key = self.leaders.pop(request_id, None)
+            if key is None:
+                return []
+            del self.inflight[key]
+            return self.followers.pop(request_id)
+
+    # A cancelled leader hands its commands over to its first follower
+    # still waiting, and the other followers follow it.
+    # Returns the new leader (None: no followers).
+    def promote(self, request_id):
+        with self.coalesce_lock:
+            followers = [follower for follower in
+                         self.followers.get(request_id, [])
+                         if self.waiting(follower)]
+            if not followers:
+                return None
+            key = self.leaders.pop(request_id)
+            del self.followers[request_id]
+            leader = followers[0]
+            self.inflight[key] = leader
+            self.leaders[leader] = key
+            self.followers[leader] = followers[1:]
+        self.promoted[self.release_commands(request_id)] = leader
+        for store in (self.results, self.progress):
+            if request_id in store:
+                store[leader] = store.pop(request_id)
+        self.logger.info('%s - promoted to the leader of %s', leader,
+                         request_id)
+        return leader
+
+    def waiting(self, request_id):
+        record = self.requests.get(request_id)
+        return record is not None and record.status not in CompletedStatus
+
+    # Returns the ID of the commands of a request (the cancelled leader
+    # it was promoted from, or itself), which are no longer followed.
+    def release_commands(self, request_id):
+        for commands_id, leader in list(self.promoted.items()):
+            if leader == request_id:
+                del self.promoted[commands_id]
+                return commands_id
+        return request_id
+
+    # Sends the result (or the error) of a leader to its followers.
+    def fan_out(self, request_id, result, status, update_status):
+        for follower in self.release(request_id):
+            record = self.requests.get(follower)
+            if not record or record.status in CompletedStatus:
+                # timed out by itself
+                continue
+            self.update_status(follower, status, 'Coalesced: %s' %
+                               request_id)
+            self.send_result(follower, dict(result, id=follower),
+                             update_status=update_status)
+
+    # Commands whose results are in the result cache, and the memoized
+    # counts are not sent to the workers: the result collector receives
+    # the results from this process.
+    def cached_result(self, message):
+        if 'memoized' in message:
+            stdout = self.memoized_stdout(message['memoized'],
+                                          message['sum'])
+        elif self.result_cache is not None and message.get('cache_key'):
+            stdout = self.result_cache.get(message['cache_key'])
+        else:
+            return False
+        if stdout is None:
+            return False
+        result = dict(message, type='result', worker=self.CACHE_WORKER,
+                      stdout=stdout, stderr='', exit_status=0,
+                      elapsed_time=0.0)
+        self.logger.debug('%s - cached result #%s', message['id'],
+                          message['index'])
+        self.loopback(result)
+        return True
+
+    def cache_result(self, message):
+        if self.result_cache is None or not message.get('cache_key') or \
+           message['worker'] == self.CACHE_WORKER:
+            return
+        # the rows of streamed results are not all in the message
+        if message['exit_status'] == 0 and not message['stderr'] and \
+           not message.get('chunks'):
+            self.result_cache.put(message['cache_key'], message['stdout'])
+
+    # The counts of the partitions in the standard output of a worker:
+    # the sum, or a count for each partition.
+    def memoized_stdout(self, counts, sum_option):
+        if sum_option:
+            return '%d\n' % sum(counts)
+        return ''.join('%d\n' % count for count in counts)
+
+    def memoize_counts(self, message):
+        if self.count_store is None or not message.get('partition_counts'):
+            return
+        if message['exit_status'] == 0 and not message['stderr']:
+            self.count_store.put_many(message['partition_counts'])
+
+    # Splits a group of whole partitions into the counts in the count
+    # store, and a group of the other partitions (or None).
+    # Returns (group, count keys of the group, counts).
+    def memoized_counts(self, user, group, match, exact, filters):
+        paths = group.paths.split(' ')
+        keys = [count_key(user, match, exact, filters, group.version,
+                          path, identity)
+                for path, identity in zip(paths, group.identity)]
+        counts = self.count_store.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in counts]
+        known = [counts[key] for key in keys if key in counts]
+        if not missing:
+            return (None, [], known)
+        group = group._replace(
+            paths=' '.join(paths[i] for i in missing),
+            identity=tuple(group.identity[i] for i in missing))
+        return (group, [keys[i] for i in missing], known)
+
+    def no_partitions(self, request_id, sum):
+        self.update_status(request_id, Status.WR_ReceivedAllResults,
+                           'No Partitions')
+        result = self.consolidate_result(request_id, sum, [])
+        self.send_result(request_id, result, update_status=True)
+
+    # The rows of a request are sent to the client in chunks ('stream'),
+    # but counts are sent in the result.
+    def streamed(self, data):
+        return bool(data.get('stream')) and not data.get('count')
+
+    # Returns the 'sum' option, the priority class of the request and the
+    # command messages to the workers.
+    def command_messages(self, data):
         request_id = data['id']
         try:
             user = data['user']
@@ -499,58 +1278,315 @@ class RequestBroker(HayabusaBase):
             if empty_re.match(match):
                 match = None
 
-        start_time, end_time = \
+        start_time, end_time, ts_range = \
             self.parse_time_period(start_time_str, end_time_str)
+        filters = self.parse_filters(data)
+        if ts_range:
+            filters['ts_range'] = ts_range
 
         cmds = self.generate_commands(user, start_time, end_time,
-                                      match, count, sum, exact)
-        num_commands = len(cmds)
+                                      match, count, sum, exact, filters)
+        # no messages if there are no partitions in the time period
+        stream = self.streamed(data)
+        messages = []
         for i, cmd in enumerate(cmds):
-            message = {'id': request_id, 'command': cmd, 'sum': sum,
-                       'index': i, 'commands': num_commands}
-            self.sender.send_json(message)
-            self.notify_status(request_id, Status.RW_SentCommand, message)
-        log_message = self.log_filter(data)
-        self.notify_status(request_id, Status.RW_SentAllCommands, log_message)
+            message = {'id': request_id, 'index': i,
+                       'commands': len(cmds), 'reply_to': self.reply_to}
+            message.update(cmd)
+            if stream:
+                message['stream'] = True
+            messages.append(message)
+        return (sum, self.request_priority(start_time, end_time), messages)
+
+    # Notice:
+    # This string-escaping is not enough safe for a production use.
+    # Use a safer way for it.
+    def escape(self, value):
+        return re.sub("'", "''", value)
+
+    # Structured partitions filter the LOG table by its columns first,
+    # and then by the full text search.
+    def structured_conditions(self, time_range, filters):
+        conditions = []
+        if time_range:
+            start, end = time_range
+            conditions.append("minute between '%s' and '%s'" %
+                              (minute_str(start), minute_str(end)))
+        ts_range = filters.get('ts_range')
+        if ts_range:
+            start, end = ts_range
+            conditions.append("ts between '%s' and '%s'" %
+                              (start.strftime(TS_FORMAT),
+                               end.strftime(TS_FORMAT)))
+        for field in ('host', 'program'):
+            if filters.get(field):
+                conditions.append("%s = '%s'" %
+                                  (field, self.escape(filters[field])))
+        if filters.get('severity') is not None:
+            conditions.append('severity <= %d' % filters['severity'])
+        return conditions
 
-    def generate_sql(self, match, count, exact):
+    # Other partitions only have the lines (and the 'minute' column if
+    # compacted), so the host and the program are matched in the syslog
+    # headers, the severity is unknown (no line matches),
+    # and the time period is applied by the minute.
+    def legacy_conditions(self, time_range, filters):
+        conditions = []
+        if time_range:
+            start, end = time_range
+            conditions.append("minute between '%s' and '%s'" %
+                              (minute_str(start), minute_str(end)))
+        if filters.get('host'):
+            conditions.append("logs like '%%:__ %s %%'" %
+                              self.escape(filters['host']))
+        if filters.get('program'):
+            program = self.escape(filters['program'])
+            conditions.append("(logs like '%% %s[%%' or logs like '%% %s:%%')"
+                              % (program, program))
+        if filters.get('severity') is not None:
+            conditions.append('0')
+        return conditions
+
+    def generate_sql(self, match, count, exact, storage_format,
+                     time_range=None, filters=None):
+        filters = filters or {}
         if count:
             column = 'count(*)'
         else:
-            column = '*'
-
-        if not match:
-            return 'select %s from syslog' % column
-
-        # Notice:
-        # This string-escaping is not enough safe for a production use.
-        # Use a safer way for it.
-        escaped_match = re.sub("'", "''", match)
-        if exact:
-            sql = '''select %s from syslog where logs match '"%s"';''' % \
-                  (column, escaped_match)
+            column = 'logs'
+
+        if match:
+            match_expression = storage_format.match_expression(match, exact)
+            match_condition = "logs match '%s'" % self.escape(match_expression)
+
+        if storage_format.version == STRUCTURED:
+            sql = 'select %s from log' % column
+            conditions = self.structured_conditions(time_range, filters)
+            if match:
+                conditions.append('id in (select rowid from syslog where %s)'
+                                  % match_condition)
         else:
-            sql = '''select %s from syslog where logs match '%s';''' % \
-                  (column, escaped_match)
-        return sql
+            sql = 'select %s from syslog' % column
+            conditions = self.legacy_conditions(time_range, filters)
+            if match:
+                conditions.insert(0, match_condition)
+
+        if conditions:
+            sql += ' where ' + ' and '.join(conditions)
+        return sql + ';'
+
+    # The number of commands to split a request into: the worker
+    # processes which sent notices or results recently (or the worker
+    # processes of a host if none did yet), unless configured.
+    def num_shards(self):
+        if self.shards:
+            return self.shards
+        now = time.time()
+        live = [worker for worker, last in list(self.workers.items())
+                if now - last < self.worker_lifetime]
+        return len(live) or self.worker_processes
 
-    def generate_db_file_paths(self, user, start_time, end_time):
+    def generate_partition_plan(self, user, start_time, end_time):
         base_dir = os.path.join(self.store_dir, user)
-        paths = db_file_path(base_dir, start_time, end_time)
-        return paths
+        return partition_plan(base_dir, start_time, end_time)
 
-    def generate_commands(self, user, start_time, end_time,
-                          match, count, sum, exact):
+    # A command runs the SQL on each partition of the paths.
+    # Workers skip the partitions whose bloom filters do not have
+    # all the phrases.
+    # Partitions are 'immutable' if the catalog lists them (published
+    # partitions never change, they are only replaced by renaming).
+    def generate_command(self, paths, sql, count, sum, phrases=None,
+                         immutable=False):
+        return {'paths': paths, 'sql': sql, 'count': count, 'sum': sum,
+                'phrases': phrases or [], 'immutable': immutable}
+
+    def generate_group_command(self, group, group_format, match, count,
+                               sum, exact, phrases, filters,
+                               immutable=False):
+        sql = self.generate_sql(match, count, exact, group_format,
+                                group.time_range, filters)
+        # FTS3 partitions do not have bloom filters
+        if group_format.version == FTS3:
+            phrases = None
+        return self.generate_command(group.paths, sql, count, sum, phrases,
+                                     immutable)
 
-        paths = self.generate_db_file_paths(user, start_time, end_time)
-        sql = self.generate_sql(match, count, exact)
+    def generate_commands(self, user, start_time, end_time,
+                          match, count, sum, exact, filters=None):
+        store_dir = os.path.join(self.store_dir, user)
+        phrases = required_phrases(match, exact)
+        args = (match, count, sum, exact, phrases, filters)
 
         cmds = []
-        # 'shlex.quote' turns str into a safe token in a shell command line.
-        quoted_sql = shlex.quote(sql)
-        for path in paths:
-            cmd = 'parallel sqlite3 ::: %s ::: %s' % (path, quoted_sql)
-            if count and sum:
-                cmd += " | awk '{m+=$1} END{print m;}'"
-            cmds.append(cmd)
+        # The catalog has the existing partitions and their formats.
+        if catalog_exists(store_dir):
+            check_time_period(start_time, end_time)
+            with PartitionCatalog(store_dir, readonly=True) as catalog:
+                plan = catalog.plan(start_time, end_time)
+            memoized = []
+            # (group, count keys of the group)
+            groups = []
+            for group in [group for groups in plan for group in groups]:
+                keys = None
+                # whole partitions have counts in the count store
+                if count and self.count_store is not None and \
+                   group.time_range is None:
+                    group, keys, known = self.memoized_counts(
+                        user, group, match, exact, filters)
+                    memoized += known
+                    if group is None:
+                        continue
+                groups.append((group, keys))
+            shards = shard_groups([group for group, _ in groups],
+                                  self.num_shards())
+            for (_, keys), group_shards in zip(groups, shards):
+                for group, piece in group_shards:
+                    cmd = self.generate_group_command(
+                        group, StorageFormat(group.version), *args,
+                        immutable=True)
+                    # the counts of periods of partitions are not kept
+                    if keys and group.time_range is None:
+                        cmd['count_keys'] = \
+                            keys[slice(*piece)] if piece else keys
+                    if self.result_cache is not None:
+                        cmd['cache_key'] = result_cache_key(
+                            user, cmd['sql'], sum, cmd['paths'],
+                            group.identity)
+                    cmds.append(cmd)
+            if memoized:
+                cmd = self.generate_command('', None, count, sum)
+                cmd['memoized'] = memoized
+                cmds.append(cmd)
+            return cmds
+
+        # Stores without the catalog:
+        # partitions written in different storage formats need
+        # different SQL, so the time period is split where the format of
+        # the user's store changed.
+        history = load_format_history(store_dir)
+        segments = format_segments(history, start_time, end_time)
+        for seg_start, seg_end, storage_format in segments:
+            plan = self.generate_partition_plan(user, seg_start, seg_end)
+            shards = shard_groups([group for groups in plan
+                                   for group in groups], self.num_shards())
+            for group_shards in shards:
+                for group, _ in group_shards:
+                    # the compactor always writes structured partitions
+                    if group.compacted:
+                        group_format = storage_format.compacted()
+                    else:
+                        group_format = storage_format
+                    cmds.append(self.generate_group_command(
+                        group, group_format, *args))
         return cmds
+
+
+class TestCoalescedRequests(unittest.TestCase):
+
+    class Broker(RequestBroker):
+        # the state of the request broker used by the result collector
+        def __init__(self):
+            self.logger = logging.getLogger('TestCoalescedRequests')
+            self.max_result_log_length = 100
+            self.max_stderr_length = 100
+            self.requests = RequestRegistry()
+            self.results = {}
+            self.progress = {}
+            self.inflight = {}
+            self.leaders = {}
+            self.followers = {}
+            self.promoted = {}
+            self.coalesce_lock = threading.Lock()
+            self.workers = {}
+            self.partition_cache_stats = {}
+            self.streams = {}
+            self.scheduler = CommandScheduler()
+            self.result_cache = None
+            self.count_store = None
+            self.sent = {}
+            self.cancelled = []
+
+        def send_result(self, request_id, message, update_status):
+            self.sent[request_id] = message
+
+        def cancel_commands(self, request_id):
+            self.cancelled.append(request_id)
+
+    def request(self, broker, request_id, count=True, stream=False):
+        broker.create_request('user', request_id, Status.CR_ReceivedRequest,
+                              'localhost', 10000, '')
+        return broker.coalesce({'id': request_id, 'user': 'user',
+                                'match': 'noc', 'count': count,
+                                'stream': stream})
+
+    def result(self, request_id):
+        return {'type': 'result', 'id': request_id, 'commands': 1,
+                'index': 0, 'worker': 'worker', 'sum': True,
+                'stdout': '3', 'stderr': '', 'exit_status': 0}
+
+    def test_cancelled_leader(self):
+        broker = self.Broker()
+        self.assertFalse(self.request(broker, 'leader'))
+        self.assertTrue(self.request(broker, 'follower1'))
+        self.assertTrue(self.request(broker, 'follower2'))
+        broker.collect_result(broker.cancel_message(
+            'leader', 'localhost', 10000, 'Client Disconnected'))
+        self.assertEqual([], broker.cancelled)
+        self.assertEqual(Status.RC_CancelledRequest.name,
+                         broker.sent['leader']['message'])
+        # the results of the commands of the leader
+        broker.collect_result(self.result('leader'))
+        for follower in ('follower1', 'follower2'):
+            self.assertEqual('3', broker.sent[follower]['stdout'])
+            self.assertEqual(follower, broker.sent[follower]['id'])
+        self.assertEqual({}, broker.promoted)
+        self.assertEqual({}, broker.inflight)
+
+    def test_streamed_requests(self):
+        broker = self.Broker()
+        # counts are not streamed (eg: the WebUI)
+        self.request(broker, 'count', stream=True)
+        self.assertTrue(self.request(broker, 'follower', stream=True))
+        self.assertFalse(self.request(broker, 'rows', count=False,
+                                      stream=True))
+        self.assertFalse(self.request(broker, 'rows2', count=False,
+                                      stream=True))
+
+    def test_timed_out_leader(self):
+        broker = self.Broker()
+        self.request(broker, 'leader')
+        self.request(broker, 'follower')
+        broker.collect_result(broker.timeout_message('leader', 'localhost',
+                                                     10000))
+        self.assertEqual(['leader'], broker.cancelled)
+        self.assertEqual(Status.RC_TimeoutError.name,
+                         broker.sent['follower']['message'])
+
+
+class TestRequestMonitor(unittest.TestCase):
+
+    def test_disconnected_requests(self):
+        broker = TestCoalescedRequests.Broker()
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(64)
+            port = listener.getsockname()[1]
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as closed:
+                closed.bind(('127.0.0.1', 0))
+                closed_port = closed.getsockname()[1]
+            for i in range(20):
+                broker.create_request('user', 'listening-%d' % i,
+                                      Status.CR_ReceivedRequest,
+                                      '127.0.0.1', port, '')
+            broker.create_request('user', 'disconnected',
+                                  Status.CR_ReceivedRequest,
+                                  '127.0.0.1', closed_port, '')
+            broker.create_request('user', 'completed', Status.RC_SentResult,
+                                  '127.0.0.1', closed_port, '')
+            self.assertEqual(['disconnected'],
+                             [request_id for request_id, _ in
+                              broker.disconnected_requests()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@ import zmq
 from hayabusa import HayabusaBase
 from hayabusa.constants import Status
 from hayabusa.errors import RESTClientError, RESTResultWaitTimeout
+from hayabusa.result_stream import ChunkWriter
 
 
 class RESTClient(HayabusaBase):
@@ -38,6 +39,8 @@ class RESTClient(HayabusaBase):
             func = requests.get
         elif method == 'post':
             func = requests.post
+        elif method == 'delete':
+            func = requests.delete
         else:
             raise RESTClientError('Error: Invalid Method: %s', method)
 
@@ -66,6 +69,9 @@ class RESTClient(HayabusaBase):
     def get(self, path, data=None):
         return self.request_base('get', path, data=data)
 
+    def delete(self, path, data=None):
+        return self.request_base('delete', path, data=data)
+
     def health_check(self):
         path = '/health_check'
         url = self.request_url(path)
@@ -90,23 +96,55 @@ class RESTClient(HayabusaBase):
         else:
             return receiver.recv_json()
 
+    # Receives the result. With 'output', the rows are requested in
+    # chunks and written to it as they are received (the result has
+    # an empty 'stdout').
+    def receive_result(self, receiver, timeout=None, output=None):
+        data = self.receive_data(receiver, timeout)
+        if output is None:
+            return data
+        writer = ChunkWriter(output)
+        try:
+            while data.get('type') == 'chunk' or 'chunks' in data:
+                if data.get('type') == 'chunk':
+                    writer.add(data)
+                else:
+                    result = data
+                    writer.finish(result['chunks'])
+                if writer.finished():
+                    return result
+                data = self.receive_data(receiver, timeout)
+        finally:
+            writer.close()
+        # not streamed (counts, errors and no partitions)
+        output.write(data['stdout'])
+        data['stdout'] = ''
+        return data
+
     def search(self, user, password, match, start_time, end_time,
-               count, sum, exact, timeout=None):
+               count, sum, exact, timeout=None, filters=None, output=None):
         receiver, host, port = self.listen_random_port()
 
         request_id = self.search_base(user, password, match,
                                       start_time, end_time,
-                                      count, sum, exact, host, port)
+                                      count, sum, exact, host, port,
+                                      filters, stream=output is not None)
 
         try:
-            data = self.receive_data(receiver, timeout)
+            data = self.receive_result(receiver, timeout, output)
             log_message = self.log_filter(data)
             self.logger.debug('[%s] - %s - %s', Status.RC_ReceivedResult,
                               request_id, log_message)
         except RESTResultWaitTimeout as e:
             error = '%s: %s' % (e, request_id)
             self.logger.error(error)
+            self.cancel_quietly(user, password, request_id)
             raise RESTResultWaitTimeout(error)
+        except KeyboardInterrupt:
+            self.cancel_quietly(user, password, request_id)
+            raise
+        finally:
+            receiver.close()
 
         return request_id, data
 
@@ -120,12 +158,19 @@ class RESTClient(HayabusaBase):
         self.logger.error(error)
         raise RESTClientError(error)
 
+    # filters: 'host', 'program' and 'severity' of the syslog headers
+    # stream: the rows are sent in chunks (see receive_result)
     def search_base(self, user, password, match, start_time, end_time,
-                    count, sum, exact, host, port):
+                    count, sum, exact, host, port, filters=None,
+                    stream=False):
         params = {'user': user, 'password': password, 'match': match,
                   'start_time': start_time, 'end_time': end_time,
                   'count': count, 'sum': sum, 'exact': exact,
                   'host': host, 'port': port}
+        if stream:
+            params['stream'] = True
+        if filters:
+            params.update({'log_' + k: v for k, v in filters.items()})
         log_message = self.log_filter(params)
         if self.logger:
             self.logger.debug('Request Parameters: %s', log_message)
@@ -156,6 +201,36 @@ class RESTClient(HayabusaBase):
             raise RESTClientError('Not Found Response with Request ID')
         return request_id
 
+    # Cancels the request: the workers stop searching for it.
+    def cancel(self, user, password, request_id):
+        params = {'user': user, 'password': password}
+        try:
+            res = self.delete('/request/' + request_id, params)
+        except Exception as e:
+            raise RESTClientError('Error: %s' % e)
+
+        if res.status_code != 200:
+            self.response_status_code_error(res.status_code, res.text)
+
+        if not res.text:
+            self.empty_response_error()
+
+        data = res.json()
+        error = data.get('error')
+        if error:
+            raise RESTClientError(error)
+
+        if self.logger:
+            self.logger.debug('%s - %s', request_id, data)
+        return data
+
+    # The result is no longer awaited (the request may have completed).
+    def cancel_quietly(self, user, password, request_id):
+        try:
+            self.cancel(user, password, request_id)
+        except RESTClientError as e:
+            self.logger.debug('Cannot Cancel: %s, %s', request_id, e)
+
     def status(self, user, password, request_id):
         params = {'user': user, 'password': password}
         log_message = self.log_filter(params)
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import threading
+import unittest
+from collections import OrderedDict
+
+
+# The key of the result of a command: the same SQL on the same
+# partitions (paths and identities from the partition catalog) gives
+# the same result, as published partitions never change (they are only
+# replaced by new files, with new identities).
+def result_cache_key(user, sql, sum, paths, identity):
+    data = json.dumps([user, sql, sum, paths, identity])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+# Results (the standard output of the commands) of the request broker,
+# the least recently used are evicted beyond 'max_bytes'.
+class ResultCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self.entries[key] = value
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_result_cache(self):
+        cache = ResultCache(10)
+        cache.put('a', '1234')
+        cache.put('b', '5678')
+        self.assertEqual('1234', cache.get('a'))
+        # 'b' is the least recently used
+        cache.put('c', '90')
+        cache.put('d', '12')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(['a', 'c', 'd'], list(cache.entries))
+        self.assertEqual(8, cache.bytes)
+        cache.put('e', '12345678901')
+        self.assertIsNone(cache.get('e'))
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+    def test_result_cache_key(self):
+        key = result_cache_key('user', 'select count(*) from log;', True,
+                               '/s/2018/08/01/00.db', [[60, 600]])
+        self.assertEqual(key, result_cache_key(
+            'user', 'select count(*) from log;', True,
+            '/s/2018/08/01/00.db', [[60, 600]]))
+        self.assertNotEqual(key, result_cache_key(
+            'user', 'select count(*) from log;', True,
+            '/s/2018/08/01/00.db', [[61, 610]]))
+
+
+if __name__ == '__main__':
+    unittest.main()
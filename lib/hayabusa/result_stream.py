@@ -0,0 +1,109 @@
+import io
+import shutil
+import tempfile
+import unittest
+
+
+# Writes the chunks of a streamed result in the order of the commands.
+# The chunks of the first unfinished command are written as they are
+# received, and the chunks of the later commands are spooled (to
+# temporary files beyond 'spool_size' characters) until the commands
+# before them are finished.
+# A command sent again (its worker process restarted) sends the same
+# chunks again, and the repeated chunks are ignored.
+class ChunkWriter:
+    def __init__(self, output, spool_size=1024 * 1024):
+        self.output = output
+        self.spool_size = spool_size
+        # the command written to the output
+        self.current = 0
+        # {index: spooled chunks}, {index: {received sequence numbers}},
+        # {index: chunks of the command (with the last chunk)}
+        self.spools = {}
+        self.received = {}
+        self.expected = {}
+        # chunks of each command in the result (the final message)
+        self.chunks = None
+
+    def add(self, chunk):
+        index = chunk['index']
+        received = self.received.setdefault(index, set())
+        if chunk['seq'] in received:
+            return
+        received.add(chunk['seq'])
+        if chunk.get('last'):
+            self.expected[index] = chunk['seq'] + 1
+        if index == self.current:
+            self.output.write(chunk['stdout'])
+        else:
+            if index not in self.spools:
+                self.spools[index] = tempfile.SpooledTemporaryFile(
+                    self.spool_size, mode='w+')
+            self.spools[index].write(chunk['stdout'])
+        self.advance()
+
+    # 'chunks' of the result, which may arrive before the last chunks
+    def finish(self, chunks):
+        self.chunks = chunks
+        for index, num_chunks in enumerate(chunks):
+            self.expected[index] = num_chunks
+        self.advance()
+
+    def finished(self):
+        return self.chunks is not None and self.current >= len(self.chunks)
+
+    def advance(self):
+        while self.current in self.expected and \
+                len(self.received.get(self.current, ())) >= \
+                self.expected[self.current]:
+            self.current += 1
+            spool = self.spools.pop(self.current, None)
+            if spool:
+                spool.seek(0)
+                shutil.copyfileobj(spool, self.output)
+                spool.close()
+
+    def close(self):
+        for spool in self.spools.values():
+            spool.close()
+        self.spools.clear()
+
+
+class TestChunkWriter(unittest.TestCase):
+
+    def chunk(self, index, seq, stdout, last=False):
+        return {'index': index, 'seq': seq, 'stdout': stdout, 'last': last}
+
+    def test_chunk_writer(self):
+        output = io.StringIO()
+        writer = ChunkWriter(output, spool_size=4)
+        writer.add(self.chunk(1, 0, 'b0\n'))
+        writer.add(self.chunk(0, 0, 'a0\n'))
+        writer.add(self.chunk(2, 0, 'c0\n', last=True))
+        writer.add(self.chunk(1, 1, 'b1\n', last=True))
+        self.assertEqual('a0\n', output.getvalue())
+        # a command sent again
+        writer.add(self.chunk(0, 0, 'a0\n'))
+        self.assertEqual('a0\n', output.getvalue())
+        writer.add(self.chunk(0, 1, 'a1\n', last=True))
+        writer.add(self.chunk(1, 0, 'b0\n'))
+        self.assertEqual('a0\na1\nb0\nb1\nc0\n', output.getvalue())
+        self.assertFalse(writer.finished())
+        writer.finish([2, 2, 1])
+        self.assertTrue(writer.finished())
+
+    def test_early_result(self):
+        output = io.StringIO()
+        writer = ChunkWriter(output)
+        # commands without rows, and the result before the last chunk
+        writer.finish([1, 1])
+        writer.add(self.chunk(1, 0, '', last=True))
+        self.assertFalse(writer.finished())
+        writer.add(self.chunk(0, 0, 'a0\n', last=True))
+        self.assertTrue(writer.finished())
+        self.assertEqual('a0\n', output.getvalue())
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import threading
+import unittest
+from collections import OrderedDict, deque
+
+
+# priority classes of requests
+INTERACTIVE = 0
+BATCH = 1
+PRIORITIES = (INTERACTIVE, BATCH)
+
+
+# The commands of the requests waiting for free workers.
+# The commands of interactive requests (short time periods, eg: the
+# counts of the search query poller) are dispatched before the others.
+# In a priority class, the users share the workers in proportion to
+# their weights (stride scheduling: the user with the least dispatched
+# commands per weight goes next), and the requests of a user take turns,
+# so a long search does not hold back the other searches.
+class CommandScheduler:
+    def __init__(self, weights=None, default_weight=1.0):
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.lock = threading.Lock()
+        # for each priority class:
+        # {user: OrderedDict({request ID: deque([command, ...])})}
+        self.queues = [{} for _ in PRIORITIES]
+        # the virtual time of each user and of each priority class
+        self.passes = [{} for _ in PRIORITIES]
+        self.clock = [0.0 for _ in PRIORITIES]
+        # {request ID: (priority, user)}
+        self.requests = {}
+        self.size = 0
+
+    def weight(self, user):
+        return self.weights.get(user, self.default_weight)
+
+    # Returns the queues of the requests of a user (with the lock).
+    def user_requests(self, user, priority):
+        users = self.queues[priority]
+        if user not in users:
+            users[user] = OrderedDict()
+            passes = self.passes[priority]
+            # idle users do not save up their share
+            passes[user] = max(passes.get(user, 0.0), self.clock[priority])
+        return users[user]
+
+    def add(self, user, request_id, priority, commands):
+        if not commands:
+            return
+        with self.lock:
+            requests = self.user_requests(user, priority)
+            requests.setdefault(request_id, deque()).extend(commands)
+            self.requests[request_id] = (priority, user)
+            self.size += len(commands)
+
+    # Returns (user, priority, command) of the next command, or None.
+    def next(self):
+        with self.lock:
+            for priority, users in enumerate(self.queues):
+                if not users:
+                    continue
+                passes = self.passes[priority]
+                user = min(users, key=passes.get)
+                requests = users[user]
+                request_id, commands = next(iter(requests.items()))
+                command = commands.popleft()
+                if commands:
+                    requests.move_to_end(request_id)
+                else:
+                    del requests[request_id]
+                    del self.requests[request_id]
+                if not requests:
+                    del users[user]
+                self.clock[priority] = passes[user]
+                passes[user] += 1.0 / self.weight(user)
+                self.size -= 1
+                return (user, priority, command)
+        return None
+
+    # Puts back a command which was not run (eg: the worker was
+    # restarted), so that it goes before the other commands of the user.
+    def requeue(self, user, request_id, priority, command):
+        with self.lock:
+            requests = self.user_requests(user, priority)
+            requests.setdefault(request_id, deque()).appendleft(command)
+            requests.move_to_end(request_id, last=False)
+            self.requests[request_id] = (priority, user)
+            self.size += 1
+
+    # Drops the queued commands of a request.
+    # Returns the number of the dropped commands.
+    def cancel(self, request_id):
+        with self.lock:
+            entry = self.requests.pop(request_id, None)
+            if entry is None:
+                return 0
+            priority, user = entry
+            requests = self.queues[priority][user]
+            commands = requests.pop(request_id)
+            if not requests:
+                del self.queues[priority][user]
+            self.size -= len(commands)
+            return len(commands)
+
+    def __len__(self):
+        return self.size
+
+
+class TestCommandScheduler(unittest.TestCase):
+
+    def drain(self, scheduler):
+        commands = []
+        entry = scheduler.next()
+        while entry is not None:
+            commands.append(entry[2])
+            entry = scheduler.next()
+        return commands
+
+    def test_fair_share(self):
+        scheduler = CommandScheduler()
+        scheduler.add('a', 'a1', BATCH, ['a1-0', 'a1-1', 'a1-2', 'a1-3'])
+        scheduler.add('a', 'a2', BATCH, ['a2-0'])
+        scheduler.add('b', 'b1', BATCH, ['b1-0', 'b1-1'])
+        self.assertEqual(7, len(scheduler))
+        self.assertEqual(['a1-0', 'b1-0', 'a2-0', 'b1-1',
+                          'a1-1', 'a1-2', 'a1-3'], self.drain(scheduler))
+        self.assertEqual(0, len(scheduler))
+
+    def test_weights(self):
+        scheduler = CommandScheduler(weights={'a': 2})
+        scheduler.add('a', 'a1', BATCH, ['a'] * 4)
+        scheduler.add('b', 'b1', BATCH, ['b'] * 4)
+        self.assertEqual(['a', 'b', 'a', 'a', 'b', 'a', 'b', 'b'],
+                         self.drain(scheduler))
+
+    def test_priority(self):
+        scheduler = CommandScheduler()
+        scheduler.add('a', 'a1', BATCH, ['a1-0', 'a1-1'])
+        self.assertEqual(('a', BATCH, 'a1-0'), scheduler.next())
+        scheduler.add('b', 'b1', INTERACTIVE, ['b1-0'])
+        self.assertEqual(['b1-0', 'a1-1'], self.drain(scheduler))
+
+    def test_idle_user(self):
+        scheduler = CommandScheduler()
+        scheduler.add('a', 'a1', BATCH, ['a'] * 3)
+        self.assertEqual(['a', 'a'], [scheduler.next()[2],
+                                      scheduler.next()[2]])
+        # 'b' did not use its share while it was idle
+        scheduler.add('b', 'b1', BATCH, ['b'] * 3)
+        self.assertEqual(['b', 'a', 'b', 'b'], self.drain(scheduler))
+
+    def test_cancel(self):
+        scheduler = CommandScheduler()
+        scheduler.add('a', 'a1', BATCH, ['a1-0', 'a1-1'])
+        scheduler.add('a', 'a2', BATCH, ['a2-0'])
+        self.assertEqual(2, scheduler.cancel('a1'))
+        self.assertEqual(0, scheduler.cancel('a1'))
+        self.assertEqual(['a2-0'], self.drain(scheduler))
+
+    def test_requeue(self):
+        scheduler = CommandScheduler()
+        scheduler.add('a', 'a1', BATCH, ['a1-0', 'a1-1'])
+        scheduler.add('a', 'a2', BATCH, ['a2-0'])
+        user, priority, command = scheduler.next()
+        scheduler.requeue(user, 'a1', priority, command)
+        self.assertEqual(['a1-0', 'a2-0', 'a1-1'], self.drain(scheduler))
+        scheduler.requeue('a', 'a1', BATCH, 'a1-1')
+        self.assertEqual(1, len(scheduler))
+        self.assertEqual(['a1-1'], self.drain(scheduler))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,328 @@
+import json
+import os
+import re
+import sqlite3
+import unittest
+from datetime import datetime, timedelta
+
+from hayabusa.errors import StorageError
+from hayabusa.log_parser import parse_line
+
+
+# Storage format versions of partitions.
+# The version is stored in 'PRAGMA user_version' of each partition.
+# Legacy partitions have user_version 0 and are treated as FTS3.
+# COMPACTED partitions are FTS5 with an extra MINUTE column
+# ('YYYY-MM-DD hh:mm'), the hourly and daily partitions of older compactors.
+# STRUCTURED partitions keep lines in the LOG table with the columns
+# parsed from the syslog headers, and index them with an external content
+# FTS5 table. The compactor always writes STRUCTURED partitions
+# (and 'compactor.py --upgrade' rewrites COMPACTED ones).
+FTS3 = 1
+FTS5 = 2
+COMPACTED = 3
+STRUCTURED = 4
+VERSIONS = (FTS3, FTS5, COMPACTED, STRUCTURED)
+
+FORMAT_NAMES = {'fts3': FTS3, 'fts5': FTS5, 'structured': STRUCTURED}
+TOKENIZERS = ('unicode61', 'trigram')
+
+FORMAT_HISTORY_FILE = 'format_history'
+TIME_FORMAT = '%Y-%m-%d %H:%M'
+
+
+class StorageFormat:
+    def __init__(self, version=FTS3, tokenizer='unicode61', prefix=''):
+        if version not in VERSIONS:
+            raise StorageError('Unknown Storage Format Version: %s' %
+                               version)
+        if tokenizer not in TOKENIZERS:
+            raise StorageError('Unknown Tokenizer: %s' % tokenizer)
+        if not re.match(r'^[0-9 ]*$', prefix):
+            raise StorageError('Invalid Prefix Index: %s' % prefix)
+        self.version = version
+        self.tokenizer = tokenizer
+        self.prefix = ' '.join(prefix.split())
+
+    def __eq__(self, other):
+        return isinstance(other, StorageFormat) and \
+            self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return 'StorageFormat(%s)' % self.to_dict()
+
+    def to_dict(self):
+        if self.version == FTS3:
+            return {'version': self.version}
+        return {'version': self.version, 'tokenizer': self.tokenizer,
+                'prefix': self.prefix}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['version'], data.get('tokenizer', 'unicode61'),
+                   data.get('prefix', ''))
+
+    @classmethod
+    def from_config(cls, section):
+        name = section.get('format', 'fts3')
+        try:
+            version = FORMAT_NAMES[name]
+        except KeyError:
+            raise StorageError('Unknown Storage Format: %s' % name)
+        return cls(version, section.get('tokenizer', 'unicode61'),
+                   section.get('prefix', ''))
+
+    def create_table_sql(self):
+        if self.version == FTS3:
+            return ['CREATE VIRTUAL TABLE SYSLOG USING FTS3(LOGS)']
+        sqls = []
+        columns = ['LOGS']
+        if self.version == COMPACTED:
+            columns.append('MINUTE UNINDEXED')
+        elif self.version == STRUCTURED:
+            sqls.append('CREATE TABLE LOG(ID INTEGER PRIMARY KEY, '
+                        'MINUTE TEXT, TS TEXT, HOST TEXT, PROGRAM TEXT, '
+                        'SEVERITY INTEGER, LOGS TEXT)')
+            for column in ('MINUTE', 'TS', 'HOST', 'PROGRAM'):
+                sqls.append('CREATE INDEX LOG_%s ON LOG(%s)' %
+                            (column, column))
+            columns += ["content='LOG'", "content_rowid='ID'"]
+        columns.append("tokenize='%s'" % self.tokenizer)
+        if self.prefix:
+            columns.append("prefix='%s'" % self.prefix)
+        sqls.append('CREATE VIRTUAL TABLE '
+                    'SYSLOG USING FTS5(%s)' % ', '.join(columns))
+        if self.version == STRUCTURED:
+            sqls.append('CREATE TRIGGER LOG_INSERT AFTER INSERT ON LOG '
+                        'BEGIN INSERT INTO SYSLOG(ROWID, LOGS) '
+                        'VALUES (NEW.ID, NEW.LOGS); END')
+        return sqls
+
+    # An existing partition (eg: reopened after a restart) keeps its format.
+    # Returns the format of the partition.
+    def create_schema(self, conn):
+        exists = conn.execute("SELECT 1 FROM SQLITE_MASTER WHERE "
+                              "TYPE = 'table' AND NAME = 'SYSLOG'").fetchone()
+        if exists:
+            version = partition_version(conn)
+            if version == self.version:
+                return self
+            return StorageFormat(version)
+        for sql in self.create_table_sql():
+            conn.execute(sql)
+        conn.execute('PRAGMA user_version = %d' % self.version)
+        return self
+
+    # rows: (line, minute) pairs, minute is 'YYYY-MM-DD hh:mm'
+    def insert(self, conn, rows):
+        if self.version == STRUCTURED:
+            conn.executemany('INSERT INTO LOG(MINUTE, TS, HOST, PROGRAM, '
+                             'SEVERITY, LOGS) VALUES (?, ?, ?, ?, ?, ?)',
+                             [structured_row(line, minute)
+                              for line, minute in rows])
+        elif self.version == COMPACTED:
+            conn.executemany('INSERT INTO SYSLOG(LOGS, MINUTE) '
+                             'VALUES (?, ?)', rows)
+        else:
+            conn.executemany('INSERT INTO SYSLOG(LOGS) VALUES (?)',
+                             [(line,) for line, _ in rows])
+        return len(rows)
+
+    def compacted(self):
+        return StorageFormat(STRUCTURED, self.tokenizer, self.prefix)
+
+    def match_expression(self, match, exact):
+        if self.version == FTS3:
+            if exact:
+                return '"%s"' % match
+            return match
+        if exact:
+            return fts5_phrase(match)
+        return fts5_query(match)
+
+
+def minute_str(time):
+    return time.strftime(TIME_FORMAT)
+
+
+def structured_row(line, minute):
+    ts, host, program, severity = \
+        parse_line(line, int(minute[:4]), int(minute[5:7]))
+    return (minute, ts, host, program, severity, line)
+
+
+def partition_version(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    return version or FTS3
+
+
+# Rows are never deleted from partitions, so the last row ID is the number
+# of rows (without scanning the full text index).
+def partition_rows(conn):
+    exists = conn.execute("SELECT 1 FROM SQLITE_MASTER WHERE "
+                          "TYPE = 'table' AND NAME = 'LOG'").fetchone()
+    if exists:
+        sql = 'SELECT max(ID) FROM LOG'
+    else:
+        sql = 'SELECT max(ROWID) FROM SYSLOG'
+    return conn.execute(sql).fetchone()[0] or 0
+
+
+def fts5_phrase(text, prefix=False):
+    phrase = '"%s"' % text.replace('"', '""')
+    if prefix:
+        phrase += '*'
+    return phrase
+
+
+FTS5_OPERATORS = ('AND', 'OR', 'NOT')
+FTS5_TOKEN_RE = re.compile(r'\s*(?:("(?:[^"]|"")*"\*?)'
+                           r'|([()])'
+                           r'|([^\s()"]+))')
+
+
+# Rewrites an FTS3 style query into FTS5 query syntax.
+# FTS5 only accepts alphanumeric barewords, so every term is quoted
+# as a phrase (eg: 192.168.0.1 -> "192.168.0.1"), and an explicit AND is
+# inserted between adjacent operands (eg: (a OR b) c).
+def fts5_query(match):
+    tokens = []
+    position = 0
+    match = match.strip()
+    while position < len(match):
+        m = FTS5_TOKEN_RE.match(match, position)
+        if not m:
+            # an unbalanced double quote
+            tokens.append(fts5_phrase(match[position:].strip().strip('"')))
+            break
+        position = m.end()
+        phrase, paren, word = m.groups()
+        if phrase:
+            tokens.append(phrase)
+        elif paren:
+            tokens.append(paren)
+        elif word in FTS5_OPERATORS:
+            tokens.append(word)
+        elif word.endswith('*') and len(word) > 1:
+            tokens.append(fts5_phrase(word[:-1], prefix=True))
+        else:
+            tokens.append(fts5_phrase(word))
+
+    query = []
+    for token in tokens:
+        if query and query[-1] not in FTS5_OPERATORS + ('(',) and \
+           token not in FTS5_OPERATORS + (')',):
+            query.append('AND')
+        query.append(token)
+    return ' '.join(query)
+
+
+def format_history_path(store_dir):
+    return os.path.join(store_dir, FORMAT_HISTORY_FILE)
+
+
+# The format history records since when each storage format is written
+# into a store, so that the format of any partition is known from its
+# time without opening it.
+# (one JSON object per line,
+#  eg: {"since": "2018-08-01 03:05", "version": 2, "tokenizer": ...})
+def load_format_history(store_dir):
+    path = format_history_path(store_dir)
+    history = []
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                since = datetime.strptime(data.pop('since'), TIME_FORMAT)
+                history.append((since, StorageFormat.from_dict(data)))
+    except FileNotFoundError:
+        pass
+    except (ValueError, KeyError) as e:
+        raise StorageError('Invalid Format History: %s, %s' % (path, e))
+    return history
+
+
+def record_format(store_dir, storage_format, since):
+    history = load_format_history(store_dir)
+    if history and history[-1][1] == storage_format:
+        return False
+    data = {'since': since.strftime(TIME_FORMAT)}
+    data.update(storage_format.to_dict())
+    os.makedirs(store_dir, exist_ok=True)
+    with open(format_history_path(store_dir), 'a') as f:
+        f.write(json.dumps(data) + '\n')
+    return True
+
+
+# Splits [start_time, end_time] (minutes, inclusive) into
+# (start, end, StorageFormat) segments written in the same format.
+def format_segments(history, start_time, end_time):
+    segments = []
+    current = StorageFormat(FTS3)
+    seg_start = start_time
+    for since, storage_format in history:
+        if since <= start_time:
+            current = storage_format
+            continue
+        if since > end_time:
+            break
+        segments.append((seg_start, since - timedelta(minutes=1), current))
+        seg_start = since
+        current = storage_format
+    segments.append((seg_start, end_time, current))
+    return segments
+
+
+class TestStorage(unittest.TestCase):
+
+    def test_fts5_query(self):
+        self.assertEqual('"noc"', fts5_query('noc'))
+        self.assertEqual('"noc" AND "192.168.0.1"',
+                         fts5_query('noc 192.168.0.1'))
+        self.assertEqual('"noc" OR "root"', fts5_query('noc OR root'))
+        self.assertEqual('( "noc" OR "root" ) AND "sshd[123]"',
+                         fts5_query('(noc OR root) sshd[123]'))
+        self.assertEqual('"acc"* AND "login failed"',
+                         fts5_query('acc* "login failed"'))
+        self.assertEqual('"noc" NOT "root"', fts5_query('noc NOT root'))
+
+    def test_match_expression(self):
+        fts3 = StorageFormat(FTS3)
+        fts5 = StorageFormat(FTS5, 'trigram')
+        self.assertEqual('noc 192.168', fts3.match_expression('noc 192.168',
+                                                              False))
+        self.assertEqual('"noc 192.168"',
+                         fts3.match_expression('noc 192.168', True))
+        self.assertEqual('"say ""hi"""',
+                         fts5.match_expression('say "hi"', True))
+
+    def test_structured_insert(self):
+        conn = sqlite3.connect(':memory:')
+        storage_format = StorageFormat(STRUCTURED).create_schema(conn)
+        storage_format.insert(conn, [('Aug  1 03:05:01 host1 sshd[1]: noc',
+                                      '2018-08-01 03:05')])
+        self.assertEqual(STRUCTURED, partition_version(conn))
+        sql = "SELECT TS, HOST, PROGRAM FROM LOG WHERE ID IN " \
+              "(SELECT ROWID FROM SYSLOG WHERE LOGS MATCH 'noc')"
+        self.assertEqual([('2018-08-01 03:05:01', 'host1', 'sshd')],
+                         conn.execute(sql).fetchall())
+
+    def test_format_segments(self):
+        fts5 = StorageFormat(FTS5, 'unicode61', '2 3')
+        history = [(datetime(2018, 8, 1, 3, 5), fts5)]
+        start = datetime(2018, 8, 1, 3, 0)
+        end = datetime(2018, 8, 1, 3, 10)
+        self.assertEqual([(start, datetime(2018, 8, 1, 3, 4),
+                           StorageFormat(FTS3)),
+                          (datetime(2018, 8, 1, 3, 5), end, fts5)],
+                         format_segments(history, start, end))
+        self.assertEqual([(start, end, StorageFormat(FTS3))],
+                         format_segments([], start, end))
+        self.assertEqual([(end, end, fts5)],
+                         format_segments(history, end, end))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,556 @@
+import argparse
+import configparser
+import itertools
+import json
+import os
+import select
+import shutil
+import signal
+import sqlite3
+import stat
+import sys
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from multiprocessing import Pool
+
+from hayabusa import HayabusaBase
+from hayabusa.bloom import write_partition_bloom
+from hayabusa.catalog import PartitionCatalog
+from hayabusa.db_file_path import partition_path
+from hayabusa.errors import HayabusaError, StoreEngineError, \
+    unexpected_error
+from hayabusa.storage import StorageFormat, FTS3, record_format, \
+    minute_str, partition_rows
+
+
+STORE_CONFIG_FILE = 'store_config.ini'
+
+
+def load_store_config():
+    config_path = os.path.join(HayabusaBase.etc_dir, STORE_CONFIG_FILE)
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    return config
+
+
+# The local file where a partition of the store is built.
+def staging_path(staging_dir, path):
+    if not staging_dir:
+        return path
+    return os.path.join(staging_dir, os.path.abspath(path).lstrip('/'))
+
+
+# Copies a partition built on the local disk into the store, and renames
+# it into place, so that readers only see complete partitions.
+def publish_partition(local_path, path):
+    if local_path == path:
+        return
+    tmp_path = path + '.tmp'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    shutil.copyfile(local_path, tmp_path)
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    os.remove(local_path)
+
+
+# Partitions are built in 'staging_dir' and published by rename, so the
+# partitions in the catalog never change (searched as immutable).
+class PartitionWriter:
+    def __init__(self, path, minute, logger, storage_format,
+                 overwrite=False, bloom_bits=0, staging_dir=None):
+        if not staging_dir:
+            raise StoreEngineError('No Staging Directory: %s' % path)
+        self.path = path
+        self.local_path = staging_path(staging_dir, path)
+        self.minute = minute
+        self.logger = logger
+        self.bloom_bits = bloom_bits
+        self.lines = 0
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.makedirs(os.path.dirname(self.local_path), exist_ok=True)
+        if overwrite:
+            if os.path.exists(self.local_path):
+                os.remove(self.local_path)
+        elif not os.path.exists(self.local_path) and os.path.exists(path):
+            # a published partition reopened (eg: after a restart),
+            # it is replaced when this one is published
+            shutil.copyfile(path, self.local_path)
+        self.logger.debug('opening partition: %s', self.local_path)
+        self.conn = sqlite3.connect(self.local_path)
+        self.conn.execute('PRAGMA SYNCHRONOUS = OFF')
+        self.conn.execute('PRAGMA JOURNAL_MODE = MEMORY')
+        self.storage_format = storage_format.create_schema(self.conn)
+
+    def write(self, lines):
+        minute = minute_str(self.minute)
+        try:
+            self.storage_format.insert(self.conn,
+                                       [(line, minute) for line in lines])
+        except sqlite3.Error as e:
+            raise StoreEngineError('Insert Error: %s, %s' % (self.path, e))
+        self.conn.commit()
+        self.lines += len(lines)
+
+    def rows(self):
+        return partition_rows(self.conn)
+
+    def close(self):
+        try:
+            if self.bloom_bits and self.storage_format.version != FTS3:
+                write_partition_bloom(self.conn, self.path,
+                                      self.storage_format.tokenizer,
+                                      self.bloom_bits)
+        finally:
+            self.conn.close()
+        # the bloom filter has all the terms of the old partition if any,
+        # so it is published first
+        publish_partition(self.local_path, self.path)
+        self.logger.debug('published partition: %s (%s lines)',
+                          self.path, self.lines)
+
+
+class LogTailer:
+    # bytes read from a pipe at a time
+    READ_SIZE = 65536
+
+    def __init__(self, path, poll_interval, logger, from_start=False):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.logger = logger
+        self.from_start = from_start
+        self.fh = None
+        self.inode = None
+        self.pipe = False
+
+    def open(self, seek_end):
+        if self.path == '-':
+            self.fh = sys.stdin
+            self.pipe = True
+            return
+        self.fh = open(self.path, 'r', encoding='utf-8', errors='ignore')
+        st = os.fstat(self.fh.fileno())
+        self.inode = st.st_ino
+        self.pipe = stat.S_ISFIFO(st.st_mode)
+        if seek_end and not self.pipe:
+            self.fh.seek(0, os.SEEK_END)
+        self.logger.debug('following %s (inode: %s)', self.path, self.inode)
+
+    def rotated(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if st.st_ino != self.inode:
+            return True
+        # copytruncate
+        return st.st_size < self.fh.tell()
+
+    def wait(self):
+        if self.pipe:
+            readable, _, _ = select.select([self.fh], [], [],
+                                           self.poll_interval)
+            return bool(readable)
+        time.sleep(self.poll_interval)
+        return False
+
+    # Yields complete lines, and None whenever the source is idle
+    # so that the caller can flush and roll over partitions.
+    def lines(self):
+        self.open(seek_end=not self.from_start)
+        if self.pipe:
+            yield from self.pipe_lines()
+            return
+        partial = ''
+        while True:
+            line = self.fh.readline()
+            if line:
+                if not line.endswith('\n'):
+                    partial += line
+                    continue
+                yield partial + line
+                partial = ''
+                continue
+            if self.rotated():
+                self.logger.info('log file rotated: %s', self.path)
+                # drain the rest of the old file before reopening
+                rest = self.fh.read()
+                self.fh.close()
+                for line in (partial + rest).splitlines(keepends=True):
+                    yield line
+                partial = ''
+                self.open(seek_end=False)
+                continue
+            self.wait()
+            yield None
+
+    # A pipe is read from its file descriptor, because the lines read
+    # ahead into the buffer of the file object are not seen by select
+    # (they would wait for more lines to be written).
+    def pipe_lines(self):
+        fd = self.fh.fileno()
+        partial = b''
+        while True:
+            if not self.wait():
+                yield None
+                continue
+            data = os.read(fd, LogTailer.READ_SIZE)
+            if not data:
+                # EOF of a pipe: the writer has gone
+                if partial:
+                    yield partial.decode('utf-8', errors='ignore')
+                return
+            lines = (partial + data).split(b'\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8', errors='ignore') + '\n'
+
+
+# A store (the partitions of a tenant) written by the store engine.
+class Store:
+    def __init__(self, base_dir, storage_format, logger, bloom_bits=0,
+                 staging_dir=None):
+        self.base_dir = base_dir
+        self.storage_format = storage_format
+        self.logger = logger
+        self.bloom_bits = bloom_bits
+        self.staging_dir = staging_dir
+        self.format_recorded = False
+        self.catalog = None
+
+    def close(self):
+        if self.catalog:
+            self.catalog.close()
+            self.catalog = None
+
+    def open_partition(self, minute, overwrite=False):
+        if not self.format_recorded:
+            if record_format(self.base_dir, self.storage_format, minute):
+                self.logger.info('storage format changed: %s, %s',
+                                 self.base_dir, self.storage_format)
+            self.format_recorded = True
+        if not self.catalog:
+            self.catalog = PartitionCatalog(self.base_dir)
+        path = partition_path(self.base_dir, minute)
+        return PartitionWriter(path, minute, self.logger,
+                               self.storage_format, overwrite=overwrite,
+                               bloom_bits=self.bloom_bits,
+                               staging_dir=self.staging_dir)
+
+    # Partitions are searchable after they are published.
+    def close_partition(self, writer):
+        rows = writer.rows()
+        writer.close()
+        self.catalog.register(writer.path, writer.minute, writer.minute,
+                              writer.storage_format.version, rows)
+
+    # Publishes the partitions left in the staging directory
+    # by a stopped store engine (except the current minute's one,
+    # which is reopened).
+    def recover(self, current_minute):
+        local_dir = staging_path(self.staging_dir, self.base_dir)
+        if local_dir == self.base_dir or not os.path.isdir(local_dir):
+            return
+        minutes = []
+        for root, _, files in os.walk(local_dir):
+            for name in files:
+                relpath = os.path.relpath(os.path.join(root, name),
+                                          local_dir)
+                try:
+                    minutes.append(datetime.strptime(relpath,
+                                                     '%Y/%m/%d/%H/%M.db'))
+                except ValueError:
+                    continue
+        for minute in sorted(minutes):
+            if minute == current_minute:
+                continue
+            self.logger.info('publishing a partition left in '
+                             'the staging directory: %s', minute)
+            self.close_partition(self.open_partition(minute))
+
+
+# A log file ingested into the store of a tenant ('[source:NAME]')
+Source = namedtuple('Source', ['name', 'file', 'tenant'])
+
+
+def load_sources(store_config):
+    sources = []
+    for section in store_config.sections():
+        if not section.startswith('source:'):
+            continue
+        name = section[len('source:'):]
+        try:
+            sources.append(Source(name, store_config[section]['file'],
+                                  store_config[section]['tenant']))
+        except KeyError as e:
+            raise StoreEngineError('Invalid Source: %s, no %s' %
+                                   (section, e))
+    return sources
+
+
+# The position in a source file up to which the lines are stored.
+# (eg: {"inode": 1234, "offset": 5678})
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            return (data['inode'], data['offset'])
+        except FileNotFoundError:
+            return (None, 0)
+        except (ValueError, KeyError) as e:
+            raise StoreEngineError('Invalid Checkpoint: %s, %s' %
+                                   (self.path, e))
+
+    def save(self, inode, offset):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'inode': inode, 'offset': offset}, f)
+        os.rename(tmp_path, self.path)
+
+
+# Ingests the lines added to the sources of a tenant since the last
+# checkpoints into the partition of the current minute.
+# Tenants are ingested in parallel by a process pool, and the sources of
+# a tenant one by one (they share the partition).
+class TenantIngester:
+    def __init__(self, store_dir, storage_format, logger, batch_lines,
+                 checkpoint_dir, bloom_bits=0, staging_dir=None):
+        self.store_dir = store_dir
+        self.storage_format = storage_format
+        self.logger = logger
+        self.batch_lines = batch_lines
+        self.checkpoint_dir = checkpoint_dir
+        self.bloom_bits = bloom_bits
+        self.staging_dir = staging_dir
+
+    # Returns the checkpoint, and the inode and the offset to save.
+    def read_source(self, source, open_writer):
+        checkpoint = Checkpoint(os.path.join(self.checkpoint_dir,
+                                             source.name + '.json'))
+        inode, offset = checkpoint.load()
+        try:
+            fh = open(source.file, 'rb')
+        except FileNotFoundError:
+            self.logger.info('source not found: %s, %s',
+                             source.name, source.file)
+            return None
+        with fh:
+            st = os.fstat(fh.fileno())
+            if st.st_ino != inode or st.st_size < offset:
+                # rotated or truncated
+                offset = 0
+            fh.seek(offset)
+            while True:
+                chunk = list(itertools.islice(fh, self.batch_lines))
+                if chunk and not chunk[-1].endswith(b'\n'):
+                    # the incomplete last line is read next time
+                    chunk.pop()
+                if not chunk:
+                    break
+                open_writer().write([line.decode('utf-8', 'ignore')
+                                     for line in chunk])
+                offset += sum(len(line) for line in chunk)
+        return (checkpoint, st.st_ino, offset)
+
+    # tenant_sources: (tenant, [Source, ...])
+    # Returns (tenant, lines, error).
+    def ingest(self, tenant_sources):
+        tenant, sources = tenant_sources
+        store = Store(os.path.join(self.store_dir, tenant),
+                      self.storage_format, self.logger,
+                      bloom_bits=self.bloom_bits,
+                      staging_dir=self.staging_dir)
+        minute = datetime.now().replace(second=0, microsecond=0)
+        writers = []
+
+        def open_writer():
+            if not writers:
+                writers.append(store.open_partition(minute))
+            return writers[0]
+
+        try:
+            positions = []
+            try:
+                for source in sources:
+                    position = self.read_source(source, open_writer)
+                    if position:
+                        positions.append(position)
+            finally:
+                if writers:
+                    store.close_partition(writers[0])
+                store.close()
+            # after the lines are published
+            # (lines may be stored twice if it stops here, never lost)
+            for checkpoint, inode, offset in positions:
+                checkpoint.save(inode, offset)
+            lines = writers[0].lines if writers else 0
+            return (tenant, lines, None)
+        except Exception as e:
+            self.logger.error('%s: %s: %s', tenant,
+                              e.__class__.__name__, e)
+            return (tenant, 0, '%s: %s' % (e.__class__.__name__, e))
+
+
+class StoreEngine(HayabusaBase):
+    def __init__(self):
+        self.args = self.parse_args()
+        super().__init__('store-engine', stderr_logging=self.args.v)
+
+        store_config = load_store_config()
+        self.store_config = store_config
+        self.log_file = store_config['path']['log-file']
+        self.follow_file = store_config['path']['follow-file']
+        self.base_dir = store_config['path']['base-dir']
+        self.store_dir = store_config['path'].get('store-dir')
+        self.staging_dir = store_config['path'].get('staging-dir')
+        self.checkpoint_dir = store_config['path'].get('checkpoint-dir')
+        self.batch_lines = int(store_config['ingest']['batch-lines'])
+        self.flush_interval = float(store_config['ingest']['flush-interval'])
+        self.poll_interval = float(store_config['ingest']['poll-interval'])
+        self.processes = int(store_config['ingest'].get('processes', '4'))
+        self.storage_format = \
+            StorageFormat.from_config(store_config['storage'])
+        self.bloom_bits = \
+            float(store_config['storage'].get('bloom-bits-per-term', '0'))
+        self.store = Store(self.base_dir, self.storage_format, self.logger,
+                           bloom_bits=self.bloom_bits,
+                           staging_dir=self.staging_dir)
+
+        self.writer = None
+        self.buffer = []
+        self.last_flush = time.time()
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--follow', action='store_true',
+                            help='run as a daemon following the live log')
+        parser.add_argument('--from-start', action='store_true',
+                            help='with --follow, read the log file '
+                                 'from the beginning')
+        parser.add_argument('--source',
+                            help="log file to read, '-' for stdin "
+                                 '(default: log-file, or follow-file '
+                                 'with --follow)')
+        parser.add_argument('--sources', action='store_true',
+                            help='ingest the new lines of all the '
+                                 '[source:NAME] sections in parallel')
+        parser.add_argument('-v', help='verbose', action='store_true')
+        return parser.parse_args()
+
+    def ingest_sources(self):
+        sources = load_sources(self.store_config)
+        if not sources:
+            raise StoreEngineError('No Sources: %s' % STORE_CONFIG_FILE)
+        if not self.store_dir or not self.checkpoint_dir:
+            raise StoreEngineError('store-dir and checkpoint-dir '
+                                   'are required: %s' % STORE_CONFIG_FILE)
+        tenants = OrderedDict()
+        for source in sources:
+            tenants.setdefault(source.tenant, []).append(source)
+
+        ingester = TenantIngester(self.store_dir, self.storage_format,
+                                  self.logger, self.batch_lines,
+                                  self.checkpoint_dir,
+                                  bloom_bits=self.bloom_bits,
+                                  staging_dir=self.staging_dir)
+        errors = []
+        with Pool(min(self.processes, len(tenants))) as pool:
+            for tenant, lines, error in \
+                    pool.imap_unordered(ingester.ingest, tenants.items()):
+                if error:
+                    errors.append(tenant)
+                else:
+                    self.logger.debug('ingested %s: %s lines', tenant, lines)
+        if errors:
+            raise StoreEngineError('Ingest Error: %s' % ', '.join(errors))
+
+    def batch(self):
+        source = self.args.source or self.log_file
+        minute = datetime.now().replace(second=0, microsecond=0)
+        writer = self.store.open_partition(minute, overwrite=True)
+        try:
+            with open(source, 'r', encoding='utf-8', errors='ignore') as fh:
+                while True:
+                    chunk = list(itertools.islice(fh, self.batch_lines))
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+        finally:
+            self.store.close_partition(writer)
+
+    def flush(self):
+        if self.buffer:
+            if not self.writer:
+                self.writer = \
+                    self.store.open_partition(self.current_minute)
+            self.writer.write(self.buffer)
+            self.buffer = []
+        self.last_flush = time.time()
+
+    def roll_over(self, minute):
+        self.flush()
+        if self.writer:
+            self.store.close_partition(self.writer)
+            self.writer = None
+        self.current_minute = minute
+
+    def follow(self):
+        source = self.args.source or self.follow_file
+        tailer = LogTailer(source, self.poll_interval, self.logger,
+                           from_start=self.args.from_start)
+        self.current_minute = \
+            datetime.now().replace(second=0, microsecond=0)
+        self.store.recover(self.current_minute)
+        try:
+            for line in tailer.lines():
+                minute = datetime.now().replace(second=0, microsecond=0)
+                if minute != self.current_minute:
+                    self.roll_over(minute)
+                if line is not None:
+                    self.buffer.append(line)
+                if len(self.buffer) >= self.batch_lines or \
+                   time.time() - self.last_flush >= self.flush_interval:
+                    self.flush()
+        finally:
+            self.roll_over(None)
+
+    def terminate(self, signum, frame):
+        self.logger.info('Received signal %s, stopping %s',
+                         signum, self.name)
+        exit(0)
+
+    def main(self):
+        if not self.staging_dir:
+            raise StoreEngineError('staging-dir is required: %s' %
+                                   STORE_CONFIG_FILE)
+        if self.args.sources:
+            self.ingest_sources()
+        elif self.args.follow:
+            self.logger.info('========================='
+                             ' Starting Store Engine '
+                             '=========================')
+            signal.signal(signal.SIGTERM, self.terminate)
+            self.follow()
+        else:
+            self.batch()
+
+    def exec(self):
+        try:
+            self.main()
+        except KeyboardInterrupt:
+            sys.stderr.write('Interrupted\n')
+            exit(1)
+        except HayabusaError as e:
+            self.logger.error('%s: %s', e.__class__.__name__, e)
+            sys.stderr.write('%s: %s\n' % (e.__class__.__name__, e))
+            exit(1)
+        except Exception as e:
+            unexpected_error(self.logger, 'StoreEngine', e)
+            raise
@@ -1,19 +1,29 @@
 import copy
 import os
 import subprocess
+import threading
 import time
+from collections import OrderedDict
 from multiprocessing import Process
 from setproctitle import setproctitle
 
 import zmq
 
 from hayabusa import HayabusaBase
-from hayabusa.constants import Status
-from hayabusa.errors import unexpected_error
+from hayabusa.archive import ArchiveExtractor
+from hayabusa.bloom import PartitionPruner
+from hayabusa.constants import Status, BROKER_PORT_STRIDE
+from hayabusa.db_file_path import expand_paths
+from hayabusa.errors import HayabusaError, unexpected_error
+from hayabusa.partition_cache import PartitionCache
+from hayabusa.query_engine import QueryEngine, format_rows
 from hayabusa.utils import time_str
 
 
 class Worker(HayabusaBase):
+    # the IDs of the cancelled requests kept by each process
+    MAX_CANCELLED = 1000
+
     def __init__(self):
         super().__init__('worker')
         self.name = 'MainProcess'
@@ -26,25 +36,32 @@ class Worker(HayabusaBase):
         config = self.config
         self.num_processes = int(config['worker']['process'])
         self.request_borker_host = config['request-broker']['host']
-        self.local_command_port = config['port']['worker-local']
         self.receiver_port = config['port']['command']
         self.sender_port = config['port']['result']
-        self.bash_path = config['path']['bash']
-
-        receiver_connect = 'tcp://%s:%s' % \
-                           (self.request_borker_host, self.receiver_port)
-        sender_bind = 'tcp://%s:%s' % ('127.0.0.1', self.local_command_port)
-        self.info('Command PULL: %s', receiver_connect)
-        self.info('Command Local PUSH: %s', sender_bind)
-
-        pull_context = zmq.Context()
-        self.main_receiver = pull_context.socket(zmq.PULL)
-
-        self.main_receiver.connect(receiver_connect)
-
-        push_context = zmq.Context()
-        self.main_sender = push_context.socket(zmq.PUSH)
-        self.main_sender.bind(sender_bind)
+        self.cancel_port = config['port'].get('cancel', '5559')
+        self.broker_processes = \
+            int(config['request-broker'].get('processes', '1'))
+        # threads and cached connections of the query engine of each
+        # process
+        self.threads = int(config['worker'].get('threads', '4'))
+        self.max_connections = \
+            int(config['worker'].get('connection-cache', '256'))
+        # second, idle processes offer themselves again at the interval
+        self.ready_interval = \
+            float(config['worker'].get('ready-interval', '5'))
+        # the rows of streamed requests are sent in chunks of about
+        # 'chunk-size' KB
+        self.chunk_size = \
+            int(float(config['worker'].get('chunk-size', '1024')) * 1024)
+        # local copies of the partitions in the partition catalog
+        cache_dir = config['worker'].get('partition-cache-dir', '')
+        cache_size = \
+            float(config['worker'].get('partition-cache-size', '0'))
+        self.partition_cache_dir = cache_dir if cache_size else None
+        self.partition_cache_bytes = int(cache_size * 1024 * 1024)
+        # archive members are decompressed here to be searched
+        self.archive_dir = os.path.join(config['path']['tmp-dir'],
+                                        'hayabusa-archive')
 
     def worker_label(self):
         return '%s-%s' % (self.hostname, self.name)
@@ -58,43 +75,129 @@ class Worker(HayabusaBase):
     def debug(self, *args):
         self.__log(self.logger.debug, *args)
 
+    # Each process asks each request broker process for a command when
+    # it is free (a socket for each broker process, so that the messages
+    # go to a given broker process).
     def connect_ports(self):
-        receiver_connect = 'tcp://%s:%s' % \
-                           ('127.0.0.1', self.local_command_port)
         sender_connect = 'tcp://%s:%s' % \
                          (self.request_borker_host, self.sender_port)
-        self.info('Command Local PULL: %s', receiver_connect)
-        self.info('Result PUSH: %s', sender_connect)
 
-        pull_context = zmq.Context()
-        self.receiver = pull_context.socket(zmq.PULL)
-        self.receiver.connect(receiver_connect)
+        dealer_context = zmq.Context()
+        self.receivers = []
+        for n in range(self.broker_processes):
+            receiver_connect = 'tcp://%s:%s' % \
+                               (self.request_borker_host,
+                                int(self.receiver_port) +
+                                n * BROKER_PORT_STRIDE)
+            self.info('Command DEALER: %s', receiver_connect)
+            receiver = dealer_context.socket(zmq.DEALER)
+            receiver.connect(receiver_connect)
+            self.receivers.append(receiver)
+
+        self.push_context = zmq.Context()
+        self.senders = {}
+        self.default_reply_to = sender_connect
 
-        push_context = zmq.Context()
-        self.sender = push_context.socket(zmq.PUSH)
-        self.sender.connect(sender_connect)
+        self.engine = QueryEngine(self.threads, self.max_connections)
+        self.partition_cache = None
+        if self.partition_cache_dir:
+            self.partition_cache = PartitionCache(self.partition_cache_dir,
+                                                  self.partition_cache_bytes)
+
+        # {request ID: None} of the cancelled requests,
+        # and the request ID of the running command
+        self.cancelled = OrderedDict()
+        self.running = None
+        self.cancel_lock = threading.Lock()
+        listener = threading.Thread(target=self.cancel_listener)
+        listener.daemon = True
+        listener.start()
+
+    # Receives the IDs of the cancelled requests from all the request
+    # broker processes, and stops the running command of the request.
+    def cancel_listener(self):
+        sub_context = zmq.Context()
+        receiver = sub_context.socket(zmq.SUB)
+        receiver.setsockopt_string(zmq.SUBSCRIBE, '')
+        for n in range(self.broker_processes):
+            cancel_connect = 'tcp://%s:%s' % \
+                             (self.request_borker_host,
+                              int(self.cancel_port) + n * BROKER_PORT_STRIDE)
+            self.info('Cancel SUB: %s', cancel_connect)
+            receiver.connect(cancel_connect)
+        while True:
+            request_id = receiver.recv_string()
+            with self.cancel_lock:
+                self.cancelled[request_id] = None
+                if len(self.cancelled) > Worker.MAX_CANCELLED:
+                    self.cancelled.popitem(last=False)
+                if self.running == request_id:
+                    self.info('Cancelled: %s', request_id)
+                    self.engine.interrupt()
+
+    def is_cancelled(self, request_id):
+        with self.cancel_lock:
+            return request_id in self.cancelled
+
+    # The results go to the request broker process of the request.
+    def result_sender(self, message):
+        address = message.get('reply_to', self.default_reply_to)
+        if address not in self.senders:
+            self.info('Result PUSH: %s', address)
+            sender = self.push_context.socket(zmq.PUSH)
+            sender.connect(address)
+            self.senders[address] = sender
+        return self.senders[address]
 
     def start(self):
         self.info('Starting %s Worker Processes: %s', self.num_processes,
                   self.hostname)
+        processes = []
         for i in range(self.num_processes):
             p = Process(target=self.main_loop, args=(i+1,))
             p.start()
+            processes.append(p)
 
-        # Load balancing
-        while True:
-            message = self.main_receiver.recv()
-            self.main_sender.send(message)
+        # the processes get the commands from the request brokers
+        for p in processes:
+            p.join()
+
+    # 'ready' is a credit for a command, 'start' makes the request broker
+    # requeue the command lost by the restart of the process, and
+    # 'renew' repeats the credit of an idle process (a restarted request
+    # broker process lost it).
+    def ready(self, receiver, start=False, renew=False):
+        message = {'type': 'ready', 'worker': self.worker_label(),
+                   'host': self.hostname}
+        if start:
+            message['start'] = True
+        if renew:
+            message['renew'] = True
+        receiver.send_json(message)
+
+    def withdraw(self, receiver):
+        receiver.send_json({'type': 'withdraw',
+                            'worker': self.worker_label()})
 
     def notify(self, message):
         new_message = copy.deepcopy(message)
         new_message['type'] = 'notice'
         new_message['worker'] = self.worker_label()
         new_message['message'] = Status.RW_ReceivedCommand.name
-        self.sender.send_json(new_message)
+        self.result_sender(message).send_json(new_message)
         self.debug('[%s] - %s',
                    Status.WR_SentNotice, new_message)
 
+    # A chunk of the rows of a command of a streamed request.
+    def send_chunk(self, message, seq, stdout):
+        new_message = {'id': message['id'], 'type': 'chunk',
+                       'worker': self.worker_label(),
+                       'index': message['index'], 'seq': seq,
+                       'stdout': stdout}
+        self.result_sender(message).send_json(new_message)
+        self.debug('[%s] - %s #%s chunk %s', Status.WR_SentResult,
+                   message['id'], message['index'], seq)
+
     def send_result(self, start_time, message, process):
         stdout = process.stdout
         stderr = process.stderr
@@ -108,7 +211,16 @@ class Worker(HayabusaBase):
         new_message['stdout'] = stdout
         elapsed_time = float('%.3f' % (time.time() - start_time))
         new_message['elapsed_time'] = elapsed_time
-        self.sender.send_json(new_message)
+        partition_counts = getattr(process, 'partition_counts', None)
+        if partition_counts:
+            new_message['partition_counts'] = partition_counts
+        # the rest of the rows of a streamed request follow the chunks
+        chunks = getattr(process, 'chunks', None)
+        if chunks:
+            new_message['chunks'] = chunks
+        if self.partition_cache:
+            new_message['partition_cache'] = self.partition_cache.stats()
+        self.result_sender(message).send_json(new_message)
 
         log_message = self.log_filter(new_message)
         self.debug('[%s] [%s]: %s', Status.WR_SentResult,
@@ -120,10 +232,30 @@ class Worker(HayabusaBase):
         message = {}
         try:
             self.connect_ports()
+            poller = zmq.Poller()
+            for receiver in self.receivers:
+                poller.register(receiver, zmq.POLLIN)
+                self.ready(receiver, start=True)
             while True:
-                #  Wait for next command from Request Broker
-                message = self.receiver.recv_json()
-                self.main(message)
+                #  Wait for next command from Request Brokers
+                ready = [receiver for receiver, _ in
+                         poller.poll(self.ready_interval * 1000)]
+                if not ready:
+                    for receiver in self.receivers:
+                        self.ready(receiver, renew=True)
+                    continue
+                # the other broker processes do not wait for this process
+                for receiver in self.receivers:
+                    if receiver not in ready:
+                        self.withdraw(receiver)
+                # the commands sent before the withdrawals arrived
+                while ready:
+                    for receiver in ready:
+                        message = receiver.recv_json()
+                        self.main(message)
+                    ready = [receiver for receiver, _ in poller.poll(0)]
+                for receiver in self.receivers:
+                    self.ready(receiver)
         except Exception as e:
             unexpected_error(self.logger, 'Worker-%s' % self.name, e, message)
             raise
@@ -131,11 +263,141 @@ class Worker(HayabusaBase):
     def main(self, message):
         start_time = time.time()
         self.debug('[%s] - %s', Status.RW_ReceivedCommand, message)
+        if self.is_cancelled(message['id']):
+            self.debug('Dropped Command: %s #%s', message['id'],
+                       message['index'])
+            return
         self.notify(message)
-        cmd = message['command']
 
-        # Bash is required for 'Brace Expansion'.
-        process = subprocess.run(cmd, executable=self.bash_path, shell=True,
-                                 encoding='utf-8', stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
+        extractor = ArchiveExtractor(self.archive_dir)
+        try:
+            process = self.run(message, extractor)
+        except HayabusaError as e:
+            process = subprocess.CompletedProcess(message['sql'], 1, '',
+                                                  '%s: %s\n' %
+                                                  (e.__class__.__name__, e))
+        finally:
+            extractor.cleanup()
+        if self.is_cancelled(message['id']):
+            # the request broker ignores the results of cancelled requests
+            return
         self.send_result(start_time, message, process)
+
+    # Searches the partitions with the query engine.
+    # The result is a CompletedProcess, as the commands used to be
+    # 'parallel sqlite3' in a shell: the output of the partitions in
+    # order, and an error line for each failed partition.
+    def run(self, message, extractor):
+        paths = expand_paths(message['paths'])
+        pruner = PartitionPruner(message['phrases'], extractor.load_bloom)
+        # (index of the path, path to search)
+        searched = []
+        for i, path in enumerate(paths):
+            if not pruner.may_match(path):
+                continue
+            # the hours of archives are searched in local copies
+            target = extractor.local_path(path)
+            if target:
+                searched.append((i, target))
+        skipped = len(paths) - len(searched)
+        self.debug('partitions: %s, skipped: %s', len(paths), skipped)
+
+        sql = message['sql']
+        immutable = bool(message.get('immutable'))
+        # the connections to the local copies of archives are not kept
+        archived = set(i for i, target in searched if target != paths[i])
+        # the errors name the partitions, not their local copies
+        targets = searched
+        if immutable and self.partition_cache:
+            targets = self.cached_partitions(searched, archived)
+        partitions = [(target, immutable, immutable and i not in archived)
+                      for i, target in targets]
+        with self.cancel_lock:
+            self.running = message['id']
+            if message['id'] in self.cancelled:
+                self.engine.interrupt()
+        chunks = 0
+        try:
+            if message.get('stream') and not message['count']:
+                results, tail, chunks = self.stream_results(message, sql,
+                                                            partitions)
+            else:
+                results = self.engine.run(sql, partitions)
+        finally:
+            with self.cancel_lock:
+                self.running = None
+                self.engine.reset()
+
+        stderr = ''.join('Error: %s: %s\n' % (target, error)
+                         for (_, target), (_, error) in zip(searched, results)
+                         if error)
+        returncode = 1 if stderr else 0
+        if not message['count']:
+            if message.get('stream'):
+                stdout = tail
+            else:
+                stdout = ''.join(format_rows(rows) for rows, _ in results
+                                 if rows)
+            process = subprocess.CompletedProcess(sql, returncode, stdout,
+                                                  stderr)
+            process.chunks = chunks
+            return process
+
+        counts = [rows[0][0] if rows else 0 for rows, _ in results]
+        if message['sum']:
+            stdout = '%d\n' % sum(counts)
+        else:
+            # a count for each partition, as if it had been searched
+            stdout = ''.join('%d\n' % count for count in counts) + \
+                '0\n' * skipped
+        process = subprocess.CompletedProcess(sql, returncode, stdout,
+                                              stderr)
+        if message.get('count_keys') and not stderr:
+            self.partition_counts(message, process, len(paths), searched,
+                                  counts)
+        return process
+
+    # Sends the rows of the partitions of a streamed request in chunks
+    # while the partitions are searched, so that the worker process
+    # keeps the rows of a few partitions at a time.
+    # Returns (None, error message) of each partition, the rows which
+    # did not fill a chunk and the number of the chunks sent.
+    def stream_results(self, message, sql, partitions):
+        results = []
+        buffer = []
+        size = 0
+        seq = 0
+        for rows, error in self.engine.iterate(sql, partitions):
+            results.append((None, error))
+            if not rows:
+                continue
+            text = format_rows(rows)
+            buffer.append(text)
+            size += len(text)
+            if size >= self.chunk_size:
+                self.send_chunk(message, seq, ''.join(buffer))
+                seq += 1
+                buffer = []
+                size = 0
+        return (results, ''.join(buffer), seq)
+
+    # Replaces the partitions with their local copies (copied on the
+    # threads of the query engine).
+    def cached_partitions(self, searched, archived):
+        def local_path(entry):
+            i, target = entry
+            if i in archived:
+                return entry
+            return (i, self.partition_cache.local_path(target))
+        return list(self.engine.executor.map(local_path, searched))
+
+    # Adds the counts of the partitions ((count key, count) pairs) to
+    # the process, so that the request broker memoizes them.
+    def partition_counts(self, message, process, num_paths, searched,
+                         values):
+        if len(message['count_keys']) != num_paths:
+            return
+        counts = [0] * num_paths
+        for (i, _), value in zip(searched, values):
+            counts[i] = value
+        process.partition_counts = list(zip(message['count_keys'], counts))
@@ -285,7 +285,8 @@ def post_request(user, match, start_time, end_time, count, sum, exact):
     request_id = webui.rest_client.search_base(user.username,
                                                user.api_password,
                                                match, start_time, end_time,
-                                               count, sum, exact, host, port)
+                                               count, sum, exact, host, port,
+                                               stream=True)
     th = threading.Thread(target=receive_result,
                           args=(receiver, user.username, request_id))
     th.setDaemon(True)
@@ -306,7 +307,9 @@ def receive_result_main(receiver, user, request_id):
     meta_file = file_name_base + '.meta'
 
     try:
-        data = webui.rest_client.receive_data(receiver)
+        # the rows are written as they are received
+        with open(stdout_file, mode='w') as f:
+            data = webui.rest_client.receive_result(receiver, output=f)
         stdout = data['stdout']
         stderr = data['stderr']
         exit_status = data['exit_status']
@@ -322,7 +325,7 @@ def receive_result_main(receiver, user, request_id):
 
 def create_result_files(user, stdout_file, meta_file, stdout, stderr,
                         exit_status):
-    with open(stdout_file, mode='w') as f:
+    with open(stdout_file, mode='a') as f:
         f.write(stdout)
 
     remove_empty_lines(stdout_file)